@@ -1,156 +1,54 @@
 # app.py - Main Streamlit application file
 
 import streamlit as st
-import psycopg2
 import os
-import uuid
 import base64
-from datetime import datetime
-from twilio.rest import Client
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-import imaplib
-import email
-from email.header import decode_header
+import csv
+import io
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
 from O365 import Account, FileSystemTokenBackend, Message
-from twilio.twiml.voice_response import VoiceResponse
-from flask import Flask, request
-from threading import Thread
 from dotenv import load_dotenv
+from db import get_db_connection
+from migrations import ensure_schema
+from mail_sync import get_mail_sync, get_inbox_emails
+from outbound_email import get_email_outbox
+from twilio_dispatch import enqueue, get_dispatcher
+from identity import get_identity_cache
+from attachment_store import get_attachment_store, attachment_url, check_link_secret
+from previews import get_preview_cache
+from notifications import get_event_hub, ALL_TOPIC
+from broadcast import create_broadcast, broadcast_progress, get_broadcasts
+from metrics import CHANNEL_ERRORS, CHANNEL_SECONDS, serve_metrics_once, timed
+from query_cache import get_query_cache
 
 load_dotenv()  # Add this near the top of your file, after imports
 
-# Initialize Flask app
-flask_app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 # Twilio credentials
 account_sid = os.getenv('TWILIO_ACCOUNT_SID')
 auth_token = os.getenv('TWILIO_AUTH_TOKEN')
 twilio_number = os.getenv('TWILIO_PHONE_NUMBER')
-client = Client(account_sid, auth_token)
-
-# Database connection
-def get_db_connection():
-    conn = psycopg2.connect(
-        host="localhost",
-        database="omni_channel_db",
-        user="postgres",
-        password=os.getenv('DB_PASSWORD')
-    )
-    return conn
+# TwiML webhook Twilio fetches when an outbound call connects
+voice_url = os.getenv('TWILIO_VOICE_URL', 'https://4824-64-224-134-197.ngrok-free.app/incoming-call')
 
-# Initialize database tables
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Create users table
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        username VARCHAR(50) UNIQUE NOT NULL,
-        email VARCHAR(100) UNIQUE NOT NULL,
-        phone_number VARCHAR(20) UNIQUE NOT NULL,
-        password VARCHAR(100) NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create messages table
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS messages (
-        id SERIAL PRIMARY KEY,
-        sender_id INTEGER REFERENCES users(id),
-        receiver_id INTEGER REFERENCES users(id),
-        message_type VARCHAR(20) NOT NULL,  -- 'email', 'sms', 'chat', 'call'
-        content TEXT,
-        attachment_path TEXT,
-        status VARCHAR(20) NOT NULL,  -- 'sent', 'delivered', 'read'
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create calls table
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS calls (
-        id SERIAL PRIMARY KEY,
-        caller_id INTEGER REFERENCES users(id),
-        receiver_phone VARCHAR(20),
-        start_time TIMESTAMP,
-        end_time TIMESTAMP,
-        status VARCHAR(20),  -- 'ongoing', 'completed', 'missed'
-        direction VARCHAR(10),  -- 'inbound', 'outbound'
-        call_sid VARCHAR(34),  -- Twilio Call SID
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Insert demo users if they don't exist
-    cur.execute("SELECT COUNT(*) FROM users")
-    if cur.fetchone()[0] == 0:
-        cur.execute("""
-        INSERT INTO users (username, email, phone_number, password)
-        VALUES 
-        ('user1', 'user1@example.com', '+1234567890', 'password1'),
-        ('user2', 'user2@example.com', '+1987654321', 'password2')
-        """)
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-
-# Add a route for the root URL
-@flask_app.route('/')
-def index():
-    return "Welcome to the Omni-Channel Communication App!"
+# Rows per page in the history views
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '50'))
+# Messages loaded when a chat thread is first opened (and per "Load older")
+CHAT_THREAD_SIZE = int(os.getenv('CHAT_THREAD_SIZE', '50'))
+# Minimum seconds between automatic inbox syncs
+MAIL_SYNC_INTERVAL = float(os.getenv('MAIL_SYNC_INTERVAL', '60'))
+# Seconds between the in-memory checks for pushed events (no database access)
+LIVE_REFRESH_INTERVAL = float(os.getenv('LIVE_REFRESH_INTERVAL', '0.5'))
+# Port of this process's /metrics (the webhook server has its own); empty to disable
+METRICS_PORT = os.getenv('METRICS_PORT', '9100')
 
-# Add a route for the favicon
-@flask_app.route('/favicon.ico')
-def favicon():
-    return '', 204
-
-# Function to handle incoming calls
-@flask_app.route("/incoming-call", methods=["POST"])
-def incoming_call():
-    # Get call details from Twilio
-    from_number = request.form.get('From', '')
-    print(f"Incoming call from: {from_number}")
-    
-    # Look up the caller in the database
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username FROM users WHERE phone_number = %s", (from_number,))
-    caller = cur.fetchone()
-    
-    # Find user2 to receive the call
-    cur.execute("SELECT phone_number FROM users WHERE username = 'user2'")
-    receiver = cur.fetchone()
-    receiver_phone = receiver[0] if receiver else None
-    
-    # Record the call in database
-    if caller and receiver_phone:
-        cur.execute("""
-        INSERT INTO calls (caller_id, receiver_phone, start_time, status, direction)
-        VALUES (%s, %s, NOW(), 'ongoing', 'inbound')
-        RETURNING id
-        """, (caller[0], receiver_phone))
-        call_id = cur.fetchone()[0]
-        conn.commit()
-        print(f"Call recorded with ID: {call_id}")
-    
-    cur.close()
-    conn.close()
-    
-    # Create TwiML response to forward the call to user2's phone number
-    response = VoiceResponse()
-    response.say("Hello, this is a call from the Omni-Channel Communication App.")
-    response.dial(receiver_phone)
-    
-    return str(response)
 
 # Functions for handling each communication channel
+@timed(CHANNEL_SECONDS, CHANNEL_ERRORS, channel="send_email")
 def send_email(sender_id, receiver_email, subject, content, attachment=None):
     """
     Send an email to any email address, not just registered users.
@@ -162,78 +60,46 @@ def send_email(sender_id, receiver_email, subject, content, attachment=None):
         content: Body content of the email
         attachment: Optional file attachment
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
+    identities = get_identity_cache()
     
     # Get sender details
-    cur.execute("SELECT email, username FROM users WHERE id = %s", (sender_id,))
-    sender_data = cur.fetchone()
-    sender_email = sender_data[0]
-    sender_username = sender_data[1]
+    sender_email = identities.by_id(sender_id).email
     
     # Check if receiver exists in our system
-    cur.execute("SELECT id FROM users WHERE email = %s", (receiver_email,))
-    receiver_result = cur.fetchone()
-    receiver_id = receiver_result[0] if receiver_result else None
-    
-    # Save attachment if provided
-    attachment_path = None
-    if attachment is not None:
-        # Save attachment to disk
-        file_extension = attachment.name.split('.')[-1]
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        attachment_path = os.path.join("attachments", unique_filename)
-        os.makedirs("attachments", exist_ok=True)
-        
-        with open(attachment_path, "wb") as f:
-            f.write(attachment.getbuffer())
+    receiver = identities.by_email(receiver_email)
+    receiver_id = receiver.id if receiver else None
     
-    # Save message to database
+    # Stream the attachment to the store; identical content is kept only once
+    store = get_attachment_store()
+    blob = store.write(attachment) if attachment is not None else None
+    attachment_path = store.path(blob.sha256) if blob else None
+    
+    # Queue the message; a background worker delivers it over a reused SMTP
+    # session and moves the row to 'sent' or 'failed'
+    conn = get_db_connection()
+    cur = conn.cursor()
     cur.execute("""
-    INSERT INTO messages (sender_id, receiver_id, message_type, content, subject, attachment_path, status)
-    VALUES (%s, %s, 'email', %s, %s, %s, 'sent')
-    """, (sender_id, receiver_id, content, subject, attachment_path))
+    INSERT INTO messages (sender_id, receiver_id, message_type, content, subject, attachment_path,
+                          from_address, to_address, status)
+    VALUES (%s, %s, 'email', %s, %s, %s, %s, %s, 'queued')
+    RETURNING id
+    """, (sender_id, receiver_id, content, subject, attachment_path, sender_email, receiver_email))
+    message_id = cur.fetchone()[0]
+    
+    if blob:
+        store.attach(cur, message_id, blob, attachment.name, attachment.type)
     
     conn.commit()
     cur.close()
     conn.close()
+    get_query_cache().invalidate(sender_id, receiver_id)
     
-    # Send the email using smtplib
-    try:
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        smtp_username = os.getenv('GMAIL_USERNAME')
-        smtp_password = os.getenv('GMAIL_APP_PASSWORD')
-        
-        # Create message
-        msg = MIMEMultipart()
-        msg["From"] = sender_email
-        msg["To"] = receiver_email
-        msg["Subject"] = subject
-        
-        # Attach message body
-        msg.attach(MIMEText(content, "plain"))
-        
-        # Attach file if provided
-        if attachment_path:
-            with open(attachment_path, "rb") as file:
-                part = MIMEApplication(file.read(), Name=os.path.basename(attachment_path))
-                part["Content-Disposition"] = f'attachment; filename="{os.path.basename(attachment_path)}"'
-                msg.attach(part)
-        
-        # Send email
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(msg)
-        
-        st.success(f"Email sent successfully from {sender_email} to {receiver_email}")
-        return True
-        
-    except Exception as e:
-        st.error(f"Error sending email: {str(e)}")
-        return False
+    get_email_outbox().wake()
+    
+    st.success(f"Email from {sender_email} to {receiver_email} queued for delivery")
+    return True
 
+@timed(CHANNEL_SECONDS, CHANNEL_ERRORS, channel="send_sms")
 def send_sms(sender_id, receiver_id, content, attachment=None):
     """
     Send an SMS to any phone number, not just registered users.
@@ -244,318 +110,773 @@ def send_sms(sender_id, receiver_id, content, attachment=None):
         content: Body content of the SMS
         attachment: Optional file attachment (for MMS)
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
+    identities = get_identity_cache()
     
     # Get sender and receiver details
-    cur.execute("SELECT phone_number FROM users WHERE id = %s", (sender_id,))
-    sender_phone = cur.fetchone()[0]
-    
-    cur.execute("SELECT phone_number FROM users WHERE id = %s", (receiver_id,))
-    receiver_phone = cur.fetchone()[0]
-    
-    # Save attachment if provided
-    attachment_path = None
-    if attachment is not None:
-        # Save attachment to disk
-        file_extension = attachment.name.split('.')[-1]
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        attachment_path = os.path.join("attachments", unique_filename)
-        os.makedirs("attachments", exist_ok=True)
-        
-        with open(attachment_path, "wb") as f:
-            f.write(attachment.getbuffer())
+    sender_phone = identities.by_id(sender_id).phone_number
+    receiver_phone = identities.by_id(receiver_id).phone_number
     
-    # Save message to database
+    # Stream the attachment to the store; identical content is kept only once
+    store = get_attachment_store()
+    blob = store.write(attachment) if attachment is not None else None
+    attachment_path = store.path(blob.sha256) if blob else None
+    
+    # Save message to database together with its outbox job; the Twilio
+    # dispatcher sends it in the background and updates the status
+    conn = get_db_connection()
+    cur = conn.cursor()
     cur.execute("""
     INSERT INTO messages (sender_id, receiver_id, message_type, content, attachment_path, status)
-    VALUES (%s, %s, 'sms', %s, %s, 'sent')
+    VALUES (%s, %s, 'sms', %s, %s, 'queued')
+    RETURNING id
     """, (sender_id, receiver_id, content, attachment_path))
+    message_id = cur.fetchone()[0]
+    
+    if blob:
+        store.attach(cur, message_id, blob, attachment.name, attachment.type)
+    
+    enqueue(cur, 'sms', {'from': twilio_number, 'to': receiver_phone, 'body': content}, message_id=message_id)
     
     conn.commit()
     cur.close()
     conn.close()
+    get_query_cache().invalidate(sender_id, receiver_id)
     
-    # Send the SMS using Twilio
-    try:
-        account_sid = 'AC286c1c9bc019897af671fe9c3a558ccd'  # Replace with your Twilio Account SID
-        auth_token = 'a2be9cec0c8b7d75ca4a73676eb23ad5'  # Replace with your Twilio Auth Token
-        client = Client(account_sid, auth_token)
-        
-        message = client.messages.create(
-            from_='+18508134976',  # Replace with your Twilio phone number
-            body=content,
-            to='+18777804236'
-        )
-        
-        st.success(f"SMS sent successfully from {sender_phone} to {receiver_phone}")
-        return True
-        
-    except Exception as e:
-        st.error(f"Error sending SMS: {str(e)}")
-        return False
+    # Build the thumbnail now, so the first view of the message already has it
+    if blob:
+        get_preview_cache().submit(blob.sha256, attachment.type, attachment_path)
+    
+    get_dispatcher().wake()
+    
+    st.success(f"SMS from {sender_phone} to {receiver_phone} queued for delivery")
+    return True
 
+@timed(CHANNEL_SECONDS, CHANNEL_ERRORS, channel="send_chat")
 def send_chat(sender_id, receiver_id, content, attachment=None):
     conn = get_db_connection()
     cur = conn.cursor()
     
-    # Save attachment if provided
-    attachment_path = None
-    if attachment is not None:
-        # Save attachment to disk
-        file_extension = attachment.name.split('.')[-1]
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        attachment_path = os.path.join("attachments", unique_filename)
-        os.makedirs("attachments", exist_ok=True)
-        
-        with open(attachment_path, "wb") as f:
-            f.write(attachment.getbuffer())
-        
-        # Debugging: Print the attachment path
-        print(f"Attachment saved at: {attachment_path}")
+    # Stream the attachment to the store; identical content is kept only once
+    store = get_attachment_store()
+    blob = store.write(attachment) if attachment is not None else None
+    attachment_path = store.path(blob.sha256) if blob else None
     
-    # Debugging: Print the values to be inserted into the database
-    print(f"Inserting into database: sender_id={sender_id}, receiver_id={receiver_id}, content={content}, attachment_path={attachment_path}")
+    # Ids and sizes only: message text is not logged
+    logger.debug("Sending chat message: sender_id=%s, receiver_id=%s, %d chars, attachment_path=%s",
+                 sender_id, receiver_id, len(content or ""), attachment_path)
     
     # Save message to database
     cur.execute("""
     INSERT INTO messages (sender_id, receiver_id, message_type, content, attachment_path, status)
     VALUES (%s, %s, 'chat', %s, %s, 'sent')
+    RETURNING id
     """, (sender_id, receiver_id, content, attachment_path))
+    message_id = cur.fetchone()[0]
+    
+    if blob:
+        store.attach(cur, message_id, blob, attachment.name, attachment.type)
     
     conn.commit()
     cur.close()
     conn.close()
+    get_query_cache().invalidate(sender_id, receiver_id)
+    
+    # Build the thumbnail now, so the first view of the message already has it
+    if blob:
+        get_preview_cache().submit(blob.sha256, attachment.type, attachment_path)
     
     st.success("Chat message sent")
     return True
 
+@timed(CHANNEL_SECONDS, CHANNEL_ERRORS, channel="make_call")
 def make_call(caller_id, receiver_phone, direction):
+    identities = get_identity_cache()
+    
+    # Get caller details
+    caller_phone = identities.by_id(caller_id).phone_number
+    receiver = identities.by_phone(receiver_phone)
+    
+    # Record the call and queue it; the Twilio dispatcher places it and fills
+    # in call_sid once Twilio accepts it
     conn = get_db_connection()
     cur = conn.cursor()
+    cur.execute("""
+    INSERT INTO calls (caller_id, receiver_id, receiver_phone, start_time, status, direction)
+    VALUES (%s, %s, %s, %s, 'queued', %s)
+    RETURNING id
+    """, (caller_id, receiver.id if receiver else None, receiver_phone, datetime.now(), direction))
+    call_id = cur.fetchone()[0]
     
-    # Get caller details
-    cur.execute("SELECT phone_number FROM users WHERE id = %s", (caller_id,))
-    caller_phone = cur.fetchone()[0]
+    enqueue(cur, 'call', {'from': twilio_number, 'to': receiver_phone, 'url': voice_url}, call_id=call_id)
     
-    # Make the call using Twilio
-    try:
-        account_sid = 'AC286c1c9bc019897af671fe9c3a558ccd'  # Replace with your Twilio Account SID
-        auth_token = 'a2be9cec0c8b7d75ca4a73676eb23ad5'  # Replace with your Twilio Auth Token
-        client = Client(account_sid, auth_token)
-        
-        call = client.calls.create(
-            url='https://4824-64-224-134-197.ngrok-free.app/incoming-call',  # Replace with your ngrok URL
-            to=receiver_phone,
-            from_='+18508134976'  # Replace with your Twilio phone number
-        )
-        
-        call_sid = call.sid
-        
-        # Record call in database
-        cur.execute("""
-        INSERT INTO calls (caller_id, receiver_phone, start_time, status, direction, call_sid)
-        VALUES (%s, %s, %s, 'ongoing', %s, %s)
-        RETURNING id
-        """, (caller_id, receiver_phone, datetime.now(), direction, call_sid))
-        
-        call_id = cur.fetchone()[0]
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        st.success(f"Call initiated from {caller_phone} to {receiver_phone}")
-        return call_id
-        
-    except Exception as e:
-        st.error(f"Error making call: {str(e)}")
-        return None
+    conn.commit()
+    cur.close()
+    conn.close()
+    get_query_cache().invalidate(caller_id, receiver.id if receiver else None)
+    
+    get_dispatcher().wake()
+    
+    st.success(f"Call from {caller_phone} to {receiver_phone} queued")
+    return call_id
 
+@timed(CHANNEL_SECONDS, CHANNEL_ERRORS, channel="end_call")
 def end_call(call_id):
     conn = get_db_connection()
     cur = conn.cursor()
     
-    # Get the call SID from the database
-    cur.execute("SELECT call_sid FROM calls WHERE id = %s", (call_id,))
-    call_sid = cur.fetchone()[0]
+    # Hanging up goes through the same outbox, after any pending dial
+    enqueue(cur, 'end_call', {}, call_id=call_id)
+    cur.execute("SELECT caller_id, receiver_id FROM calls WHERE id = %s", (call_id,))
+    participants = cur.fetchone() or ()
     
-    # End the call using Twilio
-    try:
-        account_sid = 'AC286c1c9bc019897af671fe9c3a558ccd'  # Replace with your Twilio Account SID
-        auth_token = 'a2be9cec0c8b7d75ca4a73676eb23ad5'  # Replace with your Twilio Auth Token
-        client = Client(account_sid, auth_token)
-        
-        call = client.calls(call_sid).update(status='completed')
-        
-        # Update call record in database
-        cur.execute("""
-        UPDATE calls SET end_time = %s, status = 'completed'
-        WHERE id = %s
-        """, (datetime.now(), call_id))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        st.success("Call ended")
-        return True
-        
-    except Exception as e:
-        st.error(f"Error ending call: {str(e)}")
-        return False
+    conn.commit()
+    cur.close()
+    conn.close()
+    # The call's status changes when the dispatcher hangs up, which the
+    # trigger reports; this covers anything shown about the request itself
+    get_query_cache().invalidate(*participants)
+    
+    get_dispatcher().wake()
+    
+    st.success("Ending call")
+    return True
 
-def get_messages(user_id, message_type=None):
-    conn = get_db_connection()
-    cur = conn.cursor()
+# Rows of the history views. Lists carry only a preview of each body, so a
+# page of long emails stays small; the full body and its attachments are
+# loaded by get_message_body once the user opens the message.
+MessageSummary = namedtuple("MessageSummary", ["id", "sender", "receiver", "message_type", "subject", "preview",
+                                               "body_size", "has_attachment", "status", "created_at"])
+CallSummary = namedtuple("CallSummary", ["id", "caller", "receiver_phone", "start_time", "answered_at", "end_time",
+                                         "duration", "status", "direction", "created_at"])
+TimelineItem = namedtuple("TimelineItem", ["kind", "id", "item_type", "sender", "receiver", "preview", "body_size",
+                                           "has_attachment", "shown_at", "created_at"])
+MessageBody = namedtuple("MessageBody", ["id", "content", "attachment_path", "attachment_names", "attachments"])
+ChatMessage = namedtuple("ChatMessage", ["id", "sender", "receiver", "content", "attachment_path", "status",
+                                         "created_at"])
+
+# Characters of the body shown in lists. substr() reads just the first
+# slice of a TOASTed body, where left() would decompress all of it, and
+# octet_length() comes from the TOAST header without reading the body.
+PREVIEW_CHARS = 160
+_PREVIEW = f"COALESCE(preview, substr(content, 1, {PREVIEW_CHARS}))"
+_BODY_SIZE = "COALESCE(octet_length(content), 0)"
+
+def get_messages(user_id, message_type=None, before=None, limit=PAGE_SIZE, peer_id=None):
+    """
+    One page of a user's messages, newest first, as MessageSummary records.
     
+    Args:
+        user_id: ID of the user whose sent and received messages are listed
+        message_type: Optional 'email', 'sms' or 'chat' filter
+        before: Keyset cursor (created_at, id) of the last row already shown;
+            only older rows are returned
+        limit: Maximum number of rows to return
+        peer_id: Optional ID of the other participant
+    """
+    # Each side of "sender OR receiver" is its own ordered index scan, so
+    # Postgres can stop after `limit` rows instead of sorting the whole history.
+    filters = ""
+    params = {"user_id": user_id, "limit": limit}
     if message_type:
-        cur.execute("""
-        SELECT m.id, sender.username, receiver.username, m.message_type, m.content, m.attachment_path, m.status, m.created_at
-        FROM messages m
-        JOIN users sender ON m.sender_id = sender.id
-        JOIN users receiver ON m.receiver_id = receiver.id
-        WHERE (m.sender_id = %s OR m.receiver_id = %s) AND m.message_type = %s
-        ORDER BY m.created_at DESC
-        """, (user_id, user_id, message_type))
-    else:
-        cur.execute("""
-        SELECT m.id, sender.username, receiver.username, m.message_type, m.content, m.attachment_path, m.status, m.created_at
-        FROM messages m
-        JOIN users sender ON m.sender_id = sender.id
-        JOIN users receiver ON m.receiver_id = receiver.id
-        WHERE m.sender_id = %s OR m.receiver_id = %s
-        ORDER BY m.created_at DESC
-        """, (user_id, user_id))
+        filters += " AND message_type = %(message_type)s"
+        params["message_type"] = message_type
+    if before:
+        filters += " AND (created_at, id) < (%(before_time)s, %(before_id)s)"
+        params["before_time"], params["before_id"] = before
+    
+    sent_filter = received_filter = filters
+    if peer_id is not None:
+        sent_filter += " AND receiver_id = %(peer_id)s"
+        received_filter += " AND sender_id = %(peer_id)s"
+        params["peer_id"] = peer_id
     
-    messages = cur.fetchall()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    # Outer joins, as the page is already cut: SMS from unknown numbers and
+    # emails to outside addresses have no user on one side and show the
+    # address instead
+    cur.execute("""
+    SELECT m.id, COALESCE(sender.username, m.from_address), COALESCE(receiver.username, m.to_address),
+           m.message_type, m.subject, m.preview, m.body_size, m.has_attachment, m.status, m.created_at
+    FROM (
+        (SELECT id, sender_id, receiver_id, from_address, to_address, message_type, subject,
+                """ + _PREVIEW + """ AS preview, """ + _BODY_SIZE + """ AS body_size,
+                attachment_path IS NOT NULL AS has_attachment, status, created_at
+         FROM messages
+         WHERE sender_id = %(user_id)s""" + sent_filter + """
+         ORDER BY created_at DESC, id DESC
+         LIMIT %(limit)s)
+        UNION ALL
+        (SELECT id, sender_id, receiver_id, from_address, to_address, message_type, subject,
+                """ + _PREVIEW + """, """ + _BODY_SIZE + """, attachment_path IS NOT NULL, status, created_at
+         FROM messages
+         WHERE receiver_id = %(user_id)s AND sender_id IS DISTINCT FROM %(user_id)s""" + received_filter + """
+         ORDER BY created_at DESC, id DESC
+         LIMIT %(limit)s)
+    ) m
+    LEFT JOIN users sender ON m.sender_id = sender.id
+    LEFT JOIN users receiver ON m.receiver_id = receiver.id
+    ORDER BY m.created_at DESC, m.id DESC
+    LIMIT %(limit)s
+    """, params)
+    
+    messages = [MessageSummary(*row) for row in cur.fetchall()]
     cur.close()
     conn.close()
     
     return messages
 
-def get_calls(user_id, direction=None):
+def get_message_body(user_id, message_id):
+    """
+    The full body and attachments of one message as a MessageBody, or None
+    unless `user_id` sent or received it (synced inbox emails are shared).
+    """
     conn = get_db_connection()
     cur = conn.cursor()
+    cur.execute("""
+    SELECT id, content, attachment_path, attachment_names
+    FROM messages
+    WHERE id = %(message_id)s
+    AND (sender_id = %(user_id)s OR receiver_id = %(user_id)s OR imap_mailbox IS NOT NULL)
+    """, {"message_id": message_id, "user_id": user_id})
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
     
+    if row is None:
+        return None
+    _, content, attachment_path, attachment_names = row
+    attachments = []
+    if attachment_path or attachment_names:
+        attachments = get_attachment_store().attachments_for([message_id]).get(message_id, [])
+    return MessageBody(message_id, content, attachment_path, attachment_names, attachments)
+
+def get_calls(user_id, direction=None, before=None, limit=PAGE_SIZE):
+    """
+    One page of the calls a user placed, newest first, as CallSummary records.
+    
+    The last record's (created_at, id) is the cursor passed back in `before`.
+    """
+    filters = ""
+    params = {"user_id": user_id, "limit": limit}
     if direction:
-        cur.execute("""
-        SELECT c.id, caller.username, c.receiver_phone, c.start_time, c.end_time, c.status, c.direction
-        FROM calls c
-        JOIN users caller ON c.caller_id = caller.id
-        WHERE c.caller_id = %s AND c.direction = %s
-        ORDER BY c.created_at DESC
-        """, (user_id, direction))
-    else:
-        cur.execute("""
-        SELECT c.id, caller.username, c.receiver_phone, c.start_time, c.end_time, c.status, c.direction
-        FROM calls c
-        JOIN users caller ON c.caller_id = caller.id
-        WHERE c.caller_id = %s
-        ORDER BY c.created_at DESC
-        """, (user_id,))
+        filters += " AND c.direction = %(direction)s"
+        params["direction"] = direction
+    if before:
+        filters += " AND (c.created_at, c.id) < (%(before_time)s, %(before_id)s)"
+        params["before_time"], params["before_id"] = before
     
-    calls = cur.fetchall()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    cur.execute("""
+    SELECT c.id, caller.username, c.receiver_phone, c.start_time, c.answered_at, c.end_time, c.duration,
+           c.status, c.direction, c.created_at
+    FROM calls c
+    JOIN users caller ON c.caller_id = caller.id
+    WHERE c.caller_id = %(user_id)s""" + filters + """
+    ORDER BY c.created_at DESC, c.id DESC
+    LIMIT %(limit)s
+    """, params)
+    
+    calls = [CallSummary(*row) for row in cur.fetchall()]
     cur.close()
     conn.close()
     
     return calls
 
-def get_users():
+# Timeline rows sort by (created_at, kind, id); calls come before messages
+# created in the same instant.
+TIMELINE_MESSAGE = 0
+TIMELINE_CALL = 1
+
+def get_timeline(user_id, before=None, limit=PAGE_SIZE):
+    """
+    One page of a user's messages and calls merged newest first in SQL, as
+    TimelineItem records; a call's preview is its status and direction.
+    `before` is the (created_at, kind, id) cursor of the last row already
+    shown, see timeline_cursor().
+    """
+    params = {"user_id": user_id, "limit": limit}
+    message_filter = call_filter = ""
+    if before:
+        before_time, before_kind, before_id = before
+        params.update(before_time=before_time, before_id=before_id)
+        # Per-source keyset condition equivalent to
+        # (created_at, kind, id) < cursor, but still usable by each index.
+        message_filter = _timeline_before(TIMELINE_MESSAGE, before_kind)
+        call_filter = _timeline_before(TIMELINE_CALL, before_kind, "c.")
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    cur.execute("""
+    SELECT t.kind, t.id, t.item_type, COALESCE(sender.username, t.from_address),
+           COALESCE(receiver.username, t.to_address, t.receiver_phone),
+           t.preview, t.body_size, t.has_attachment, t.shown_at, t.created_at
+    FROM (
+        (SELECT 0 AS kind, id, message_type AS item_type, sender_id, from_address, receiver_id, to_address,
+                NULL AS receiver_phone,
+                """ + _PREVIEW + """ AS preview, """ + _BODY_SIZE + """ AS body_size,
+                attachment_path IS NOT NULL AS has_attachment, created_at AS shown_at, created_at
+         FROM messages
+         WHERE sender_id = %(user_id)s""" + message_filter + """
+         ORDER BY created_at DESC, id DESC
+         LIMIT %(limit)s)
+        UNION ALL
+        (SELECT 0, id, message_type, sender_id, from_address, receiver_id, to_address, NULL,
+                """ + _PREVIEW + """, """ + _BODY_SIZE + """,
+                attachment_path IS NOT NULL, created_at, created_at
+         FROM messages
+         WHERE receiver_id = %(user_id)s AND sender_id IS DISTINCT FROM %(user_id)s""" + message_filter + """
+         ORDER BY created_at DESC, id DESC
+         LIMIT %(limit)s)
+        UNION ALL
+        (SELECT 1, c.id, 'call', c.caller_id, NULL, NULL, NULL, c.receiver_phone,
+                concat('Status: ', c.status, ', Direction: ', c.direction), 0, FALSE, c.start_time, c.created_at
+         FROM calls c
+         WHERE c.caller_id = %(user_id)s""" + call_filter + """
+         ORDER BY c.created_at DESC, c.id DESC
+         LIMIT %(limit)s)
+    ) t
+    -- Outer joins, as the page is already cut: SMS from unknown numbers and
+    -- emails, SMS and broadcasts to outside addresses show the address
+    LEFT JOIN users sender ON t.sender_id = sender.id
+    LEFT JOIN users receiver ON t.receiver_id = receiver.id
+    ORDER BY t.created_at DESC, t.kind DESC, t.id DESC
+    LIMIT %(limit)s
+    """, params)
+    
+    timeline = [TimelineItem(*row) for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+    
+    return timeline
+
+def _timeline_before(kind, before_kind, prefix=""):
+    if kind < before_kind:
+        return f" AND {prefix}created_at <= %(before_time)s"
+    if kind == before_kind:
+        return f" AND ({prefix}created_at, {prefix}id) < (%(before_time)s, %(before_id)s)"
+    return f" AND {prefix}created_at < %(before_time)s"
+
+def timeline_cursor(item):
+    return (item.created_at, item.kind, item.id)
+
+def history_cursor(record):
+    """(created_at, id) cursor of a MessageSummary or CallSummary."""
+    return (record.created_at, record.id)
+
+def has_more_body(record):
+    """Whether opening a listed message shows more than its preview."""
+    return record.has_attachment or record.body_size > len((record.preview or "").encode("utf-8"))
+
+def get_conversations(user_id, channel=None, before=None, limit=PAGE_SIZE):
+    """
+    One page of a user's conversations, most recent activity first.
+    
+    Reads the summaries kept by the triggers from migration 15, so the cost
+    depends on the page size, not on how many messages and calls the user has.
+    Rows are (id, channel, peer, peer_id, last_subject, last_preview,
+    last_status, last_outbound, unread, total, last_at); see
+    conversation_cursor() for the `before` cursor.
+    
+    Args:
+        user_id: ID of the user whose inbox is listed
+        channel: Optional 'email', 'sms', 'chat' or 'call' filter
+        before: Keyset cursor (last_at, id) of the last row already shown
+        limit: Maximum number of rows to return
+    """
+    filters = ""
+    params = {"user_id": user_id, "limit": limit}
+    if channel:
+        filters += " AND c.channel = %(channel)s"
+        params["channel"] = channel
+    if before:
+        filters += " AND (c.last_at, c.id) < (%(before_time)s, %(before_id)s)"
+        params["before_time"], params["before_id"] = before
+    
     conn = get_db_connection()
     cur = conn.cursor()
+    cur.execute("""
+    SELECT c.id, c.channel, COALESCE(peer.username, c.peer_address), c.peer_id, c.last_subject, c.last_preview,
+           c.last_status, c.last_outbound, c.unread, c.total, c.last_at
+    FROM conversations c
+    LEFT JOIN users peer ON peer.id = c.peer_id
+    WHERE c.user_id = %(user_id)s""" + filters + """
+    ORDER BY c.last_at DESC, c.id DESC
+    LIMIT %(limit)s
+    """, params)
+    conversations = cur.fetchall()
+    cur.close()
+    conn.close()
+    return conversations
+
+def conversation_cursor(row):
+    return (row[10], row[0])
+
+def mark_conversation_read(user_id, conversation_id):
+    """Reset the unread count of one of the user's conversations."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    UPDATE conversations SET unread = 0
+    WHERE id = %s AND user_id = %s AND unread > 0
+    """, (conversation_id, user_id))
+    conn.commit()
+    cur.close()
+    conn.close()
+    get_query_cache().invalidate(user_id)
+
+# Marks around matched words in search snippets (rendered as bold markdown)
+SNIPPET_OPTIONS = "StartSel=**, StopSel=**, MaxWords=25, MinWords=10, MaxFragments=2, FragmentDelimiter=\" ... \""
+
+def search_messages(user_id, query, message_type=None, before=None, limit=PAGE_SIZE):
+    """
+    One page of a user's emails, SMS and chat messages matching `query`,
+    best match first.
+    
+    `query` uses web search syntax ("quoted phrases", -excluded, or). Rows
+    are (id, sender, receiver, type, subject, snippet, created_at, rank);
+    subjects weigh more than bodies. The snippet highlights matched words
+    and is only built for the rows returned.
+    
+    Args:
+        user_id: ID of the user whose sent and received messages are searched
+        query: Search text
+        message_type: Optional 'email', 'sms' or 'chat' filter
+        before: Keyset cursor (rank, id) of the last row already shown, see
+            search_cursor()
+        limit: Maximum number of rows to return
+    """
+    filters = ""
+    params = {"user_id": user_id, "query": query, "limit": limit, "options": SNIPPET_OPTIONS}
+    if message_type:
+        filters += " AND message_type = %(message_type)s"
+        params["message_type"] = message_type
+    page_filter = ""
+    if before:
+        page_filter = " WHERE (rank, id) < (%(before_rank)s::real, %(before_id)s)"
+        params["before_rank"], params["before_id"] = before
     
-    cur.execute("SELECT id, username FROM users")
-    users = cur.fetchall()
+    conn = get_db_connection()
+    cur = conn.cursor()
     
+    # messages_search_idx finds the matches, the sender/receiver indexes
+    # narrow them to this user; only matches are ranked.
+    cur.execute("""
+    SELECT m.id, COALESCE(sender.username, m.from_address), COALESCE(receiver.username, m.to_address),
+           m.message_type, m.subject, ts_headline('english', COALESCE(m.content, ''), m.q, %(options)s),
+           m.created_at, m.rank
+    FROM (
+        SELECT * FROM (
+            SELECT id, sender_id, receiver_id, message_type, subject, content, from_address, to_address,
+                   created_at, q, ts_rank(search_vector, q) AS rank
+            FROM messages, websearch_to_tsquery('english', %(query)s) q
+            WHERE search_vector @@ q
+            AND (sender_id = %(user_id)s OR receiver_id = %(user_id)s)
+            AND message_type IN ('email', 'sms', 'chat')""" + filters + """
+        ) ranked""" + page_filter + """
+        ORDER BY rank DESC, id DESC
+        LIMIT %(limit)s
+    ) m
+    LEFT JOIN users sender ON m.sender_id = sender.id
+    LEFT JOIN users receiver ON m.receiver_id = receiver.id
+    ORDER BY m.rank DESC, m.id DESC
+    """, params)
+    
+    results = cur.fetchall()
     cur.close()
     conn.close()
     
-    return users
+    return results
+
+def search_cursor(row):
+    return (row[7], row[0])
 
-# Function to fetch emails from an external email account
-def fetch_emails(limit=5):
-    email_user = os.getenv('GMAIL_USERNAME')
-    email_password = os.getenv('GMAIL_APP_PASSWORD')
-    imap_server = "imap.gmail.com"
-    imap_port = 993
+def split_page(rows, page_size, cursor_of=history_cursor):
+    """
+    Split a result fetched with limit=page_size + 1 into the rows to show and
+    the cursor for the next page, or None on the last page.
     
-    # Connect to the server
-    mail = imaplib.IMAP4_SSL(imap_server, imap_port)
+    The default cursor is (created_at, id), matching get_messages, get_calls
+    and get_inbox_emails.
+    """
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, cursor_of(rows[-1])
+
+def pager(key):
+    """Cursor stack for a paginated view; the last entry is the current page's cursor."""
+    if key not in st.session_state:
+        st.session_state[key] = [None]
+    return st.session_state[key]
+
+def pager_controls(key, next_cursor):
+    """Render "Newer" / "Load older" buttons for the view paginated under `key`."""
+    cursors = pager(key)
+    col1, col2 = st.columns(2)
+    with col1:
+        if len(cursors) > 1 and st.button("Newer", key=f"{key}_newer"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        if next_cursor is not None and st.button("Load older", key=f"{key}_older"):
+            cursors.append(next_cursor)
+            st.rerun()
+
+def show_attachment(attachment, user_id):
+    """
+    Render a stored attachment as its thumbnail (when one has been built)
+    plus a link to the original, which is only downloaded when clicked.
+    """
+    original_url = attachment_url(attachment.id, user_id)
+    status = get_preview_cache().status(attachment.sha256, attachment.content_type, attachment.path)
+    if status == "ready":
+        st.image(attachment_url(attachment.id, user_id, preview=True), caption=attachment.filename)
+    elif status == "pending":
+        st.caption(f"Preparing preview of {attachment.filename}…")
+    st.markdown(f"[Open {attachment.filename}]({original_url})")
+
+def adopt_legacy_attachments(user_id, message_id, filenames):
+    """
+    Move the files of an email synced before the attachment store, kept by
+    name under attachments/, into the store, so the browser downloads them
+    from the webhook server like any other attachment. Returns the names no
+    longer on disk.
+    """
+    store = get_attachment_store()
+    missing = []
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # Another session may be adopting the same files
+    cur.execute("SELECT id FROM messages WHERE id = %s FOR UPDATE", (message_id,))
+    cur.execute("SELECT 1 FROM message_attachments WHERE message_id = %s LIMIT 1", (message_id,))
+    if cur.fetchone() is None:
+        for filename in filenames:
+            filename = os.path.basename(filename)
+            path = os.path.join("attachments", filename)
+            if not os.path.isfile(path):
+                missing.append(filename)
+                continue
+            with open(path, "rb") as f:
+                store.attach(cur, message_id, store.write(f), filename)
+    conn.commit()
+    cur.close()
+    conn.close()
     
-    # Login to the account
-    mail.login(email_user, email_password)
+    get_query_cache().invalidate(user_id)
+    return missing
+
+def show_message_body(user_id, record, topic):
+    """
+    Render a listed message (a MessageSummary or TimelineItem): its preview,
+    and once the user opens it, the full body and attachments, fetched then
+    and kept open for the rest of the session.
+    """
+    opened = st.session_state.setdefault("opened_messages", set())
+    if record.id not in opened:
+        st.write(record.preview)
+        if not has_more_body(record) or not st.button("Show message", key=f"open_message_{record.id}"):
+            return
+        opened.add(record.id)
+        st.rerun()
+    
+    body = get_query_cache().fetch(user_id, topic, get_message_body, user_id, record.id)
+    if body is None:
+        st.warning("This message is no longer available")
+        return
+    st.write(body.content)
+    for stored_attachment in body.attachments:
+        show_attachment(stored_attachment, user_id)
+    if body.attachment_path and not body.attachments:  # Saved before the blob store
+        st.write("Has attachment")
+
+def get_chat_thread(user_id, peer_id, after_id=None, before_id=None, limit=CHAT_THREAD_SIZE):
+    """
+    Chat messages between two users, oldest first, as ChatMessage records
+    (a chat shows every body in full, so there is no preview).
     
-    # Select the mailbox you want to check
-    mail.select("inbox")
+    Args:
+        user_id: ID of the logged-in user
+        peer_id: ID of the other participant
+        after_id: Only return messages newer than this id (the delta since the
+            last message already shown); the limit does not apply
+        before_id: Only return the `limit` messages just before this id
+        limit: How many of the most recent messages to return otherwise
+    """
+    filters = ""
+    params = {"low": min(user_id, peer_id), "high": max(user_id, peer_id), "limit": limit}
+    if after_id is not None:
+        filters += " AND m.id > %(after_id)s"
+        params["after_id"] = after_id
+        params["limit"] = None  # LIMIT NULL means no limit
+    if before_id is not None:
+        filters += " AND m.id < %(before_id)s"
+        params["before_id"] = before_id
     
-    # Search for all emails in the inbox
-    status, messages = mail.search(None, "ALL")
+    conn = get_db_connection()
+    cur = conn.cursor()
     
-    # Convert messages to a list of email IDs
-    email_ids = messages[0].split()
+    # Matches messages_chat_pair_idx: both directions of the conversation live
+    # under the same (low, high) key, ordered by id.
+    cur.execute("""
+    SELECT * FROM (
+        SELECT m.id, sender.username, receiver.username, m.content, m.attachment_path, m.status, m.created_at
+        FROM messages m
+        JOIN users sender ON m.sender_id = sender.id
+        JOIN users receiver ON m.receiver_id = receiver.id
+        WHERE m.message_type = 'chat'
+        AND LEAST(m.sender_id, m.receiver_id) = %(low)s
+        AND GREATEST(m.sender_id, m.receiver_id) = %(high)s""" + filters + """
+        ORDER BY m.id DESC
+        LIMIT %(limit)s
+    ) thread
+    ORDER BY id
+    """, params)
+    
+    messages = [ChatMessage(*row) for row in cur.fetchall()]
+    cur.close()
+    conn.close()
     
-    # Limit the number of emails fetched to the latest 'limit' emails
-    email_ids = email_ids[-limit:]
+    return messages
+
+def load_chat_thread(user_id, peer_id, version=None):
+    """
+    The chat thread with `peer_id` kept in session state.
     
-    emails = []
+    The first load fetches the last CHAT_THREAD_SIZE messages; later reruns
+    only fetch messages with an id above the newest one already held, and
+    skip the query entirely while the conversation's event `version` (from
+    the EventHub) is unchanged. With version None every rerun fetches.
+    """
+    key = f"chat_thread_{user_id}_{peer_id}"
+    thread = st.session_state.get(key)
+    
+    if thread is None:
+        messages = get_chat_thread(user_id, peer_id)
+        thread = {"messages": [], "has_older": len(messages) == CHAT_THREAD_SIZE, "attachments": {}}
+        st.session_state[key] = thread
+    elif version is not None and thread["version"] == version:
+        return thread
+    elif thread["messages"]:
+        messages = get_chat_thread(user_id, peer_id, after_id=thread["messages"][-1].id)
+    else:
+        messages = get_chat_thread(user_id, peer_id)
     
-    for email_id in email_ids:
-        # Fetch the email by ID
-        status, msg_data = mail.fetch(email_id, "(RFC822)")
+    thread["messages"].extend(messages)
+    thread["attachments"].update(
+        get_attachment_store().attachments_for([msg.id for msg in messages if msg.attachment_path])
+    )
+    thread["version"] = version
+    return thread
+
+def load_older_chat(thread, user_id, peer_id):
+    """Prepend the CHAT_THREAD_SIZE messages preceding the oldest one in `thread`."""
+    older = get_chat_thread(user_id, peer_id, before_id=thread["messages"][0].id)
+    thread["messages"][:0] = older
+    thread["has_older"] = len(older) == CHAT_THREAD_SIZE
+    thread["attachments"].update(get_attachment_store().attachments_for([msg.id for msg in older if msg.attachment_path]))
+
+def show_chat_thread(user_id, username, peer_id):
+    """
+    Render the chat history with `peer_id`. Run as a fragment that reruns on
+    its own every LIVE_REFRESH_INTERVAL seconds while events are being
+    pushed; between messages a rerun touches neither the database nor the
+    rest of the page.
+    """
+    thread = load_chat_thread(user_id, peer_id, get_event_hub().version(user_id, f"chat:{peer_id}"))
+    
+    if thread["has_older"] and st.button("Load older"):
+        load_older_chat(thread, user_id, peer_id)
+    
+    for msg in thread["messages"]:
+        if msg.sender == username:
+            st.write(f"You: {msg.content}")
+        else:
+            st.write(f"{msg.sender}: {msg.content}")
         
-        for response_part in msg_data:
-            if isinstance(response_part, tuple):
-                # Parse the email content
-                msg = email.message_from_bytes(response_part[1])
-                
-                # Decode the email subject
-                subject, encoding = decode_header(msg["Subject"])[0]
-                if isinstance(subject, bytes):
-                    subject = subject.decode(encoding if encoding else "utf-8")
-                
-                # Decode the email sender
-                from_ = msg.get("From")
-                
-                # Get the email body and attachments
-                body = ""
-                attachments = []
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        content_type = part.get_content_type()
-                        content_disposition = str(part.get("Content-Disposition"))
-                        
-                        if "attachment" in content_disposition:
-                            # Extract attachment
-                            filename = part.get_filename()
-                            if filename:
-                                attachments.append(filename)
-                                filepath = os.path.join("attachments", filename)
-                                os.makedirs("attachments", exist_ok=True)
-                                with open(filepath, "wb") as f:
-                                    f.write(part.get_payload(decode=True))
-                        elif content_type == "text/plain" and "attachment" not in content_disposition:
-                            # Extract plain text email body
-                            body = part.get_payload(decode=True).decode()
-                        elif content_type == "text/html" and "attachment" not in content_disposition:
-                            # Extract HTML email body
-                            body = part.get_payload(decode=True).decode()
-                else:
-                    body = msg.get_payload(decode=True).decode()
-                
-                emails.append({
-                    "from": from_,
-                    "subject": subject,
-                    "body": body,
-                    "is_html": content_type == "text/html",
-                    "attachments": attachments
-                })
+        if msg.attachment_path:
+            attachment_path = msg.attachment_path
+            stored_attachment = thread["attachments"].get(msg.id, [None])[0]
+            if stored_attachment:
+                # Thumbnail and link, both served by the Flask route
+                show_attachment(stored_attachment, user_id)
+            elif attachment_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
+                st.image(attachment_path, caption="Attachment", use_container_width=True)
+            else:
+                st.markdown(f"[Download Attachment]({attachment_path})")
+
+def live_fragment(func):
+    """`func` as a fragment rerunning every LIVE_REFRESH_INTERVAL seconds, or only on interaction when nothing is pushed."""
+    return st.fragment(func, run_every=LIVE_REFRESH_INTERVAL if get_event_hub().listening else None)
+
+def live_refresh(user_id, topics):
+    """
+    Rerun the page as soon as an event for one of `topics` is pushed.
     
-    # Close the connection and logout
-    mail.close()
-    mail.logout()
+    Call it before the page queries anything: the versions are captured now
+    and the fragment only compares them with the in-memory EventHub, so an
+    idle page costs the database nothing. Without a listener it does nothing
+    and the page updates on the next interaction, as before.
+    """
+    hub = get_event_hub()
+    seen = {topic: hub.version(user_id, topic) for topic in topics}
+    if None in seen.values():
+        return
+    
+    @st.fragment(run_every=LIVE_REFRESH_INTERVAL)
+    def watch_events():
+        if any(hub.version(user_id, topic) != version for topic, version in seen.items()):
+            st.rerun()
+    
+    watch_events()
+
+def read_recipients(pasted, uploaded):
+    """Recipients typed one per line plus those in an uploaded file (first CSV column)."""
+    recipients = [line for line in pasted.splitlines() if line.strip()]
+    if uploaded is not None:
+        rows = csv.reader(io.TextIOWrapper(uploaded, encoding="utf-8", errors="replace"))
+        recipients.extend(row[0] for row in rows if row)
+    return recipients
+
+def show_broadcast_progress(broadcast_id):
+    """Per-status counts of a broadcast; run as a fragment that refreshes until nothing is pending."""
+    progress = broadcast_progress(broadcast_id)
+    if progress is None:
+        return
+    statuses = progress["statuses"]
+    finished = progress["total"] - progress["pending"]
+    st.progress(finished / progress["total"] if progress["total"] else 1.0,
+                text=f"{finished} of {progress['total']} processed")
+    st.caption(", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())) +
+               f" · {progress['rejected']} invalid and {progress['duplicates']} duplicate recipients skipped")
+    if progress["done"] and st.session_state.get("broadcast_done") != broadcast_id:
+        # Stop the refresh timer
+        st.session_state.broadcast_done = broadcast_id
+        st.rerun()
+
+def get_users():
+    # Served from the identity cache, so reruns don't query the users table
+    return get_identity_cache().all_users()
+
+# Function to pull new emails from the external email account into the database
+def sync_inbox(force=False):
+    """
+    Incrementally sync the IMAP inbox, at most once every MAIL_SYNC_INTERVAL
+    seconds unless `force` is set. Returns the number of new emails.
+    """
+    mail_sync = get_mail_sync()
+    if not force and time.time() - mail_sync.last_sync < MAIL_SYNC_INTERVAL:
+        return 0
     
-    return emails
+    try:
+        return mail_sync.sync()
+    except Exception as e:
+        st.error(f"Error syncing inbox: {str(e)}")
+        return 0
 
 def get_incoming_calls():
     conn = get_db_connection()
@@ -597,12 +918,59 @@ def check_incoming_calls(user_id):
     
     return incoming_call
 
+def show_incoming_call(user_id):
+    """
+    Banner for a ringing inbound call, run as a live fragment on every page.
+    The calls table is only queried again after a call event for this user
+    was pushed (or on every rerun when no listener is running).
+    """
+    incoming_call = get_query_cache().fetch(user_id, "calls", check_incoming_calls, user_id)
+    if incoming_call:
+        call_id, caller_name, caller_phone = incoming_call
+        st.warning(f"Incoming call from {caller_name} ({caller_phone})")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Answer Call"):
+                # In a real app, you would connect the call
+                st.success(f"Connected to call with {caller_name}")
+        
+        with col2:
+            if st.button("Decline Call"):
+                # Update call status
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute("""
+                UPDATE calls SET status = 'missed', end_time = NOW()
+                WHERE id = %s
+                """, (call_id,))
+                conn.commit()
+                cur.close()
+                conn.close()
+                get_query_cache().invalidate(user_id)
+                st.rerun(scope="fragment")
+
 # Main Streamlit app
 def main():
     st.title("Omni-Channel Communication App")
     
-    # Initialize database
-    init_db()
+    # Attachment links are verified by the webhook server, so both need the signing key
+    try:
+        check_link_secret()
+    except RuntimeError as e:
+        st.error(str(e))
+        st.stop()
+    
+    # Bring the schema up to date (only the first run in this process does any work)
+    ensure_schema()
+    
+    # Deliver any emails, SMS and calls still queued from an earlier run
+    get_email_outbox()
+    get_dispatcher()
+    
+    # UI request timings and outbox depths for Prometheus
+    if METRICS_PORT:
+        serve_metrics_once(int(METRICS_PORT))
     
     # Session state for login
     if 'logged_in' not in st.session_state:
@@ -652,14 +1020,52 @@ def main():
         # Communication options
         option = st.sidebar.selectbox(
             "Select Communication Channel",
-            ["Email", "SMS", "Chat", "Calls", "All Messages"]
+            ["Inbox", "Email", "SMS", "Chat", "Calls", "All Messages", "Search", "Broadcast"]
         )
         
+        # Ringing calls show up on every page, pushed as they arrive
+        live_fragment(show_incoming_call)(st.session_state.user_id)
+        
         # Get list of users for recipient selection
         users = get_users()
         user_options = [(user[0], user[1]) for user in users if user[0] != st.session_state.user_id]
         
-        if option == "Email":
+        if option == "Inbox":
+            st.header("Inbox")
+            live_refresh(st.session_state.user_id, [ALL_TOPIC])
+            
+            channel = st.selectbox("Channel", ["All", "Email", "SMS", "Chat", "Call"])
+            conversations, next_cursor = split_page(
+                get_query_cache().fetch(
+                    st.session_state.user_id, ALL_TOPIC, get_conversations, st.session_state.user_id,
+                    None if channel == "All" else channel.lower(), before=pager(f"conversation_pages_{channel}")[-1],
+                    limit=PAGE_SIZE + 1
+                ),
+                PAGE_SIZE,
+                cursor_of=conversation_cursor
+            )
+            
+            if not conversations:
+                st.info("No conversations yet")
+            for (conversation_id, conversation_channel, peer, peer_id, last_subject, last_preview, last_status,
+                 last_outbound, unread, total, last_at) in conversations:
+                title = f"{conversation_channel.upper()}: {peer or 'unknown'}"
+                if unread:
+                    title += f" ({unread} new)"
+                with st.expander(f"{title} - {last_at.strftime('%Y-%m-%d %H:%M')}"):
+                    if conversation_channel == "call":
+                        summary = f"{'Outgoing' if last_outbound else 'Incoming'} call, {last_status}"
+                    else:
+                        summary = " - ".join(part for part in (last_subject, last_preview) if part)
+                    st.write(f"{'You: ' if last_outbound else ''}{summary}")
+                    st.caption(f"{total} in total · Status: {last_status}")
+                    if unread and st.button("Mark as read", key=f"read_conversation_{conversation_id}"):
+                        mark_conversation_read(st.session_state.user_id, conversation_id)
+                        st.rerun()
+            
+            pager_controls(f"conversation_pages_{channel}", next_cursor)
+        
+        elif option == "Email":
             st.header("Email")
             
             # Compose Email section
@@ -670,44 +1076,66 @@ def main():
             attachment = st.file_uploader("Attachment")
             
             if st.button("Send Email"):
-                if send_email(st.session_state.user_id, recipient_email, subject, content, attachment):
-                    st.success("Email sent successfully!")
+                send_email(st.session_state.user_id, recipient_email, subject, content, attachment)
             
             # Add a separator between compose and inbox
             st.markdown("---")
             
-            # Inbox section
+            # Inbox section, rendered from the synced copy in the database
             st.subheader("Inbox")
-            emails = fetch_emails(limit=2)
+            live_refresh(st.session_state.user_id, ["email"])
+            sync_inbox(force=st.button("Refresh Inbox"))
+            emails, next_cursor = split_page(
+                get_inbox_emails(before=pager("inbox_pages")[-1], limit=PAGE_SIZE + 1),
+                PAGE_SIZE
+            )
             
-            for email in emails:
+            opened = st.session_state.setdefault("opened_messages", set())
+            for mail in emails:
                 with st.container():
                     st.markdown("""
                     ---
                     **From:** {}  
                     **Subject:** {}
-                    """.format(email['from'], email['subject']))
+                    """.format(mail.from_address, mail.subject))
+                    # Parsed and stored at ingestion; nothing is re-parsed here
+                    if mail.preview:
+                        st.caption(mail.preview)
                     
                     with st.expander("View Message"):
-                        # Display the content without HTML tags
-                        from bs4 import BeautifulSoup
-                        
-                        if email['is_html']:
-                            soup = BeautifulSoup(email['body'], 'html.parser')
-                            clean_text = soup.get_text(separator='\n')
-                            st.write(clean_text)
+                        # Bodies are read from the database only once opened; small ones
+                        # arrive with the sync, larger ones are downloaded from IMAP first
+                        if mail.id not in opened:
+                            if st.button("Load message", key=f"load_email_{mail.id}"):
+                                try:
+                                    if not mail.body_loaded:
+                                        get_mail_sync().load_body(mail.id)
+                                    opened.add(mail.id)
+                                except Exception as e:
+                                    st.error(f"Error loading email: {str(e)}")
+                                st.rerun()
                         else:
-                            st.write(email['body'])
-                        
-                        if email['attachments']:
-                            st.markdown("**Attachments:**")
-                            for attachment in email['attachments']:
-                                st.download_button(
-                                    label=f"📎 {attachment}",
-                                    data=open(os.path.join("attachments", attachment), "rb"),
-                                    file_name=attachment
-                                )
+                            body = get_query_cache().fetch(st.session_state.user_id, "email", get_message_body,
+                                                           st.session_state.user_id, mail.id)
+                            st.write(body.content if body else "")
+                            
+                            if mail.attachment_names and body:
+                                st.markdown("**Attachments:**")
+                                # Links only; the browser downloads from the Flask route
+                                for attachment in body.attachments:
+                                    st.markdown(f"[📎 {attachment.filename}]"
+                                                f"({attachment_url(attachment.id, st.session_state.user_id)})")
+                                # Emails loaded before the attachment store kept files by name
+                                if not body.attachments:
+                                    missing = adopt_legacy_attachments(st.session_state.user_id, mail.id,
+                                                                       mail.attachment_names)
+                                    for attachment in missing:
+                                        st.caption(f"📎 {attachment} (missing attachment)")
+                                    if len(missing) < len(mail.attachment_names):
+                                        st.rerun()
                     st.markdown("---")
+            
+            pager_controls("inbox_pages", next_cursor)
         
         elif option == "SMS":
             st.header("SMS")
@@ -718,19 +1146,25 @@ def main():
             content = st.text_area("Message")
             
             if st.button("Send SMS"):
-                if send_sms(st.session_state.user_id, recipient[0], content):
-                    st.success("SMS sent successfully!")
+                send_sms(st.session_state.user_id, recipient[0], content)
             
-            # Show SMS history
+            # Show SMS history, one page at a time
             st.subheader("SMS History")
-            sms_messages = get_messages(st.session_state.user_id, "sms")
+            live_refresh(st.session_state.user_id, ["sms"])
+            # Served from the query cache until an SMS of this user is sent, received or changes status
+            sms_messages, next_cursor = split_page(
+                get_query_cache().fetch(st.session_state.user_id, "sms", get_messages, st.session_state.user_id,
+                                        "sms", before=pager("sms_pages")[-1], limit=PAGE_SIZE + 1),
+                PAGE_SIZE
+            )
             
             for sms in sms_messages:
-                with st.expander(f"From: {sms[1]} - To: {sms[2]} - {sms[7].strftime('%Y-%m-%d %H:%M')}"):
-                    st.write(sms[4])  # Content
-                    
-                    if sms[5]:  # Attachment path
-                        st.write("Has attachment")
+                with st.expander(f"From: {sms.sender} - To: {sms.receiver} - {sms.created_at.strftime('%Y-%m-%d %H:%M')}"):
+                    # The body and attachments are only fetched when asked for
+                    show_message_body(st.session_state.user_id, sms, "sms")
+                    st.caption(f"Status: {sms.status}")
+            
+            pager_controls("sms_pages", next_cursor)
         
         elif option == "Chat":
             st.header("Chat")
@@ -738,23 +1172,9 @@ def main():
             # Add recipient selection at the top
             recipient = st.selectbox("Select user to chat with", user_options, format_func=lambda x: x[1])
             
-            # Display chat history
-            chat_messages = get_messages(st.session_state.user_id, "chat")
-            filtered_messages = [msg for msg in chat_messages if 
-                                (msg[1] == recipient[1] or msg[2] == recipient[1])]
-            
-            for msg in reversed(filtered_messages):
-                if msg[1] == st.session_state.username:
-                    st.write(f"You: {msg[4]}")
-                else:
-                    st.write(f"{msg[1]}: {msg[4]}")
-                
-                if msg[5]:  # Attachment
-                    attachment_path = msg[5]
-                    if attachment_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                        st.image(attachment_path, caption="Attachment", use_container_width=True)
-                    else:
-                        st.markdown(f"[Download Attachment]({attachment_path})")
+            # Display chat history with this user; new messages are pushed into
+            # the thread without rerunning the rest of the page
+            live_fragment(show_chat_thread)(st.session_state.user_id, st.session_state.username, recipient[0])
             
             # Send chat message
             content = st.text_input("Type a message")
@@ -783,97 +1203,124 @@ def main():
                     end_call(st.session_state.current_call)
                     st.session_state.pop('current_call')
             
-            # Display incoming calls
-            st.subheader("Incoming Calls")
-            incoming_call = check_incoming_calls(st.session_state.user_id)
-            if incoming_call:
-                call_id, caller_name, caller_phone = incoming_call
-                st.warning(f"Incoming call from {caller_name} ({caller_phone})")
-                
-                col1, col2 = st.columns(2)
-                with col1:
-                    if st.button("Answer Call"):
-                        # In a real app, you would connect the call
-                        st.success(f"Connected to call with {caller_name}")
-                
-                with col2:
-                    if st.button("Decline Call"):
-                        # Update call status
-                        conn = get_db_connection()
-                        cur = conn.cursor()
-                        cur.execute("""
-                        UPDATE calls SET status = 'missed', end_time = NOW()
-                        WHERE id = %s
-                        """, (call_id,))
-                        conn.commit()
-                        cur.close()
-                        conn.close()
-                        st.rerun()
-            
-            # Call history
+            # Call history, one page at a time (incoming calls ring in the banner above)
             st.subheader("Call History")
-            calls = get_calls(st.session_state.user_id)
+            live_refresh(st.session_state.user_id, ["calls"])
+            calls, next_cursor = split_page(
+                get_query_cache().fetch(st.session_state.user_id, "calls", get_calls, st.session_state.user_id,
+                                        before=pager("call_pages")[-1], limit=PAGE_SIZE + 1),
+                PAGE_SIZE
+            )
             
             for call in calls:
-                direction = "Outgoing" if call[1] == st.session_state.username else "Incoming"
-                status = call[5]
+                direction = "Outgoing" if call.caller == st.session_state.username else "Incoming"
                 duration = "N/A"
                 
-                if call[3] and call[4]:  # start_time and end_time
-                    duration = str(call[4] - call[3])
+                # As reported by Twilio when the call completed, else as recorded here
+                if call.duration is not None:
+                    duration = str(timedelta(seconds=call.duration))
+                elif call.start_time and call.end_time:
+                    duration = str(call.end_time - call.start_time)
                 
-                st.write(f"{direction} call with {call[2]}")
-                st.write(f"Status: {status}, Duration: {duration}")
+                st.write(f"{direction} call with {call.receiver_phone}")
+                st.write(f"Status: {call.status}, Duration: {duration}")
                 st.write("---")
+            
+            pager_controls("call_pages", next_cursor)
         
         elif option == "All Messages":
             st.header("All Communications")
+            live_refresh(st.session_state.user_id, [ALL_TOPIC])
             
-            all_messages = get_messages(st.session_state.user_id)
-            all_calls = get_calls(st.session_state.user_id)
-            
-            # Combine and sort by date
-            all_comms = []
-            
-            for msg in all_messages:
-                all_comms.append({
-                    'type': msg[3],  # message_type
-                    'from': msg[1],  # sender username
-                    'to': msg[2],    # receiver username
-                    'content': msg[4],
-                    'attachment': msg[5],
-                    'time': msg[7],
-                    'display': f"{msg[3].upper()}: {msg[1]} → {msg[2]}"
-                })
-            
-            for call in all_calls:
-                all_comms.append({
-                    'type': 'call',
-                    'from': call[1],  # caller username
-                    'to': call[2],    # receiver username
-                    'content': f"Status: {call[5]}, Direction: {call[6]}",
-                    'attachment': None,
-                    'time': call[3],  # start_time
-                    'display': f"CALL: {call[1]} → {call[2]}"
-                })
-            
-            # Sort by time, newest first
-            all_comms.sort(key=lambda x: x['time'], reverse=True)
-            
-            for comm in all_comms:
-                with st.expander(f"{comm['display']} - {comm['time'].strftime('%Y-%m-%d %H:%M')}"):
-                    st.write(comm['content'])
-                    
-                    if comm['attachment']:
-                        st.write("Has attachment")
+            timeline, next_cursor = split_page(
+                get_query_cache().fetch(st.session_state.user_id, ALL_TOPIC, get_timeline, st.session_state.user_id,
+                                        before=pager("all_pages")[-1], limit=PAGE_SIZE + 1),
+                PAGE_SIZE,
+                cursor_of=timeline_cursor
+            )
+            
+            for item in timeline:
+                shown_at = item.shown_at or item.created_at
+                with st.expander(f"{item.item_type.upper()}: {item.sender} → {item.receiver} - "
+                                 f"{shown_at.strftime('%Y-%m-%d %H:%M')}"):
+                    if item.kind == TIMELINE_MESSAGE:
+                        show_message_body(st.session_state.user_id, item, ALL_TOPIC)
+                    else:
+                        st.write(item.preview)
+            
+            pager_controls("all_pages", next_cursor)
+        
+        elif option == "Search":
+            st.header("Search")
+            
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                query = st.text_input("Search emails, SMS and chats", placeholder='invoice -draft "next week"')
+            with col2:
+                channel = st.selectbox("Channel", ["All", "Email", "SMS", "Chat"])
+            
+            # A new search starts again from the best matches
+            search = (query.strip(), channel)
+            if st.session_state.get("last_search") != search:
+                st.session_state.last_search = search
+                st.session_state.pop("search_pages", None)
+            
+            if search[0]:
+                results, next_cursor = split_page(
+                    search_messages(
+                        st.session_state.user_id, search[0],
+                        message_type=None if channel == "All" else channel.lower(),
+                        before=pager("search_pages")[-1], limit=PAGE_SIZE + 1
+                    ),
+                    PAGE_SIZE,
+                    cursor_of=search_cursor
+                )
+                if not results:
+                    st.info("No messages match your search.")
+                
+                for message_id, sender, receiver, message_type, subject, snippet, created_at, rank in results:
+                    title = f"{message_type.upper()}: {sender} → {receiver} - {created_at.strftime('%Y-%m-%d %H:%M')}"
+                    with st.container():
+                        st.markdown(f"**{title}**")
+                        if subject:
+                            st.caption(subject)
+                        st.markdown(snippet)
+                        st.markdown("---")
+                
+                pager_controls("search_pages", next_cursor)
+        
+        elif option == "Broadcast":
+            st.header("Broadcast")
+            
+            # One message to many recipients, queued in bulk and delivered in the background
+            channel = st.radio("Channel", ["SMS", "Email"], horizontal=True)
+            pasted = st.text_area("Recipients (one phone number or email address per line)")
+            uploaded = st.file_uploader("Or a recipients file (one per line, or a CSV with them in the first column)",
+                                        type=["txt", "csv"])
+            subject = st.text_input("Subject") if channel == "Email" else None
+            content = st.text_area("Message", key="broadcast_message")
+            
+            if st.button("Send broadcast"):
+                result = create_broadcast(st.session_state.user_id, channel.lower(),
+                                          read_recipients(pasted, uploaded), content, subject)
+                if channel == "SMS":
+                    get_dispatcher().wake()
+                else:
+                    get_email_outbox().wake()
+                st.session_state.broadcast_id = result["id"]
+                st.success(f"{result['queued']} messages queued for delivery")
+            
+            broadcasts = get_broadcasts(st.session_state.user_id)
+            for broadcast_id, broadcast_channel, broadcast_subject, broadcast_content, total, created_at in broadcasts:
+                title = broadcast_subject or (broadcast_content or "")[:40]
+                with st.expander(f"{broadcast_channel.upper()}: {title} - {total} recipients - "
+                                 f"{created_at.strftime('%Y-%m-%d %H:%M')}",
+                                 expanded=broadcast_id == st.session_state.get("broadcast_id")):
+                    # Only the broadcast still being delivered keeps refreshing
+                    refreshing = (broadcast_id == st.session_state.get("broadcast_id")
+                                  and st.session_state.get("broadcast_done") != broadcast_id)
+                    st.fragment(show_broadcast_progress, run_every=1.0 if refreshing else None)(broadcast_id)
 
 if __name__ == "__main__":
-    # Run Flask app in a separate thread
-    def run_flask():
-        flask_app.run(port=5000)
-    
-    flask_thread = Thread(target=run_flask)
-    flask_thread.start()
-    
-    # Run Streamlit app
+    # The webhooks are served by their own process: python webhook_server.py
     main()
\ No newline at end of file
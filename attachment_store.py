@@ -0,0 +1,296 @@
+# attachment_store.py - Content-addressed attachment blobs with reference counting
+
+import hashlib
+import hmac
+import logging
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+from db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# A blob streamed to a temporary file but not yet referenced by any message
+PendingBlob = namedtuple("PendingBlob", ["sha256", "size", "temp_path"])
+
+# One attachment of a message, as stored in message_attachments
+Attachment = namedtuple("Attachment", ["id", "message_id", "sha256", "filename", "content_type", "size", "path"])
+
+
+class AttachmentStore:
+    """
+    Stores attachment content once per distinct SHA-256.
+
+    Saving is two-phase so the blob name is known before the message row is
+    written: write() streams the upload to a temporary file in CHUNK_SIZE
+    pieces while hashing it, then attach() (inside the caller's transaction)
+    bumps the blob's refcount in `attachments`, moves the file into place
+    unless an identical blob already exists, and records the reference in
+    `message_attachments`. detach() drops a message's references; blobs
+    left with no references are deleted by collect_garbage() once they have
+    been unreferenced for a grace period.
+
+    Blobs live at <root>/blobs/<first two hex digits>/<sha256>.
+
+    Args:
+        root: Directory holding the blobs (created on demand)
+        chunk_size: Bytes read and written per step
+    """
+
+    def __init__(self, root="attachments", chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.blob_root = os.path.join(root, "blobs")
+        self.temp_root = os.path.join(root, "tmp")
+        self.chunk_size = chunk_size
+
+    def path(self, sha256):
+        return os.path.join(self.blob_root, sha256[:2], sha256)
+
+    def write(self, fileobj):
+        """Stream a file-like object (or bytes) to a temporary file; returns a PendingBlob."""
+        if isinstance(fileobj, (bytes, bytearray, memoryview)):
+            chunks = [bytes(fileobj)]
+        else:
+            chunks = iter(lambda: fileobj.read(self.chunk_size), b"")
+
+        os.makedirs(self.temp_root, exist_ok=True)
+        temp_path = os.path.join(self.temp_root, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return PendingBlob(digest.hexdigest(), size, temp_path)
+
+    def attach(self, cur, message_id, blob, filename, content_type=None):
+        """
+        Reference a written blob from a message, using the caller's cursor.
+
+        The refcount row is locked before the file is moved into place, so a
+        concurrent collect_garbage() either finishes deleting the old copy
+        first or sees the new reference and skips it.
+
+        Returns the message_attachments id.
+        """
+        content_type = content_type or mimetypes.guess_type(filename or "")[0] or "application/octet-stream"
+        cur.execute("""
+        INSERT INTO attachments (sha256, size, refcount)
+        VALUES (%s, %s, 1)
+        ON CONFLICT (sha256) DO UPDATE SET refcount = attachments.refcount + 1, unreferenced_since = NULL
+        """, (blob.sha256, blob.size))
+
+        path = self.path(blob.sha256)
+        if os.path.exists(path):
+            os.unlink(blob.temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(blob.temp_path, path)
+
+        cur.execute("""
+        INSERT INTO message_attachments (message_id, sha256, filename, content_type)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+        """, (message_id, blob.sha256, filename, content_type))
+        return cur.fetchone()[0]
+
+    def discard(self, blob):
+        """Remove the temporary file of a blob that will not be attached."""
+        try:
+            os.unlink(blob.temp_path)
+        except FileNotFoundError:
+            pass
+
+    def detach(self, cur, message_id):
+        """Drop every attachment reference held by a message, using the caller's cursor."""
+        cur.execute("DELETE FROM message_attachments WHERE message_id = %s RETURNING sha256", (message_id,))
+        released = [row[0] for row in cur.fetchall()]
+        if released:
+            cur.execute("""
+            UPDATE attachments a SET refcount = a.refcount - r.n,
+                unreferenced_since = CASE WHEN a.refcount - r.n <= 0 THEN NOW() END
+            FROM (SELECT sha256, COUNT(*) AS n FROM unnest(%s::char(64)[]) AS sha256 GROUP BY sha256) r
+            WHERE a.sha256 = r.sha256
+            """, (released,))
+        return len(released)
+
+    def attachments_for(self, message_ids):
+        """{message_id: [Attachment, ...]} for a page of messages, in one query."""
+        if not message_ids:
+            return {}
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+        SELECT ma.id, ma.message_id, ma.sha256, ma.filename, ma.content_type, a.size
+        FROM message_attachments ma
+        JOIN attachments a ON a.sha256 = ma.sha256
+        WHERE ma.message_id = ANY(%s)
+        ORDER BY ma.id
+        """, (list(message_ids),))
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+
+        found = {}
+        for row in rows:
+            found.setdefault(row[1], []).append(Attachment(*row, self.path(row[2])))
+        return found
+
+    def collect_garbage(self, grace_seconds=3600):
+        """
+        Delete blobs that have had no references for `grace_seconds`, plus
+        files on disk no row knows about (uploads whose transaction rolled
+        back) and stale temporary files.
+
+        Returns (blobs deleted, bytes freed).
+        """
+        deleted = freed = 0
+        cutoff = time.time() - grace_seconds
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            # Unlink while the deleted rows are still locked, so a concurrent
+            # attach() of the same content waits and then writes a fresh copy
+            cur.execute("""
+            DELETE FROM attachments
+            WHERE refcount <= 0 AND unreferenced_since < NOW() - make_interval(secs => %s)
+            RETURNING sha256, size
+            """, (grace_seconds,))
+            for sha256, size in cur.fetchall():
+                try:
+                    os.unlink(self.path(sha256))
+                except FileNotFoundError:
+                    pass
+                deleted += 1
+                freed += size
+            conn.commit()
+
+            for directory in self._blob_directories():
+                old = {}
+                for entry in os.scandir(directory):
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        old[entry.name] = entry.stat().st_size
+                if not old:
+                    continue
+                cur.execute("SELECT sha256 FROM attachments WHERE sha256 = ANY(%s)", (list(old),))
+                known = {row[0] for row in cur.fetchall()}
+                conn.commit()
+                for name in old.keys() - known:
+                    try:
+                        os.unlink(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        continue
+                    deleted += 1
+                    freed += old[name]
+        finally:
+            cur.close()
+            conn.close()
+
+        if os.path.isdir(self.temp_root):
+            for entry in os.scandir(self.temp_root):
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+
+        logger.info("Attachment GC removed %d blobs (%d bytes)", deleted, freed)
+        return deleted, freed
+
+    def _blob_directories(self):
+        if not os.path.isdir(self.blob_root):
+            return []
+        return [entry.path for entry in os.scandir(self.blob_root) if entry.is_dir()]
+
+
+# Attachment links are signed for one user by Streamlit and verified by the
+# webhook server's workers, separate processes that must share the key
+_link_secret = os.getenv("ATTACHMENT_URL_SECRET", "").encode()
+LINK_TTL = int(os.getenv("ATTACHMENT_LINK_TTL", "3600"))
+
+
+def check_link_secret():
+    """Raise RuntimeError unless ATTACHMENT_URL_SECRET is set; called by both servers at startup."""
+    if not _link_secret:
+        raise RuntimeError("ATTACHMENT_URL_SECRET is not set; Streamlit and the webhook server need the same "
+                           "value to sign and verify attachment links")
+
+
+def _link_signature(attachment_id, user_id, expires):
+    check_link_secret()
+    return hmac.new(_link_secret, f"{attachment_id}:{user_id}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def attachment_url(attachment_id, user_id, preview=False):
+    """
+    Signed link to the Flask attachment route (or its preview) for `user_id`.
+
+    The expiry is rounded up to a LINK_TTL boundary so the same link is
+    rendered on every rerun and the browser cache keeps working.
+    """
+    expires = (int(time.time()) // LINK_TTL + 2) * LINK_TTL
+    base = os.getenv("PUBLIC_BASE_URL", "http://localhost:5000").rstrip("/")
+    return (f"{base}/attachments/{attachment_id}{'/preview' if preview else ''}"
+            f"?u={user_id}&e={expires}&s={_link_signature(attachment_id, user_id, expires)}")
+
+
+def verify_link(attachment_id, user_id, expires, signature):
+    """True when a link's signature matches and it has not expired."""
+    try:
+        user_id, expires = int(user_id), int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(_link_signature(attachment_id, user_id, expires), signature or "")
+
+
+def load_attachment(attachment_id):
+    """
+    (Attachment, sender_id, receiver_id, is_inbox_email) for the Flask route,
+    or None when the attachment does not exist.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT ma.id, ma.message_id, ma.sha256, ma.filename, ma.content_type, a.size,
+           m.sender_id, m.receiver_id, m.imap_mailbox IS NOT NULL
+    FROM message_attachments ma
+    JOIN attachments a ON a.sha256 = ma.sha256
+    JOIN messages m ON m.id = ma.message_id
+    WHERE ma.id = %s
+    """, (attachment_id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    if row is None:
+        return None
+    return Attachment(*row[:6], get_attachment_store().path(row[2])), row[6], row[7], row[8]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_attachment_store():
+    """Process-wide AttachmentStore rooted at ATTACHMENT_DIR."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = AttachmentStore(os.getenv("ATTACHMENT_DIR", "attachments"))
+        return _store
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    blobs, freed = get_attachment_store().collect_garbage(
+        grace_seconds=float(os.getenv("ATTACHMENT_GC_GRACE", "3600"))
+    )
+    print(f"removed {blobs} blobs, freed {freed} bytes")
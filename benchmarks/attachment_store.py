@@ -0,0 +1,123 @@
+# benchmarks/attachment_store.py - Disk usage and write time of attachments on a duplicate-heavy workload
+#
+# Saves the same sequence of uploads (drawn from a small set of distinct
+# files, as when one image is forwarded again and again) twice: the old way,
+# one attachments/<uuid>.<ext> file per upload, and through AttachmentStore
+# with a chat message per upload. Then drops half the messages' references
+# and garbage-collects.
+#
+#   python benchmarks/attachment_store.py --uploads 2000 --distinct 50 --size-kb 256
+
+import argparse
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+
+from common import use_bench_database
+
+from db import get_db_connection
+
+
+def disk_usage(root):
+    total = files = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            total += os.path.getsize(os.path.join(directory, name))
+            files += 1
+    return total, files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attachment disk usage and write time on duplicate-heavy uploads")
+    parser.add_argument("--uploads", type=int, default=2000)
+    parser.add_argument("--distinct", type=int, default=50, help="distinct files the uploads are drawn from")
+    parser.add_argument("--size-kb", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    use_bench_database()
+    from attachment_store import AttachmentStore
+
+    rng = random.Random(args.seed)
+    contents = [rng.randbytes(args.size_kb * 1024) for _ in range(args.distinct)]
+    # Skewed like real traffic: a few files account for most uploads
+    uploads = rng.choices(range(args.distinct), weights=[1 / (i + 1) for i in range(args.distinct)], k=args.uploads)
+
+    scratch = tempfile.mkdtemp(prefix="attachment-bench-")
+    try:
+        # Old path: the whole upload buffer written to a new uuid-named file
+        legacy_root = os.path.join(scratch, "legacy")
+        started = time.perf_counter()
+        for index in uploads:
+            path = os.path.join(legacy_root, f"{uuid.uuid4()}.bin")
+            os.makedirs(legacy_root, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(io.BytesIO(contents[index]).getbuffer())
+        legacy_seconds = time.perf_counter() - started
+        legacy_bytes, legacy_files = disk_usage(legacy_root)
+
+        # Store: chunked write + hash, refcounted row, one chat message per upload
+        store = AttachmentStore(os.path.join(scratch, "store"))
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE username = 'user1'")
+        user_id = cur.fetchone()[0]
+        message_ids = []
+        write_seconds = 0.0
+        started = time.perf_counter()
+        for index in uploads:
+            write_started = time.perf_counter()
+            blob = store.write(io.BytesIO(contents[index]))
+            write_seconds += time.perf_counter() - write_started
+            cur.execute("""
+            INSERT INTO messages (sender_id, receiver_id, message_type, content, attachment_path, status)
+            VALUES (%s, %s, 'chat', 'attachment benchmark', %s, 'sent')
+            RETURNING id
+            """, (user_id, user_id, store.path(blob.sha256)))
+            message_ids.append(cur.fetchone()[0])
+            store.attach(cur, message_ids[-1], blob, f"file{index}.bin")
+            conn.commit()
+        store_seconds = time.perf_counter() - started
+        store_bytes, store_files = disk_usage(store.blob_root)
+
+        print(f"{args.uploads} uploads of {args.size_kb} KiB drawn from {args.distinct} distinct files")
+        print(f"uuid files : {legacy_seconds:6.2f}s  {legacy_bytes / 2**20:8.1f} MiB in {legacy_files} files")
+        print(f"blob store : {store_seconds:6.2f}s  {store_bytes / 2**20:8.1f} MiB in {store_files} files "
+              f"({write_seconds:.2f}s streaming and hashing, the rest is the message insert and commit per upload)")
+
+        # Drop every other message's reference, then collect with no grace period
+        for message_id in message_ids[::2]:
+            store.detach(cur, message_id)
+        conn.commit()
+        cur.execute("""
+        SELECT COUNT(*) FROM attachments a
+        WHERE a.refcount <> (SELECT COUNT(*) FROM message_attachments ma WHERE ma.sha256 = a.sha256)
+        """)
+        mismatched = cur.fetchone()[0]
+        cur.execute("UPDATE attachments SET unreferenced_since = NOW() - INTERVAL '1 hour' WHERE refcount <= 0")
+        conn.commit()
+        started = time.perf_counter()
+        deleted, freed = store.collect_garbage(grace_seconds=60)
+        gc_bytes, gc_files = disk_usage(store.blob_root)
+        print(f"after detaching half: GC removed {deleted} blobs ({freed / 2**20:.1f} MiB) in "
+              f"{time.perf_counter() - started:.3f}s, {gc_bytes / 2**20:.1f} MiB in {gc_files} files left; "
+              f"refcount mismatches: {mismatched}")
+
+        # Leave the scratch database as it was
+        for message_id in message_ids[1::2]:
+            store.detach(cur, message_id)
+        cur.execute("DELETE FROM messages WHERE id = ANY(%s)", (message_ids,))
+        cur.execute("DELETE FROM attachments WHERE refcount <= 0")
+        conn.commit()
+        cur.close()
+        conn.close()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# benchmarks/broadcast.py - Bulk broadcast persistence and delivery against local SMTP and Twilio stand-ins
+#
+# Persists one SMS broadcast and one email broadcast with create_broadcast()
+# (one COPY plus set-based inserts) and compares the rows/sec with the
+# per-recipient path send_sms used to take: lookup, single-row insert,
+# outbox job and commit per recipient. Then lets the TwilioDispatcher and
+# EmailOutbox pools deliver both broadcasts to the stubs, polling
+# broadcast_progress() for throughput and final per-status counts.
+#
+#   python benchmarks/broadcast.py --sms 20000 --emails 5000 --mps 1000 --latency-ms 20
+
+import argparse
+import random
+import time
+
+from common import use_bench_database
+from stubs import SmtpSink, TwilioStub
+
+from db import get_db_connection
+
+
+def recipients(kind, count, rng):
+    """`count` addresses with ~1% duplicates and ~1% invalid entries mixed in."""
+    found = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.01 and found:
+            found.append(rng.choice(found))
+        elif roll < 0.02:
+            found.append("not-an-address")
+        elif kind == "sms":
+            found.append(f"+1 (666) {i // 10000:03d}-{i % 10000:04d}")
+        else:
+            found.append(f"Broadcast{i}@Example.com")
+    return found
+
+
+def per_recipient(sender_id, phones):
+    """The old path: one lookup, insert, outbox job and commit per recipient."""
+    from identity import get_identity_cache
+    from twilio_dispatch import enqueue
+
+    created = []
+    for phone in phones:
+        receiver = get_identity_cache().by_phone(phone)
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+        INSERT INTO messages (sender_id, receiver_id, message_type, content, to_address, status)
+        VALUES (%s, %s, 'sms', %s, %s, 'queued')
+        RETURNING id
+        """, (sender_id, receiver.id if receiver else None, "Campaign message", phone))
+        created.append(cur.fetchone()[0])
+        enqueue(cur, "sms", {"from": "+15550000000", "to": phone, "body": "Campaign message"}, message_id=created[-1])
+        conn.commit()
+        cur.close()
+        conn.close()
+    return created
+
+
+def cleanup(broadcast_ids, message_ids):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    DELETE FROM outbox WHERE message_id IN (
+        SELECT id FROM messages WHERE broadcast_id = ANY(%s) OR id = ANY(%s)
+    )
+    """, (broadcast_ids, message_ids))
+    cur.execute("DELETE FROM messages WHERE broadcast_id = ANY(%s) OR id = ANY(%s)", (broadcast_ids, message_ids))
+    cur.execute("DELETE FROM broadcasts WHERE id = ANY(%s)", (broadcast_ids,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk broadcast persistence and delivery throughput")
+    parser.add_argument("--sms", type=int, default=20000)
+    parser.add_argument("--emails", type=int, default=5000)
+    parser.add_argument("--baseline", type=int, default=500, help="recipients sent through the per-recipient path")
+    parser.add_argument("--workers", type=int, default=8, help="Twilio dispatcher workers")
+    parser.add_argument("--mps", type=float, default=1000.0, help="messages/sec rate limit")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="stub API response time")
+    parser.add_argument("--smtp-workers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    use_bench_database()
+    from broadcast import create_broadcast, broadcast_progress
+    from outbound_email import EmailOutbox, SmtpSession
+    from twilio_dispatch import TwilioApi, TwilioDispatcher
+
+    rng = random.Random(args.seed)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE username = 'user1'")
+    sender_id = cur.fetchone()[0]
+    # Leftovers of an interrupted run would be delivered too
+    cur.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('queued', 'sending')")
+    if cur.fetchone()[0]:
+        raise SystemExit("outbox has undelivered jobs; drain or delete them first")
+    cur.close()
+    conn.close()
+
+    started = time.perf_counter()
+    baseline_ids = per_recipient(sender_id, [f"+1777{i:07d}" for i in range(args.baseline)])
+    baseline_rate = args.baseline / (time.perf_counter() - started)
+    print(f"per-recipient inserts : {baseline_rate:9.0f} recipients/s ({args.baseline} recipients)")
+    cleanup([], baseline_ids)
+
+    broadcasts = []
+    for kind, count, subject in (("sms", args.sms, None), ("email", args.emails, "Campaign")):
+        started = time.perf_counter()
+        result = create_broadcast(sender_id, kind, recipients(kind, count, rng), "Campaign message", subject)
+        elapsed = time.perf_counter() - started
+        broadcasts.append(result["id"])
+        print(f"{kind:5} broadcast COPY  : {result['queued'] / elapsed:9.0f} recipients/s "
+              f"({result['queued']} queued in {elapsed:.2f}s, {result['rejected']} rejected, "
+              f"{result['duplicates']} duplicates)")
+
+    stub = TwilioStub(latency=args.latency_ms / 1000.0).start()
+    sink = SmtpSink().start()
+    dispatcher = TwilioDispatcher(
+        TwilioApi("ACbench", "token", base_url=stub.base_url, pool_size=args.workers),
+        workers=args.workers, messages_per_second=args.mps, poll_interval=0.05, backoff_base=0.05,
+    )
+    outbox = EmailOutbox(workers=args.smtp_workers, batch_size=100, poll_interval=0.05,
+                         session_factory=lambda: SmtpSession(sink.host, sink.port, starttls=False))
+
+    started = time.perf_counter()
+    dispatcher.start()
+    outbox.start()
+    finished = {}
+    while len(finished) < len(broadcasts):
+        time.sleep(0.25)
+        for broadcast_id in broadcasts:
+            if broadcast_id not in finished and broadcast_progress(broadcast_id)["done"]:
+                finished[broadcast_id] = time.perf_counter() - started
+    dispatcher.stop()
+    outbox.stop()
+
+    for kind, broadcast_id in zip(("sms", "email"), broadcasts):
+        progress = broadcast_progress(broadcast_id)
+        print(f"{kind:5} delivery         : {progress['total'] / finished[broadcast_id]:9.0f} messages/s "
+              f"({progress['total']} in {finished[broadcast_id]:.2f}s), statuses {progress['statuses']}")
+    print(f"Twilio requests {len(stub.requests)} over {stub.connections} connections; "
+          f"SMTP messages {sink.messages} over {sink.connections} connections")
+
+    cleanup(broadcasts, [])
+    stub.stop()
+    sink.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# benchmarks/common.py - Shared helpers for the benchmark and query-plan scripts
+#
+# Everything here runs against a scratch database (BENCH_DB_NAME, default
+# omni_channel_bench) on the server configured by the usual DB_* variables,
+# never against the application database.
+
+import math
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import psycopg2
+from db import get_db_settings
+
+# Words synthetic message bodies are made of, most frequent first, so text
+# search sees common and rare terms
+VOCABULARY = (
+    "meeting today tomorrow call please thanks invoice order delivery payment account update schedule "
+    "report project review team customer support ticket refund shipping address password reset login "
+    "contract proposal budget quarter deadline release build deploy server outage incident backup "
+    "database migration invoice receipt subscription renewal discount coupon warehouse inventory "
+    "appointment doctor dentist flight hotel booking itinerary passport visa conference keynote "
+    "webinar recording transcript agenda minutes summary feedback survey holiday birthday dinner"
+).split()
+
+
+def use_bench_database(name=None):
+    """Point the app's pool at the scratch database, creating it if needed."""
+    name = name or os.getenv("BENCH_DB_NAME", "omni_channel_bench")
+    settings = get_db_settings()
+    settings["dbname"] = "postgres"
+
+    conn = psycopg2.connect(**settings)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+    if cur.fetchone() is None:
+        cur.execute('CREATE DATABASE "%s"' % name.replace('"', '""'))
+    cur.close()
+    conn.close()
+
+    os.environ["DB_NAME"] = name
+    # The benchmarks only ever talk to the local Twilio stand-in, so
+    # placeholder credentials are enough.
+    os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACbench")
+    os.environ.setdefault("TWILIO_AUTH_TOKEN", "bench")
+    os.environ.setdefault("TWILIO_PHONE_NUMBER", "+15550000000")
+    os.environ.setdefault("ATTACHMENT_URL_SECRET", "bench")
+
+    from migrations import ensure_schema
+    ensure_schema()
+    return name
+
+
+def seed(users=10000, messages=1000000, calls=200000, heavy_share=0.02, reseed=False, random_seed=None):
+    """
+    Fill the scratch database with synthetic users, messages and calls.
+
+    `heavy_share` of all rows involve the demo user 'user1', so it stands in
+    for a heavy user with a long history. Seeding is skipped when the tables
+    already hold at least the requested number of rows. With `random_seed`
+    (between -1 and 1) a fresh seed produces the same rows every time.
+    """
+    from db import get_db_connection
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        if reseed:
+            cur.execute("TRUNCATE messages, calls RESTART IDENTITY CASCADE")
+            cur.execute("DELETE FROM users WHERE username LIKE 'bench%'")
+            conn.commit()
+        if random_seed is not None:
+            cur.execute("SELECT setseed(%s)", (random_seed,))
+
+        cur.execute("""
+        INSERT INTO users (username, email, phone_number, password)
+        SELECT 'bench' || g, 'bench' || g || '@example.com', '+1555' || lpad(g::text, 7, '0'), 'password'
+        FROM generate_series(1, %s) g
+        ON CONFLICT DO NOTHING
+        """, (users,))
+        conn.commit()
+
+        cur.execute("SELECT id FROM users WHERE username = 'user1'")
+        heavy_id = cur.fetchone()[0]
+        cur.execute("SELECT MIN(id), MAX(id) FROM users")
+        min_id, max_id = cur.fetchone()
+
+        cur.execute("SELECT COUNT(*) FROM messages")
+        missing = messages - cur.fetchone()[0]
+        if missing > 0:
+            cur.execute("""
+            INSERT INTO messages (sender_id, receiver_id, message_type, content, subject, status, created_at)
+            SELECT
+                CASE WHEN random() < %(heavy)s / 2 THEN %(heavy_id)s
+                     ELSE %(min_id)s + floor(random() * (%(max_id)s - %(min_id)s + 1))::int END,
+                CASE WHEN random() < %(heavy)s / 2 THEN %(heavy_id)s
+                     ELSE %(min_id)s + floor(random() * (%(max_id)s - %(min_id)s + 1))::int END,
+                (ARRAY['email', 'sms', 'chat'])[1 + floor(random() * 3)::int],
+                'Synthetic message body ' || g || ' ' || (
+                    -- 12 words skewed towards the start of the vocabulary; g %% 1 ties the
+                    -- subquery to the row so it isn't evaluated just once
+                    SELECT string_agg((%(words)s::text[])[1 + floor(array_length(%(words)s::text[], 1) * random() ^ 2)::int], ' ')
+                    FROM generate_series(1, 12 + (g %% 1))
+                ) || ' ' || md5(g::text),
+                'Subject ' || g,
+                'sent',
+                NOW() - random() * INTERVAL '365 days'
+            FROM generate_series(1, %(n)s) g
+            """, {"heavy": heavy_share, "heavy_id": heavy_id, "min_id": min_id, "max_id": max_id, "n": missing,
+                  "words": list(VOCABULARY)})
+            conn.commit()
+
+        cur.execute("SELECT COUNT(*) FROM calls")
+        missing = calls - cur.fetchone()[0]
+        if missing > 0:
+            cur.execute("""
+            INSERT INTO calls (caller_id, receiver_id, receiver_phone, start_time, end_time, status, direction, created_at)
+            SELECT caller, receiver, '+1555' || lpad(receiver::text, 7, '0'), started,
+                   CASE WHEN ringing THEN NULL ELSE started + random() * INTERVAL '10 minutes' END,
+                   CASE WHEN ringing THEN 'ongoing' ELSE 'completed' END,
+                   CASE WHEN ringing OR random() < 0.5 THEN 'inbound' ELSE 'outbound' END,
+                   started
+            FROM (
+                SELECT
+                    CASE WHEN random() < %(heavy)s THEN %(heavy_id)s
+                         ELSE %(min_id)s + floor(random() * (%(max_id)s - %(min_id)s + 1))::int END AS caller,
+                    %(min_id)s + floor(random() * (%(max_id)s - %(min_id)s + 1))::int AS receiver,
+                    NOW() - random() * INTERVAL '365 days' AS started,
+                    random() < 0.001 AS ringing
+                FROM generate_series(1, %(n)s)
+            ) s
+            """, {"heavy": heavy_share, "heavy_id": heavy_id, "min_id": min_id, "max_id": max_id, "n": missing})
+            conn.commit()
+
+        cur.execute("ANALYZE users")
+        cur.execute("ANALYZE messages")
+        cur.execute("ANALYZE calls")
+        conn.commit()
+        return heavy_id
+    finally:
+        cur.close()
+        conn.close()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100.0 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def time_calls(fn, repeat):
+    """Call fn() `repeat` times and return the individual durations in seconds."""
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+    return durations
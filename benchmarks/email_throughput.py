@@ -0,0 +1,88 @@
+# benchmarks/email_throughput.py - Outbound email throughput against a local SMTP sink
+#
+# Compares the old delivery path (one SMTP connection, handshake and login
+# per email) with the EmailOutbox worker pool reusing its sessions.
+#
+#   python benchmarks/email_throughput.py --emails 500 --workers 4 --handshake-ms 50
+
+import argparse
+import time
+
+from common import use_bench_database
+from stubs import SmtpSink
+
+from db import get_db_connection
+
+
+def queue_emails(count):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id, email FROM users WHERE username = 'user1'")
+    sender_id, sender_email = cur.fetchone()
+    cur.execute("""
+    INSERT INTO messages (sender_id, message_type, subject, content, from_address, to_address, status)
+    SELECT %s, 'email', 'Benchmark ' || g, repeat('Benchmark body. ', 50), %s, 'sink' || g || '@example.com', 'queued'
+    FROM generate_series(1, %s) g
+    """, (sender_id, sender_email, count))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def pending():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT COUNT(*) FROM messages
+    WHERE message_type = 'email' AND status IN ('queued', 'sending')
+    """)
+    count = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Outbound email throughput against a local SMTP sink")
+    parser.add_argument("--emails", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--handshake-ms", type=float, default=50.0,
+                        help="simulated STARTTLS + login cost per SMTP connection")
+    args = parser.parse_args()
+
+    use_bench_database()
+    from outbound_email import EmailOutbox, SmtpSession, build_message
+
+    sink = SmtpSink(handshake_delay=args.handshake_ms / 1000.0).start()
+
+    def session():
+        return SmtpSession(sink.host, sink.port, starttls=False)
+
+    # Old path: a fresh connection per email, sent from the request thread
+    baseline_count = max(args.emails // 10, 1)
+    started = time.perf_counter()
+    for i in range(baseline_count):
+        one_shot = session()
+        one_shot.send(build_message("user1@example.com", f"sink{i}@example.com", "Baseline", "body", None))
+        one_shot.close()
+    baseline_rate = baseline_count / (time.perf_counter() - started)
+
+    # New path: queue everything, let the worker pool drain it
+    sink.connections = sink.messages = 0
+    queue_emails(args.emails)
+    outbox = EmailOutbox(workers=args.workers, batch_size=50, poll_interval=0.1, session_factory=session)
+    started = time.perf_counter()
+    outbox.start()
+    while pending():
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    outbox.stop()
+
+    print(f"per-email connection : {baseline_rate:8.1f} emails/s")
+    print(f"outbox, {args.workers} workers   : {args.emails / elapsed:8.1f} emails/s "
+          f"({sink.messages} delivered over {sink.connections} SMTP connections, stats {outbox.stats})")
+    sink.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# benchmarks/history_rows.py - Transfer size and per-row memory of the message history pages
+#
+# Gives user1 a history of long emails to user2, then loads pages of it two
+# ways: with the full content of every row, as the list views used to, and
+# through app.get_messages, which returns a preview, the body size and the
+# attachment flag as MessageSummary records. Reports the text size of each
+# page, the Python memory held per row, and query latency.
+#
+#   python benchmarks/history_rows.py --emails 2000 --body-kb 40
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+
+from common import VOCABULARY, percentile, use_bench_database
+
+from db import get_db_connection
+
+# get_messages before it returned previews: the same index scans, with
+# every body and attachment path
+FULL_ROWS = """
+SELECT m.id, sender.username, receiver.username, m.message_type, m.content, m.attachment_path, m.status, m.created_at
+FROM (
+    (SELECT id, sender_id, receiver_id, message_type, content, attachment_path, status, created_at
+     FROM messages WHERE sender_id = %(user_id)s
+     ORDER BY created_at DESC, id DESC LIMIT %(limit)s)
+    UNION ALL
+    (SELECT id, sender_id, receiver_id, message_type, content, attachment_path, status, created_at
+     FROM messages WHERE receiver_id = %(user_id)s AND sender_id IS DISTINCT FROM %(user_id)s
+     ORDER BY created_at DESC, id DESC LIMIT %(limit)s)
+) m
+JOIN users sender ON m.sender_id = sender.id
+JOIN users receiver ON m.receiver_id = receiver.id
+ORDER BY m.created_at DESC, m.id DESC
+LIMIT %(limit)s
+"""
+
+MARKER = "history-rows-bench"
+
+
+def user_id(username):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE username = %s", (username,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    if row is None:
+        raise SystemExit(f"{username} is missing from the bench database; run benchmarks/suite.py once to seed it")
+    return row[0]
+
+
+def seed(sender_id, receiver_id, emails, body_kb, rng):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    rows = []
+    for i in range(emails):
+        words = []
+        size = 0
+        while size < body_kb * 1024:
+            word = rng.choice(VOCABULARY)
+            words.append(word)
+            size += len(word) + 1
+        rows.append((sender_id, receiver_id, f"{MARKER} {i}", " ".join(words)))
+    cur.executemany("""
+    INSERT INTO messages (sender_id, receiver_id, message_type, subject, content, status)
+    VALUES (%s, %s, 'email', %s, %s, 'sent')
+    """, rows)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def cleanup():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM messages WHERE subject LIKE %s", (MARKER + " %",))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def full_rows(user, limit):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(FULL_ROWS, {"user_id": user, "limit": limit})
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+
+def row_bytes(rows):
+    """Approximate payload of the rows: the text length of every value."""
+    return sum(len(str(value)) for row in rows for value in row if value is not None)
+
+
+def measure(load, repeat):
+    load()
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        load()
+        latencies.append(time.perf_counter() - started)
+    tracemalloc.start()
+    rows = load()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return rows, held, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transfer size and per-row memory of the message history pages")
+    parser.add_argument("--emails", type=int, default=1000)
+    parser.add_argument("--body-kb", type=int, default=40, help="size of each email body")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    use_bench_database()
+    import app
+
+    user = user_id("user1")
+    seed(user, user_id("user2"), args.emails, args.body_kb, random.Random(args.seed))
+    try:
+        for limit in (app.PAGE_SIZE + 1, 500):
+            print(f"{limit} rows per page, {args.body_kb} KB email bodies")
+            for label, load in (("full content", lambda: full_rows(user, limit)),
+                                ("preview", lambda: app.get_messages(user, limit=limit))):
+                rows, held, latencies = measure(load, args.repeat)
+                print(f"  {label:<13} {row_bytes(rows) / 1024:9.0f} KB   {held / len(rows):9.0f} B/row   "
+                      f"p50 {percentile(latencies, 50) * 1000:7.2f} ms   p95 {percentile(latencies, 95) * 1000:7.2f} ms")
+            started = time.perf_counter()
+            app.get_message_body(user, app.get_messages(user, limit=1)[0].id)
+            print(f"  {'open one':<13} {(time.perf_counter() - started) * 1000:9.2f} ms (preview page + full body)")
+    finally:
+        cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# benchmarks/notify_latency.py - Delivery latency of pushed events and database load while idle
+#
+# Inserts chat messages and inbound calls one at a time (as the UI and the
+# webhooks do) and measures how long it takes until the EventHub's version
+# for the receiving user changes. Then compares the queries an idle session
+# sends over the same period: the old check_incoming_calls query on every
+# refresh versus the in-memory version check that replaced it (the listener
+# itself sends nothing while idle).
+#
+#   python benchmarks/notify_latency.py --events 200 --idle-seconds 10
+
+import argparse
+import statistics
+import time
+
+from common import use_bench_database
+
+from db import get_db_connection, pool_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LISTEN/NOTIFY delivery latency and idle database load")
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--idle-seconds", type=float, default=10.0)
+    parser.add_argument("--interval", type=float, default=0.5, help="UI refresh interval being compared")
+    args = parser.parse_args()
+
+    use_bench_database()
+    from notifications import get_event_hub
+
+    hub = get_event_hub()
+    if not hub.wait_listening():
+        raise SystemExit("event listener did not connect")
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE username = 'user1'")
+    sender_id = cur.fetchone()[0]
+    cur.execute("SELECT id FROM users WHERE username = 'user2'")
+    receiver_id = cur.fetchone()[0]
+
+    latencies = {"chat": [], "call": []}
+    created = {"chat": [], "call": []}
+    for i in range(args.events):
+        kind = "chat" if i % 2 == 0 else "call"
+        topic = f"chat:{sender_id}" if kind == "chat" else "calls"
+        before = hub.version(receiver_id, topic)
+        started = time.perf_counter()
+        if kind == "chat":
+            cur.execute("""
+            INSERT INTO messages (sender_id, receiver_id, message_type, content, status)
+            VALUES (%s, %s, 'chat', 'notify benchmark', 'sent') RETURNING id
+            """, (sender_id, receiver_id))
+        else:
+            cur.execute("""
+            INSERT INTO calls (caller_id, receiver_id, status, direction)
+            VALUES (%s, %s, 'ongoing', 'inbound') RETURNING id
+            """, (sender_id, receiver_id))
+        created[kind].append(cur.fetchone()[0])
+        conn.commit()
+        while hub.version(receiver_id, topic) == before:
+            if time.perf_counter() - started > 5:
+                raise SystemExit(f"no {kind} event within 5s")
+            time.sleep(0.0002)
+        latencies[kind].append(time.perf_counter() - started)
+
+    for kind, values in latencies.items():
+        values.sort()
+        print(f"{kind:5}: {len(values)} events, insert+commit to delivery "
+              f"p50 {statistics.median(values) * 1000:.2f} ms, "
+              f"p99 {values[int(len(values) * 0.99) - 1] * 1000:.2f} ms, max {values[-1] * 1000:.2f} ms")
+
+    # One idle session checking for incoming calls every interval, both ways
+    checks = int(args.idle_seconds / args.interval)
+    for label, check in (
+        ("query per refresh", lambda: poll_incoming_call(receiver_id)),
+        ("pushed events", lambda: hub.version(receiver_id, "calls")),
+    ):
+        before = pool_stats()["checkouts"]
+        started = time.perf_counter()
+        for _ in range(checks):
+            check()
+            time.sleep(args.interval)
+        print(f"idle {time.perf_counter() - started:.1f}s, {label:17}: "
+              f"{pool_stats()['checkouts'] - before} database queries")
+
+    cur.execute("DELETE FROM messages WHERE id = ANY(%s)", (created["chat"],))
+    cur.execute("DELETE FROM calls WHERE id = ANY(%s)", (created["call"],))
+    conn.commit()
+    cur.close()
+    conn.close()
+    print(f"listener stats: {hub.stats}")
+
+
+def poll_incoming_call(user_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT c.id, u.username, u.phone_number
+    FROM calls c
+    JOIN users u ON c.caller_id = u.id
+    WHERE c.receiver_id = %s AND c.status = 'ongoing' AND c.direction = 'inbound'
+    AND c.end_time IS NULL
+    ORDER BY c.start_time DESC
+    LIMIT 1
+    """, (user_id,))
+    cur.fetchone()
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
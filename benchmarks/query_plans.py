@@ -0,0 +1,176 @@
+# benchmarks/query_plans.py - Query-plan regression checks for the hot lookups
+#
+# Seeds a large scratch dataset, runs the app's read functions while
+# recording the SQL they issue, and EXPLAIN ANALYZEs every statement. A check
+# fails when a hot table is read with a sequential scan or when a statement
+# blows its latency budget. tests/test_query_plans.py runs the same checks
+# under pytest against a smaller dataset.
+#
+#   python benchmarks/query_plans.py --messages 2000000 --budget-ms 50
+
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta
+
+from common import use_bench_database, seed
+
+import psycopg2
+from psycopg2 import extensions
+from db import ConnectionPool, get_db_settings
+
+recorded = []
+
+
+class RecordingCursor(extensions.cursor):
+    """Cursor that remembers every statement it runs, parameters bound in."""
+
+    def execute(self, query, vars=None):
+        recorded.append(self.mogrify(query, vars).decode())
+        return super().execute(query, vars)
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(cur, statement):
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement)
+    result = cur.fetchone()[0]
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]
+
+
+def build_checks(app, heavy_id, light_id):
+    """
+    (name, callable, tables that must not be sequentially scanned). Nothing
+    runs until a callable is called, so the names are known up front.
+    """
+    older = datetime.now() - timedelta(days=180)
+    return [
+        ("get_messages heavy user", lambda: app.get_messages(heavy_id), {"messages"}),
+        ("get_messages heavy user sms", lambda: app.get_messages(heavy_id, "sms"), {"messages"}),
+        ("get_messages heavy user chat", lambda: app.get_messages(heavy_id, "chat"), {"messages"}),
+        ("get_messages light user", lambda: app.get_messages(light_id), {"messages"}),
+        ("get_messages heavy user older page", lambda: app.get_messages(heavy_id, before=(older, 0)), {"messages"}),
+        ("get_calls heavy user", lambda: app.get_calls(heavy_id), {"calls"}),
+        ("get_calls heavy user older page", lambda: app.get_calls(heavy_id, before=(older, 0)), {"calls"}),
+        ("get_calls heavy user outbound", lambda: app.get_calls(heavy_id, "outbound"), {"calls"}),
+        ("get_timeline heavy user", lambda: app.get_timeline(heavy_id), {"messages", "calls"}),
+        ("get_timeline heavy user older page",
+         lambda: app.get_timeline(heavy_id, before=(older, app.TIMELINE_CALL, 0)), {"messages", "calls"}),
+        ("get_message_body", lambda: app.get_message_body(heavy_id, app.get_messages(heavy_id, limit=1)[0].id), {"messages"}),
+        ("get_chat_thread", lambda: app.get_chat_thread(heavy_id, light_id), {"messages"}),
+        ("get_chat_thread delta", lambda: app.get_chat_thread(heavy_id, light_id, after_id=1), {"messages"}),
+        ("get_incoming_calls", lambda: app.get_incoming_calls(), {"calls"}),
+        ("check_incoming_calls", lambda: app.check_incoming_calls(light_id), {"calls"}),
+        ("get_conversations heavy user", lambda: app.get_conversations(heavy_id), {"conversations"}),
+        ("get_conversations heavy user sms", lambda: app.get_conversations(heavy_id, "sms"), {"conversations"}),
+        ("get_conversations heavy user older page",
+         lambda: app.get_conversations(heavy_id, before=(older, 0)), {"conversations"}),
+        ("search_messages light user", lambda: app.search_messages(light_id, "meeting"), {"messages"}),
+        ("user by phone number", lambda: lookup("SELECT id FROM users WHERE phone_number = %s", ("+15550000042",)), {"users"}),
+        ("user by email", lambda: lookup("SELECT id FROM users WHERE email = %s", ("bench42@example.com",)), {"users"}),
+    ]
+
+
+CHECK_NAMES = [name for name, _, _ in build_checks(None, None, None)]
+
+plan_pool = None
+
+
+def lookup(sql, params):
+    conn = plan_pool.getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        cur.fetchall()
+        cur.close()
+    finally:
+        conn.close()
+
+
+def record_app_queries(app):
+    """Route app's connections through a pool of RecordingCursors."""
+    global plan_pool
+    plan_pool = ConnectionPool(minconn=1, maxconn=2, cursor_factory=RecordingCursor, **get_db_settings())
+    app.get_db_connection = lambda timeout=None: plan_pool.getconn(timeout)
+    return plan_pool
+
+
+def check_plans(explain_conn, run, guarded_tables, budget_ms):
+    """
+    Call `run` and EXPLAIN ANALYZE every read it issued. Returns a list of
+    (statement, execution ms, indexes used, problems) per statement.
+    """
+    del recorded[:]
+    run()
+    statements = [s for s in recorded if s.lstrip().upper().startswith(("SELECT", "WITH", "("))]
+
+    results = []
+    cur = explain_conn.cursor()
+    for statement in statements:
+        plan = explain(cur, statement)
+        explain_conn.rollback()
+        nodes = list(plan_nodes(plan["Plan"]))
+        seq_scans = sorted({n["Relation Name"] for n in nodes
+                            if n["Node Type"] == "Seq Scan" and n.get("Relation Name") in guarded_tables})
+        indexes = sorted({n["Index Name"] for n in nodes if "Index Name" in n})
+        elapsed = plan["Execution Time"]
+
+        problems = []
+        if seq_scans:
+            problems.append("seq scan on " + ", ".join(seq_scans))
+        if not indexes:
+            problems.append("no index used")
+        if elapsed > budget_ms:
+            problems.append("%.1f ms over %.1f ms budget" % (elapsed, budget_ms))
+        results.append((statement, elapsed, indexes, problems))
+    cur.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query-plan regression checks for the hot lookups")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--budget-ms", type=float, default=50.0,
+                        help="max execution time per statement (EXPLAIN ANALYZE)")
+    parser.add_argument("--reseed", action="store_true")
+    args = parser.parse_args()
+
+    use_bench_database()
+    heavy_id = seed(args.users, args.messages, args.calls, reseed=args.reseed)
+
+    import app
+
+    record_app_queries(app)
+
+    explain_conn = psycopg2.connect(**get_db_settings())
+    explain_cur = explain_conn.cursor()
+    explain_cur.execute("SELECT id FROM users WHERE username = 'bench42'")
+    light_id = explain_cur.fetchone()[0]
+    explain_cur.close()
+
+    failures = 0
+    for name, run, guarded_tables in build_checks(app, heavy_id, light_id):
+        for _, elapsed, indexes, problems in check_plans(explain_conn, run, guarded_tables, args.budget_ms):
+            status = "FAIL" if problems else "ok"
+            print("%-4s %-36s %8.2f ms  %s" % (status, name, elapsed, ", ".join(indexes) or "-"))
+            for problem in problems:
+                print("       " + problem)
+            failures += bool(problems)
+
+    explain_conn.close()
+    plan_pool.closeall()
+
+    print("\n%d failing statement(s)" % failures)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# benchmarks/search.py - Full-text search latency on a large messages table
+#
+# Seeds a multi-million-row scratch dataset, then times search_messages()
+# (first page and a deeper page via the keyset cursor) for a heavy and a
+# light user over common, combined, phrase, rare and missing terms, and
+# shows which indexes the plan uses. For scale, the same common-word search
+# is also run once the way it would have to be done without the tsvector
+# column: ILIKE over the user's messages.
+#
+#   python benchmarks/search.py --messages 2000000 --repeat 20
+
+import argparse
+import json
+import time
+
+from common import use_bench_database, seed, percentile, time_calls
+
+from db import get_db_connection
+
+
+def plan_indexes(cur, sql, params):
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    result = cur.fetchone()[0]
+    plan = (json.loads(result) if isinstance(result, str) else result)[0]["Plan"]
+    found, stack = set(), [plan]
+    while stack:
+        node = stack.pop()
+        if "Index Name" in node:
+            found.add(node["Index Name"])
+        stack.extend(node.get("Plans", []))
+    return sorted(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-text search latency on a large messages table")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--reseed", action="store_true")
+    args = parser.parse_args()
+
+    use_bench_database()
+    heavy_id = seed(args.users, args.messages, args.calls, reseed=args.reseed)
+
+    import app
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM messages")
+    total = cur.fetchone()[0]
+    cur.execute("SELECT id FROM users WHERE username = 'bench42'")
+    light_id = cur.fetchone()[0]
+    # A term that occurs in exactly one of the heavy user's messages
+    cur.execute("""
+    SELECT substring(content from '[0-9a-f]{32}$') FROM messages
+    WHERE sender_id = %s AND content ~ '[a-z] [0-9a-f]{32}$' ORDER BY created_at DESC LIMIT 1
+    """, (heavy_id,))
+    rare = cur.fetchone()[0]
+    conn.rollback()
+
+    queries = [
+        ("common word", "meeting"),
+        ("two words", "invoice payment"),
+        ("phrase", '"flight hotel"'),
+        ("rare term", rare),
+        ("no match", "xylophone"),
+    ]
+    print(f"{total} messages; {args.repeat} runs per search, page size {app.PAGE_SIZE}")
+    for user_label, user_id in (("heavy user", heavy_id), ("light user", light_id)):
+        for label, query in queries:
+            first = app.search_messages(user_id, query, limit=app.PAGE_SIZE + 1)
+            page, cursor = app.split_page(first, app.PAGE_SIZE, cursor_of=app.search_cursor)
+            timings = time_calls(lambda: app.search_messages(user_id, query, limit=app.PAGE_SIZE + 1), args.repeat)
+            line = (f"{user_label} {label:12} {len(page):3} hits on page 1  "
+                    f"p50 {percentile(timings, 50) * 1000:7.2f} ms  p95 {percentile(timings, 95) * 1000:7.2f} ms")
+            if cursor:
+                timings = time_calls(
+                    lambda: app.search_messages(user_id, query, before=cursor, limit=app.PAGE_SIZE + 1), args.repeat
+                )
+                line += f"  page 2 p50 {percentile(timings, 50) * 1000:7.2f} ms"
+            print(line)
+
+    cur.execute("""
+    SELECT id FROM messages, websearch_to_tsquery('english', %(q)s) q
+    WHERE search_vector @@ q AND (sender_id = %(u)s OR receiver_id = %(u)s)
+    """, {"q": "meeting", "u": heavy_id})
+    matches = cur.rowcount
+    print("plan for heavy user common word:", ", ".join(plan_indexes(cur, """
+    SELECT id FROM messages, websearch_to_tsquery('english', %(q)s) q
+    WHERE search_vector @@ q AND (sender_id = %(u)s OR receiver_id = %(u)s)
+    """, {"q": "meeting", "u": heavy_id})) or "no index")
+
+    started = time.perf_counter()
+    cur.execute("""
+    SELECT COUNT(*) FROM messages
+    WHERE (content ILIKE %(q)s OR subject ILIKE %(q)s) AND (sender_id = %(u)s OR receiver_id = %(u)s)
+    """, {"q": "%meeting%", "u": heavy_id})
+    ilike_matches = cur.fetchone()[0]
+    print(f"heavy user 'meeting': {matches} tsvector matches; ILIKE without ranking or snippets "
+          f"({ilike_matches} substring matches) took {(time.perf_counter() - started) * 1000:.1f} ms")
+    conn.rollback()
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+# benchmarks/status_callbacks.py - Twilio status-callback throughput and coalescing
+#
+# Creates outbound messages and calls with Twilio SIDs, then posts the
+# callbacks Twilio would send for them (sent, delivered, read per message;
+# initiated, ringing, in-progress, completed per call) from concurrent
+# clients over real HTTP, in a shuffled order. First against a handler that
+# runs one UPDATE and commit per callback, then against the /twilio/*-status
+# routes of webhooks.py, which queue them for the webhook ingestor's coalesced
+# bulk UPDATEs. Both must leave every message 'read' and every call
+# 'completed' with its duration.
+#
+#   python benchmarks/status_callbacks.py --messages 2000 --calls 500 --clients 16
+
+import argparse
+import logging
+import multiprocessing
+import random
+import threading
+import time
+
+import requests
+from flask import Flask, request
+from werkzeug.serving import make_server
+
+from common import percentile, use_bench_database
+
+from db import get_db_connection
+
+MESSAGE_EVENTS = ("sent", "delivered", "read")
+CALL_EVENTS = ("initiated", "ringing", "in-progress", "completed")
+
+legacy_app = Flask("legacy_status")
+
+
+@legacy_app.route("/twilio/message-status", methods=["POST"])
+def legacy_message_status():
+    # One statement and commit per callback; a late 'sent' must not undo 'read'
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    UPDATE messages SET status = %s
+    WHERE twilio_sid = %s AND array_position(ARRAY['queued', 'sending', 'sent', 'delivered', 'read'], status)
+                              <= array_position(ARRAY['queued', 'sending', 'sent', 'delivered', 'read'], %s)
+    """, (request.form["MessageStatus"], request.form["MessageSid"], request.form["MessageStatus"]))
+    conn.commit()
+    cur.close()
+    conn.close()
+    return '', 204
+
+
+@legacy_app.route("/twilio/call-status", methods=["POST"])
+def legacy_call_status():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if request.form["CallStatus"] == "completed":
+        cur.execute("UPDATE calls SET status = 'completed', end_time = NOW(), duration = %s WHERE call_sid = %s",
+                    (int(request.form["CallDuration"]), request.form["CallSid"]))
+    elif request.form["CallStatus"] == "in-progress":
+        cur.execute("UPDATE calls SET answered_at = COALESCE(answered_at, NOW()) WHERE call_sid = %s",
+                    (request.form["CallSid"],))
+    conn.commit()
+    cur.close()
+    conn.close()
+    return '', 204
+
+
+def serve(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def create(run, messages, calls):
+    """`messages` sent SMS and `calls` ongoing calls of user1, with SIDs unique to `run`."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE username = 'user1'")
+    user_id = cur.fetchone()[0]
+    cur.execute("""
+    INSERT INTO messages (sender_id, message_type, content, to_address, status, twilio_sid)
+    SELECT %s, 'sms', 'Status callback benchmark', '+15550100', 'sent', %s || i
+    FROM generate_series(1, %s) AS i
+    """, (user_id, f"SMcb{run}x", messages))
+    cur.execute("""
+    INSERT INTO calls (caller_id, receiver_phone, start_time, status, direction, call_sid)
+    SELECT %s, '+15550100', NOW(), 'ongoing', 'outbound', %s || i
+    FROM generate_series(1, %s) AS i
+    """, (user_id, f"CAcb{run}x", calls))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def callbacks(run, messages, calls, rng):
+    """Every callback for the run's SIDs, each SID's events in order but interleaved with the rest."""
+    streams = [[("/twilio/message-status", {"MessageSid": f"SMcb{run}x{i}", "MessageStatus": event})
+                for event in MESSAGE_EVENTS] for i in range(1, messages + 1)]
+    streams += [[("/twilio/call-status", {"CallSid": f"CAcb{run}x{i}", "CallStatus": event, "CallDuration": "42"})
+                 for event in CALL_EVENTS] for i in range(1, calls + 1)]
+    posts = []
+    while streams:
+        stream = streams[rng.randrange(len(streams))]
+        posts.append(stream.pop(0))
+        if not stream:
+            streams.remove(stream)
+    return posts
+
+
+def client(base_url, posts):
+    session = requests.Session()
+    latencies = []
+    for path, form in posts:
+        started = time.perf_counter()
+        response = session.post(base_url + path, data=form, timeout=30)
+        latencies.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return latencies
+
+
+def post_callbacks(base_url, posts, clients):
+    """
+    Post from `clients` processes. A SID's callbacks all go through the same
+    client, so they are sent in order as Twilio would. Returns (elapsed, latencies).
+    """
+    shards = [[] for _ in range(clients)]
+    for path, form in posts:
+        sid = form.get("MessageSid") or form["CallSid"]
+        shards[hash(sid) % clients].append((path, form))
+    with multiprocessing.get_context("fork").Pool(clients) as pool:
+        started = time.perf_counter()
+        results = pool.starmap(client, [(base_url, shard) for shard in shards])
+        elapsed = time.perf_counter() - started
+    return elapsed, [latency for latencies in results for latency in latencies]
+
+
+def outcome(run):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT status, COUNT(*) FROM messages WHERE twilio_sid LIKE %s GROUP BY status", (f"SMcb{run}x%",))
+    messages = dict(cur.fetchall())
+    cur.execute("""
+    SELECT status, COUNT(*) FILTER (WHERE duration = 42 AND answered_at IS NOT NULL AND end_time IS NOT NULL)
+    FROM calls WHERE call_sid LIKE %s GROUP BY status
+    """, (f"CAcb{run}x%",))
+    calls = dict(cur.fetchall())
+    cur.close()
+    conn.close()
+    return messages, calls
+
+
+def cleanup(runs):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    for run in runs:
+        cur.execute("DELETE FROM messages WHERE twilio_sid LIKE %s", (f"SMcb{run}x%",))
+        cur.execute("DELETE FROM calls WHERE call_sid LIKE %s", (f"CAcb{run}x%",))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def report(label, sent, elapsed, latencies):
+    print(f"{label:<12} {sent / elapsed:8.0f} callbacks/s   ack p50 {percentile(latencies, 50) * 1000:6.2f} ms"
+          f"   p99 {percentile(latencies, 99) * 1000:6.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Twilio status-callback throughput and coalescing")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    use_bench_database()
+    import webhooks
+    from webhook_ingest import get_webhook_ingestor
+
+    rng = random.Random(args.seed)
+    runs = (f"{int(time.time())}a", f"{int(time.time())}b")
+    for run, flask_app, label in ((runs[0], legacy_app, "per-callback"), (runs[1], webhooks.flask_app, "coalesced")):
+        create(run, args.messages, args.calls)
+        posts = callbacks(run, args.messages, args.calls, rng)
+        server = serve(flask_app)
+        elapsed, latencies = post_callbacks(f"http://127.0.0.1:{server.server_port}", posts, args.clients)
+        server.shutdown()
+        report(label, len(posts), elapsed, latencies)
+        if flask_app is webhooks.flask_app:
+            ingestor = get_webhook_ingestor()
+            while ingestor.pending():
+                time.sleep(0.01)
+            ingestor.stop()
+            print(f"{'':<12} ingestor stats {ingestor.stats}")
+        messages, calls = outcome(run)
+        print(f"{'':<12} messages {messages}, calls {calls} (calls with answer, end and duration)")
+
+    cleanup(runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+# benchmarks/stubs.py - Local stand-ins for the external services
+#
+# Small in-process servers that speak just enough of each protocol for the
+# app's clients: an IMAP4rev1 mailbox for mail_sync, an SMTP sink for
+# outbound_email and the slice of the Twilio REST API used by
+# twilio_dispatch. Each server runs in a background thread on 127.0.0.1 and an
+# ephemeral port.
+
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+import email.utils
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+class _ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _StubServer:
+    handler = None
+
+    def start(self):
+        self.server = _ThreadedTCPServer(("127.0.0.1", 0), self.handler)
+        self.server.stub = self
+        self.host, self.port = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_email(index, attachment_size=0, html=False):
+    """Build a raw RFC 822 message, optionally with an attachment of `attachment_size` bytes."""
+    msg = MIMEMultipart()
+    msg["From"] = f"Sender {index} <sender{index}@example.com>"
+    msg["To"] = "user1@example.com"
+    msg["Subject"] = f"Stub message {index}"
+    msg["Date"] = email.utils.formatdate(localtime=True)
+    msg["Message-ID"] = email.utils.make_msgid()
+    body = f"Body of stub message {index}. " * 20
+    msg.attach(MIMEText(f"<p>{body}</p>" if html else body, "html" if html else "plain"))
+    if attachment_size:
+        part = MIMEApplication(b"x" * attachment_size, Name=f"file{index}.bin")
+        part["Content-Disposition"] = f'attachment; filename="file{index}.bin"'
+        msg.attach(part)
+    return msg.as_bytes()
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        stub = self.server.stub
+        self.send("* OK IMAP4rev1 stub ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode().rstrip("\r\n").split(" ", 2)
+            tag, command = parts[0], parts[1].upper() if len(parts) > 1 else ""
+            args = parts[2] if len(parts) > 2 else ""
+
+            if command == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1 AUTH=PLAIN")
+            elif command == "LOGIN":
+                stub.logins += 1
+            elif command in ("SELECT", "EXAMINE"):
+                with stub.lock:
+                    self.send(f"* {len(stub.messages)} EXISTS")
+                    self.send(f"* OK [UIDVALIDITY {stub.uidvalidity}] UIDs valid")
+                    self.send(f"* OK [UIDNEXT {stub.next_uid}] Predicted next UID")
+            elif command == "UID":
+                self.uid_command(stub, args)
+            elif command == "LOGOUT":
+                self.send("* BYE stub logging out")
+                self.send(f"{tag} OK LOGOUT completed")
+                return
+            elif command not in ("NOOP", "CLOSE"):
+                self.send(f"{tag} BAD unsupported command")
+                continue
+            self.send(f"{tag} OK {command} completed")
+
+    def uid_command(self, stub, args):
+        subcommand, _, rest = args.partition(" ")
+        with stub.lock:
+            messages = list(stub.messages)
+
+        if subcommand.upper() == "SEARCH":
+            low = int(re.search(r"UID (\d+):\*", rest).group(1))
+            uids = [uid for uid, _ in messages if uid >= low]
+            if not uids and messages:
+                uids = [messages[-1][0]]
+            self.send("* SEARCH " + " ".join(str(uid) for uid in uids))
+            return
+
+        uid_set, _, items = rest.partition(" ")
+        wanted = set()
+        for chunk in uid_set.split(","):
+            low, _, high = chunk.partition(":")
+            wanted.update(range(int(low), int(high or low) + 1))
+
+        for seq, (uid, raw) in enumerate(messages, 1):
+            if uid not in wanted:
+                continue
+            stub.fetches += 1
+            if "HEADER.FIELDS" in items.upper():
+                header_bytes = raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+                names = re.findall(rb'filename="([^"]+)"', raw)
+                structure = " ".join(
+                    '("application" "octet-stream" ("name" "%s") NIL NIL "base64" 0 NIL '
+                    '("attachment" ("filename" "%s")) NIL)' % (n.decode(), n.decode()) for n in names
+                )
+                self.wfile.write(
+                    f"* {seq} FETCH (UID {uid} RFC822.SIZE {len(raw)} BODYSTRUCTURE ({structure} \"mixed\") "
+                    f"BODY[HEADER.FIELDS (FROM TO SUBJECT DATE MESSAGE-ID)] {{{len(header_bytes)}}}\r\n".encode()
+                )
+                self.wfile.write(header_bytes)
+                self.send(")")
+            else:
+                stub.bodies_served += 1
+                self.wfile.write(f"* {seq} FETCH (UID {uid} BODY[] {{{len(raw)}}}\r\n".encode())
+                self.wfile.write(raw)
+                self.send(")")
+
+
+class ImapStub(_StubServer):
+    """
+    Single-mailbox IMAP server (plain TCP, any credentials accepted).
+
+    Counts logins, per-message fetches and full bodies served so callers can
+    check how much traffic a sync caused.
+    """
+
+    handler = _ImapHandler
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []  # (uid, raw bytes), ascending uid
+        self.next_uid = 1
+        self.lock = threading.Lock()
+        self.logins = 0
+        self.fetches = 0
+        self.bodies_served = 0
+
+    def add_message(self, raw):
+        with self.lock:
+            self.messages.append((self.next_uid, raw.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")))
+            self.next_uid += 1
+            return self.next_uid - 1
+
+    def reset_uidvalidity(self, uidvalidity):
+        """Simulate the server renumbering the mailbox."""
+        with self.lock:
+            self.uidvalidity = uidvalidity
+            self.messages = [(uid, raw) for uid, (_, raw) in enumerate(self.messages, 1)]
+            self.next_uid = len(self.messages) + 1
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        stub = self.server.stub
+        with stub.lock:
+            stub.connections += 1
+        # Stands in for the TCP + STARTTLS + AUTH round trips of a real server
+        time.sleep(stub.handshake_delay)
+        self.send("220 stub ESMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().upper()
+
+            if command.startswith("EHLO"):
+                self.send("250-stub")
+                self.send("250 8BITMIME")
+            elif command.startswith("DATA"):
+                self.send("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b".\r\n":
+                        break
+                    size += len(data)
+                time.sleep(stub.message_delay)
+                with stub.lock:
+                    stub.messages += 1
+                    stub.bytes_received += size
+                self.send("250 OK queued")
+            elif command.startswith("QUIT"):
+                self.send("221 bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET, NOOP
+                self.send("250 OK")
+
+
+class SmtpSink(_StubServer):
+    """
+    SMTP server that accepts and discards every message (no TLS, no auth).
+
+    `handshake_delay` is slept once per connection to model the cost of
+    STARTTLS and login; `message_delay` once per message.
+    """
+
+    handler = _SmtpHandler
+
+    def __init__(self, handshake_delay=0.0, message_delay=0.0):
+        self.handshake_delay = handshake_delay
+        self.message_delay = message_delay
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.bytes_received = 0
+
+
+class _TwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse is visible
+    # Headers and body go out as separate writes; without TCP_NODELAY the
+    # client's delayed ACK adds ~40ms to every response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.stub.lock:
+            self.server.stub.connections += 1
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get("Content-Length", 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        time.sleep(stub.latency)
+
+        with stub.lock:
+            stub.requests.append((self.path, form))
+            fail = random.random() < stub.failure_rate
+
+        if fail:
+            self.reply(stub.failure_status, {"code": 20429, "message": "Too Many Requests"})
+        elif self.path.endswith("/Messages.json"):
+            self.reply(201, {"sid": "SM" + uuid.uuid4().hex, "status": "queued", "to": form.get("To")})
+        elif self.path.endswith("/Calls.json"):
+            self.reply(201, {"sid": "CA" + uuid.uuid4().hex, "status": "queued", "to": form.get("To")})
+        elif "/Calls/" in self.path:
+            self.reply(200, {"sid": self.path.rsplit("/", 1)[-1][:-5], "status": form.get("Status")})
+        else:
+            self.reply(404, {"message": "not found"})
+
+
+class TwilioStub:
+    """
+    HTTP stand-in for the Messages and Calls endpoints of the Twilio API.
+
+    Every request is answered after `latency` seconds; a `failure_rate`
+    fraction get `failure_status` instead, to exercise retries. Use
+    `base_url` as TWILIO_API_BASE.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, failure_status=429):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = 0
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _TwilioHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.host, self.port = self.server.server_address
+        self.base_url = f"http://{self.host}:{self.port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,329 @@
+# benchmarks/suite.py - Hot-path benchmark suite with saved results for comparing versions
+#
+# Seeds the scratch database with a fixed random seed, then measures the
+# paths every session and webhook goes through:
+#
+#   - get_messages (first page, next page, SMS only), get_calls and the
+#     All Messages timeline for a heavy user, opening one message's body, and an SMS page rerun served
+#     by the query cache
+#   - loading a chat thread and fetching its delta
+#   - /webhook/sms and /incoming-call over real HTTP from concurrent clients
+#   - syncing new mail from a local IMAP stand-in and listing the inbox
+#
+# Each case reports throughput and p50/p95/p99 latency. Results are written
+# as JSON (with the git revision and dataset sizes) to benchmarks/results/,
+# and --compare prints the change against an earlier file and exits non-zero
+# when a p95 got worse by more than --tolerance percent.
+#
+#   python benchmarks/suite.py --label baseline
+#   python benchmarks/suite.py --compare benchmarks/results/baseline.json
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from werkzeug.serving import make_server
+
+from common import ROOT, percentile, seed, time_calls, use_bench_database
+from stubs import ImapStub, make_email
+
+from db import get_db_connection, pool_stats
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+
+def summarize(durations, elapsed=None):
+    """Throughput (operations/s) and latency percentiles (ms) of a list of durations in seconds."""
+    elapsed = elapsed if elapsed is not None else sum(durations)
+    return {
+        "count": len(durations),
+        "throughput": len(durations) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(durations, 50) * 1000,
+        "p95_ms": percentile(durations, 95) * 1000,
+        "p99_ms": percentile(durations, 99) * 1000,
+    }
+
+
+def measure(fn, repeat, warmup=3):
+    for _ in range(warmup):
+        fn()
+    return summarize(time_calls(fn, repeat))
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + ("-dirty" if dirty else "")
+
+
+def serve(flask_app):
+    server = make_server("127.0.0.1", 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def post_webhooks(url, forms, clients):
+    """POST every form from `clients` threads; returns (per-request seconds, wall time)."""
+    local = threading.local()
+
+    def post(form):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        response = session.post(url, data=form)
+        duration = time.perf_counter() - started
+        response.raise_for_status()
+        return duration
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        durations = list(pool.map(post, forms))
+    return durations, time.perf_counter() - started
+
+
+def query_cases(app, heavy_id, repeat):
+    results = {}
+    first = app.get_messages(heavy_id, limit=app.PAGE_SIZE + 1)
+    _, cursor = app.split_page(first, app.PAGE_SIZE)
+    results["get_messages"] = measure(lambda: app.get_messages(heavy_id, limit=app.PAGE_SIZE + 1), repeat)
+    results["get_messages_page2"] = measure(
+        lambda: app.get_messages(heavy_id, before=cursor, limit=app.PAGE_SIZE + 1), repeat
+    )
+    results["get_messages_sms"] = measure(
+        lambda: app.get_messages(heavy_id, message_type="sms", limit=app.PAGE_SIZE + 1), repeat
+    )
+    results["get_calls"] = measure(lambda: app.get_calls(heavy_id, limit=app.PAGE_SIZE + 1), repeat)
+    results["all_messages"] = measure(lambda: app.get_timeline(heavy_id, limit=app.PAGE_SIZE + 1), repeat)
+    results["message_body"] = measure(lambda: app.get_message_body(heavy_id, first[0].id), repeat)
+
+    # An idle rerun of the SMS history: answered by the query cache without touching the database
+    from notifications import get_event_hub
+    from query_cache import get_query_cache
+    if get_event_hub().wait_listening():
+        queries = get_query_cache()
+        checkouts = pool_stats()["checkouts"]
+        results["get_messages_cached"] = measure(
+            lambda: queries.fetch(heavy_id, "sms", app.get_messages, heavy_id, "sms", limit=app.PAGE_SIZE + 1), repeat
+        )
+        results["get_messages_cached"]["queries"] = pool_stats()["checkouts"] - checkouts
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT CASE WHEN sender_id = %(u)s THEN receiver_id ELSE sender_id END AS peer
+    FROM messages
+    WHERE message_type = 'chat' AND (sender_id = %(u)s OR receiver_id = %(u)s)
+    GROUP BY peer ORDER BY COUNT(*) DESC, peer LIMIT 1
+    """, {"u": heavy_id})
+    peer_id = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    thread = app.get_chat_thread(heavy_id, peer_id)
+    newest = thread[-1].id
+    results["chat_thread"] = measure(lambda: app.get_chat_thread(heavy_id, peer_id), repeat)
+    results["chat_thread_delta"] = measure(lambda: app.get_chat_thread(heavy_id, peer_id, after_id=newest), repeat)
+    return results
+
+
+def webhook_cases(webhooks, count, clients):
+    from webhook_ingest import get_webhook_ingestor
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT phone_number FROM users WHERE username IN ('user1', 'user2') ORDER BY username")
+    from_phone, to_phone = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+
+    run = uuid.uuid4().hex[:12]
+    sms_forms = [{"MessageSid": f"SMsuite{run}{i:08d}", "From": from_phone, "To": to_phone,
+                  "Body": f"Suite webhook {i}"} for i in range(count)]
+    call_forms = [{"CallSid": f"CAsuite{run}{i:08d}", "From": from_phone} for i in range(count)]
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    results = {}
+    server = serve(webhooks.flask_app)
+    try:
+        for name, path, forms in (
+            ("webhook_sms", "/webhook/sms", sms_forms),
+            ("incoming_call", "/incoming-call", call_forms),
+        ):
+            url = f"http://127.0.0.1:{server.server_port}{path}"
+            post_webhooks(url, forms[:20], clients)  # warm up connections and caches
+            # incoming_call prints every caller; keep that out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                durations, elapsed = post_webhooks(url, forms[20:], clients)
+            results[name] = summarize(durations, elapsed)
+    finally:
+        server.shutdown()
+
+    ingestor = get_webhook_ingestor()
+    deadline = time.monotonic() + 60
+    while ingestor.pending() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    ingestor.stop()
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM messages WHERE twilio_sid LIKE %s", (f"SMsuite{run}%",))
+    stored_sms = cur.rowcount
+    cur.execute("DELETE FROM calls WHERE call_sid LIKE %s", (f"CAsuite{run}%",))
+    stored_calls = cur.rowcount
+    conn.commit()
+    cur.close()
+    conn.close()
+    if stored_sms != count or stored_calls != count:
+        raise SystemExit(f"webhooks lost events: {stored_sms}/{count} SMS, {stored_calls}/{count} calls stored")
+    return results
+
+
+def mail_cases(emails, batches, repeat):
+    from mail_sync import MailSync, get_inbox_emails
+
+    stub = ImapStub().start()
+    mailbox = f"suite-{uuid.uuid4().hex[:12]}"
+    sync = MailSync(stub.host, stub.port, "bench", "bench", mailbox=mailbox, use_ssl=False,
+                    prefetch_bytes=64 * 1024)
+    results = {}
+    try:
+        stub.add_message(make_email(0))
+        sync.sync()  # records the mailbox's UID state, as a long-running app has
+
+        # Mail arriving between refreshes, synced in `batches` rounds
+        per_batch = max(emails // batches, 1)
+        durations = []
+        for batch in range(batches):
+            for i in range(per_batch):
+                index = 1 + batch * per_batch + i
+                stub.add_message(make_email(index, html=index % 3 == 0))
+            started = time.perf_counter()
+            if sync.sync() != per_batch:
+                raise SystemExit("mail sync missed messages")
+            durations.append(time.perf_counter() - started)
+        results["fetch_emails"] = summarize(durations)
+        results["fetch_emails"]["messages_per_second"] = per_batch * batches / sum(durations)
+        results["fetch_emails_idle"] = measure(sync.sync, repeat)
+        results["inbox_page"] = measure(lambda: get_inbox_emails(mailbox), repeat)
+    finally:
+        sync.close()
+        stub.stop()
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM messages WHERE imap_mailbox = %s", (mailbox,))
+        cur.execute("DELETE FROM mailbox_sync_state WHERE mailbox = %s", (mailbox,))
+        conn.commit()
+        cur.close()
+        conn.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every case against `baseline`; returns the names of cases whose p95 regressed."""
+    regressed = []
+    print(f"\nagainst {baseline['label']} ({baseline['revision']}, {baseline['timestamp']}):")
+    for name, current in results["cases"].items():
+        before = baseline["cases"].get(name)
+        if before is None:
+            print(f"  {name:20} new")
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms", "throughput"):
+            change = (current[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            changes.append(f"{key} {change:+6.1f}%")
+        worse = before["p95_ms"] and (current["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100 > tolerance
+        if worse:
+            regressed.append(name)
+        print(f"  {name:20} " + "  ".join(changes) + ("  REGRESSED" if worse else ""))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the messaging hot paths and compare with earlier runs")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--reseed", action="store_true", help="drop and recreate the synthetic rows")
+    parser.add_argument("--random-seed", type=float, default=0.42, help="setseed() value used while seeding")
+    parser.add_argument("--repeat", type=int, default=50, help="runs per query case")
+    parser.add_argument("--webhooks", type=int, default=2000, help="requests per webhook case")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent webhook clients")
+    parser.add_argument("--emails", type=int, default=500, help="new messages synced from the IMAP stand-in")
+    parser.add_argument("--email-batches", type=int, default=10)
+    parser.add_argument("--label", help="name of this run (default: the git revision)")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<label>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=20.0, help="allowed p95 increase in percent")
+    args = parser.parse_args()
+
+    use_bench_database()
+    heavy_id = seed(args.users, args.messages, args.calls, reseed=args.reseed, random_seed=args.random_seed)
+
+    import app
+    import webhooks
+
+    revision = git_revision()
+    label = args.label or revision
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SHOW server_version")
+    server_version = cur.fetchone()[0]
+    cur.execute("SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM messages), (SELECT COUNT(*) FROM calls)")
+    users, messages, calls = cur.fetchone()
+    cur.close()
+    conn.close()
+
+    cases = {}
+    cases.update(query_cases(app, heavy_id, args.repeat))
+    cases.update(webhook_cases(webhooks, args.webhooks, args.clients))
+    cases.update(mail_cases(args.emails, args.email_batches, args.repeat))
+
+    results = {
+        "label": label,
+        "revision": revision,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "postgres": server_version,
+                        "cpus": os.cpu_count(), "platform": platform.platform()},
+        "dataset": {"users": users, "messages": messages, "calls": calls, "random_seed": args.random_seed},
+        "settings": {"repeat": args.repeat, "webhooks": args.webhooks, "clients": args.clients,
+                     "emails": args.emails, "email_batches": args.email_batches},
+        "cases": cases,
+    }
+
+    print(f"{label} ({revision}): {users} users, {messages} messages, {calls} calls")
+    for name, case in cases.items():
+        print(f"  {name:20} {case['throughput']:9.1f}/s  p50 {case['p50_ms']:8.2f} ms  "
+              f"p95 {case['p95_ms']:8.2f} ms  p99 {case['p99_ms']:8.2f} ms")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{label}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.tolerance)
+        if regressed:
+            raise SystemExit(f"p95 regressed by more than {args.tolerance:.0f}%: {', '.join(regressed)}")
+
+
+if __name__ == "__main__":
+    main()
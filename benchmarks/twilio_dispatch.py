@@ -0,0 +1,80 @@
+# benchmarks/twilio_dispatch.py - SMS dispatch throughput against a local Twilio stand-in
+#
+# Queues SMS jobs in the outbox and lets the dispatcher drain them through
+# the stub API, reporting messages/sec, retries and HTTP connections used.
+#
+#   python benchmarks/twilio_dispatch.py --sms 1000 --workers 8 --mps 200 --latency-ms 40 --failure-rate 0.05
+
+import argparse
+import time
+
+from common import use_bench_database
+from stubs import TwilioStub
+
+from db import get_db_connection
+
+
+def queue_sms(count):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE username = 'user1'")
+    sender_id = cur.fetchone()[0]
+    cur.execute("""
+    WITH inserted AS (
+        INSERT INTO messages (sender_id, receiver_id, message_type, content, status)
+        SELECT %s, %s, 'sms', 'Benchmark SMS ' || g, 'queued'
+        FROM generate_series(1, %s) g
+        RETURNING id
+    )
+    INSERT INTO outbox (kind, payload, message_id)
+    SELECT 'sms', jsonb_build_object('from', '+15550000000', 'to', '+15550000001', 'body', 'Benchmark SMS'), id
+    FROM inserted
+    """, (sender_id, sender_id, count))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def pending():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('queued', 'sending')")
+    count = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMS dispatch throughput against a local Twilio stand-in")
+    parser.add_argument("--sms", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--mps", type=float, default=200.0, help="messages/sec rate limit")
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="stub API response time")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="fraction of requests answered with 429")
+    args = parser.parse_args()
+
+    use_bench_database()
+    from twilio_dispatch import TwilioApi, TwilioDispatcher
+
+    stub = TwilioStub(latency=args.latency_ms / 1000.0, failure_rate=args.failure_rate).start()
+    api = TwilioApi("ACbench", "token", base_url=stub.base_url, pool_size=args.workers)
+    dispatcher = TwilioDispatcher(api, workers=args.workers, messages_per_second=args.mps,
+                                  max_attempts=10, poll_interval=0.05, backoff_base=0.05)
+
+    queue_sms(args.sms)
+    started = time.perf_counter()
+    dispatcher.start()
+    while pending():
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    dispatcher.stop()
+
+    print(f"{args.sms} SMS in {elapsed:.2f}s: {args.sms / elapsed:.1f} msg/s "
+          f"(limit {args.mps}/s, {args.workers} workers)")
+    print(f"requests {len(stub.requests)}, HTTP connections {stub.connections}, stats {dispatcher.stats}")
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
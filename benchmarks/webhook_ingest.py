@@ -0,0 +1,150 @@
+# benchmarks/webhook_ingest.py - Inbound SMS webhook throughput and ack latency
+#
+# Posts Twilio-style SMS webhooks at webhooks.py from concurrent clients
+# over real HTTP, first against the old handler (two user lookups and an
+# insert before answering) and then against the write-behind ingestor. A
+# share of the requests are resent with the same MessageSid, as Twilio does
+# when an ack is late, and must not create extra rows.
+#
+#   python benchmarks/webhook_ingest.py --webhooks 5000 --clients 16 --retry-share 0.05
+
+import argparse
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+
+import requests
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from common import percentile, use_bench_database
+
+from db import get_db_connection
+
+legacy_app = Flask("legacy_webhook")
+
+
+@legacy_app.route('/webhook/sms', methods=['POST'])
+def legacy_receive_sms():
+    # The handler as it was before the ingestor: every request waits on the database
+    data = request.form
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE phone_number = %s", (data['From'],))
+    sender = cur.fetchone()
+    cur.execute("SELECT id FROM users WHERE phone_number = %s", (data['To'],))
+    receiver = cur.fetchone()
+    cur.execute("""
+    INSERT INTO messages (sender_id, receiver_id, message_type, content, status)
+    VALUES (%s, %s, 'sms', %s, 'received')
+    """, (sender[0] if sender else None, receiver[0] if receiver else None, data['Body']))
+    conn.commit()
+    cur.close()
+    conn.close()
+    return jsonify({"status": "success"}), 200
+
+
+def serve(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def phones():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT phone_number FROM users WHERE username IN ('user1', 'user2') ORDER BY username")
+    numbers = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return numbers
+
+
+def stored(sids):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM messages WHERE twilio_sid = ANY(%s)", (list(sids),))
+    count = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return count
+
+
+def client(url, index, count, retry_share, from_phone, to_phone):
+    """One client process: post `count` webhooks back to back; returns (ack latencies, sids sent)."""
+    session = requests.Session()
+    latencies, sids = [], []
+    for i in range(count):
+        resend = sids and (i * 7919 + index) % 1000 < retry_share * 1000
+        sid = sids[-1] if resend else "SM" + uuid.uuid4().hex
+        form = {"MessageSid": sid, "From": from_phone, "To": to_phone, "Body": f"Webhook {index}-{i}"}
+        started = time.perf_counter()
+        response = session.post(url, data=form, timeout=30)
+        latencies.append(time.perf_counter() - started)
+        response.raise_for_status()
+        sids.append(sid)
+    return latencies, sids
+
+
+def post_webhooks(url, count, clients, retry_share, from_phone, to_phone):
+    """
+    Send `count` webhooks from `clients` separate processes, so the clients
+    don't compete with the server for the GIL. Returns (elapsed, ack
+    latencies, unique sids).
+    """
+    jobs = [(url, i, count // clients, retry_share, from_phone, to_phone) for i in range(clients)]
+    with multiprocessing.get_context("fork").Pool(clients) as pool:
+        started = time.perf_counter()
+        results = pool.starmap(client, jobs)
+        elapsed = time.perf_counter() - started
+    latencies = [latency for client_latencies, _ in results for latency in client_latencies]
+    sids = {sid for _, client_sids in results for sid in client_sids}
+    return elapsed, latencies, sids
+
+
+def report(label, sent, elapsed, latencies):
+    print(f"{label:<12} {sent / elapsed:8.0f} webhooks/s   ack p50 {percentile(latencies, 50) * 1000:6.2f} ms"
+          f"   p99 {percentile(latencies, 99) * 1000:6.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inbound SMS webhook throughput and ack latency")
+    parser.add_argument("--webhooks", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--retry-share", type=float, default=0.05,
+                        help="fraction of webhooks resent with an already used MessageSid")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    use_bench_database()
+    from webhooks import flask_app
+    from webhook_ingest import get_webhook_ingestor
+
+    from_phone, to_phone = phones()
+    sent = args.webhooks // args.clients * args.clients
+
+    server = serve(legacy_app)
+    elapsed, latencies, _ = post_webhooks(f"http://127.0.0.1:{server.server_port}/webhook/sms",
+                                          sent, args.clients, 0, from_phone, to_phone)
+    server.shutdown()
+    report("synchronous", sent, elapsed, latencies)
+
+    ingestor = get_webhook_ingestor()
+    server = serve(flask_app)
+    elapsed, latencies, sids = post_webhooks(f"http://127.0.0.1:{server.server_port}/webhook/sms",
+                                             sent, args.clients, args.retry_share, from_phone, to_phone)
+    server.shutdown()
+    report("write-behind", sent, elapsed, latencies)
+
+    started = time.perf_counter()
+    while ingestor.pending():
+        time.sleep(0.01)
+    ingestor.stop()
+    print(f"drained {time.perf_counter() - started:.2f}s after the last ack; "
+          f"{stored(sids)} rows for {len(sids)} unique MessageSids out of {sent} webhooks; stats {ingestor.stats}")
+
+
+if __name__ == "__main__":
+    main()
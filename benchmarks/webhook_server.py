@@ -0,0 +1,151 @@
+# benchmarks/webhook_server.py - Webhook requests/sec as the server's worker count grows
+#
+# Starts webhook_server.py with 1, 2, ... worker processes (up to the CPU
+# count by default) on a local port and posts Twilio-style SMS webhooks at it
+# from concurrent client processes over real HTTP. Each run is stopped with
+# SIGTERM right after the last response, and must still have written every
+# acknowledged webhook: that is the graceful shutdown draining the workers'
+# ingestor queues. The clients run on the same machine, so leave them some
+# cores; with as many workers as cores the numbers understate the server.
+#
+#   python benchmarks/webhook_server.py --workers 1,2,4,8 --threads 8 --clients 32 --webhooks 20000
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import requests
+
+from common import ROOT, percentile, use_bench_database
+
+from db import get_db_connection
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, threads, port, verbose):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "webhook_server.py"), "--workers", str(workers),
+         "--threads", str(threads), "--bind", f"127.0.0.1:{port}"],
+        cwd=ROOT, stdout=None if verbose else subprocess.DEVNULL, stderr=None if verbose else subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"webhook_server.py exited with {server.returncode}; rerun with --verbose")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit("webhook_server.py did not start listening within 60s")
+
+
+def client(url, run, index, count, from_phone, to_phone):
+    """One client process posting `count` webhooks back to back; returns (latencies, sids)."""
+    session = requests.Session()
+    latencies, sids = [], []
+    for i in range(count):
+        sid = f"SMsrv{run}{index:03d}{i:07d}"
+        started = time.perf_counter()
+        response = session.post(url, data={"MessageSid": sid, "From": from_phone, "To": to_phone,
+                                           "Body": f"Server webhook {index}-{i}"}, timeout=30)
+        latencies.append(time.perf_counter() - started)
+        response.raise_for_status()
+        sids.append(sid)
+    return latencies, sids
+
+
+def stored(run):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM messages WHERE twilio_sid LIKE %s", (f"SMsrv{run}%",))
+    count = cur.fetchone()[0]
+    cur.execute("DELETE FROM messages WHERE twilio_sid LIKE %s", (f"SMsrv{run}%",))
+    conn.commit()
+    cur.close()
+    conn.close()
+    return count
+
+
+def phones():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT phone_number FROM users WHERE username IN ('user1', 'user2') ORDER BY username")
+    numbers = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return numbers
+
+
+def run_once(workers, args, from_phone, to_phone):
+    port = free_port()
+    server = start_server(workers, args.threads, port, args.verbose)
+    run = uuid.uuid4().hex[:8]
+    url = f"http://127.0.0.1:{port}/webhook/sms"
+    per_client = args.webhooks // args.clients
+    jobs = [(url, run, i, per_client, from_phone, to_phone) for i in range(args.clients)]
+    try:
+        with multiprocessing.get_context("fork").Pool(args.clients) as pool:
+            # Warm up every worker's connections before measuring
+            pool.starmap(client, [(url, "warm" + run, i, 5, from_phone, to_phone) for i in range(args.clients)])
+            started = time.perf_counter()
+            results = pool.starmap(client, jobs)
+            elapsed = time.perf_counter() - started
+    finally:
+        stopping = time.perf_counter()
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=120)
+        shutdown = time.perf_counter() - stopping
+
+    latencies = [latency for client_latencies, _ in results for latency in client_latencies]
+    acknowledged = sum(len(sids) for _, sids in results)
+    stored("warm" + run)
+    return {
+        "workers": workers,
+        "rate": acknowledged / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "acknowledged": acknowledged,
+        "stored": stored(run),
+        "shutdown": shutdown,
+    }
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Webhook requests/sec by number of server worker processes")
+    parser.add_argument("--workers", default=",".join(str(n) for n in sorted({1, 2, max(1, cores // 2), cores})),
+                        help="comma-separated worker counts to try")
+    parser.add_argument("--threads", type=int, default=8, help="threads per worker")
+    parser.add_argument("--clients", type=int, default=16, help="client processes")
+    parser.add_argument("--webhooks", type=int, default=10000, help="webhooks per run")
+    parser.add_argument("--verbose", action="store_true", help="show the server's log")
+    args = parser.parse_args()
+
+    use_bench_database()
+    from_phone, to_phone = phones()
+
+    print(f"{cores} CPUs, {args.threads} threads per worker, {args.clients} clients, {args.webhooks} webhooks per run")
+    baseline = None
+    for workers in (int(n) for n in args.workers.split(",")):
+        result = run_once(workers, args, from_phone, to_phone)
+        baseline = baseline or result["rate"]
+        print(f"{workers:3d} workers  {result['rate']:8.0f} webhooks/s  x{result['rate'] / baseline:4.2f}   "
+              f"p50 {result['p50'] * 1000:6.2f} ms   p99 {result['p99'] * 1000:7.2f} ms   "
+              f"shutdown {result['shutdown']:.2f}s, {result['stored']}/{result['acknowledged']} stored")
+
+
+if __name__ == "__main__":
+    main()
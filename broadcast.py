@@ -0,0 +1,168 @@
+# broadcast.py - One SMS or email to many recipients, persisted in bulk with COPY
+
+import io
+import os
+import re
+from db import get_db_connection
+
+CHANNELS = ("sms", "email")
+
+_PHONE_RE = re.compile(r"^\+?[1-9]\d{6,14}$")
+_PHONE_PUNCTUATION_RE = re.compile(r"[\s().-]")
+_EMAIL_RE = re.compile(r"^[^@\s\\]+@[^@\s\\]+\.[^@\s\\]+$")
+
+# Message statuses that still have a delivery attempt ahead of them
+PENDING_STATUSES = ("queued", "sending")
+
+
+def normalize_recipients(channel, recipients):
+    """
+    Clean up a recipient list for `channel`.
+
+    Phone numbers lose spaces, dashes, dots and parentheses; email addresses
+    are lowercased. Returns (addresses in first-seen order without
+    duplicates, number rejected as invalid, number of duplicates dropped).
+    """
+    if channel not in CHANNELS:
+        raise ValueError(f"cannot broadcast over {channel!r}")
+    addresses = {}
+    rejected = duplicates = 0
+    for recipient in recipients:
+        recipient = (recipient or "").strip()
+        if channel == "sms":
+            address = _PHONE_PUNCTUATION_RE.sub("", recipient)
+            valid = _PHONE_RE.match(address)
+        else:
+            address = recipient.lower()
+            valid = _EMAIL_RE.match(address)
+        if not valid:
+            rejected += 1
+        elif address in addresses:
+            duplicates += 1
+        else:
+            addresses[address] = None
+    return list(addresses), rejected, duplicates
+
+
+def create_broadcast(sender_id, channel, recipients, content, subject=None):
+    """
+    Queue `content` for every recipient in one transaction.
+
+    The cleaned addresses are streamed into a temporary table with a single
+    COPY; from there one INSERT ... SELECT creates all message rows (resolving
+    registered users by phone number or email on the way) and, for SMS, one
+    more creates their Twilio outbox jobs. The usual workers then deliver
+    them: the TwilioDispatcher pool within its rate limit, the EmailOutbox
+    over reused SMTP sessions. Wake them after this returns.
+
+    Args:
+        sender_id: ID of the sending user
+        channel: 'sms' or 'email'
+        recipients: Iterable of phone numbers or email addresses
+        content: Message body
+        subject: Email subject (ignored for SMS)
+
+    Returns {"id", "queued", "rejected", "duplicates"}.
+    """
+    addresses, rejected, duplicates = normalize_recipients(channel, recipients)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+        INSERT INTO broadcasts (sender_id, channel, subject, content, total, rejected, duplicates)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+        """, (sender_id, channel, subject if channel == "email" else None, content,
+              len(addresses), rejected, duplicates))
+        broadcast_id = cur.fetchone()[0]
+
+        if addresses:
+            cur.execute("CREATE TEMP TABLE broadcast_recipients (position INTEGER, address TEXT) ON COMMIT DROP")
+            # Validated addresses never contain tabs, newlines or backslashes,
+            # so they need no escaping in COPY's text format
+            cur.copy_expert(
+                "COPY broadcast_recipients (position, address) FROM STDIN",
+                io.StringIO("".join(f"{i}\t{address}\n" for i, address in enumerate(addresses)))
+            )
+            user_column = "phone_number" if channel == "sms" else "email"
+            cur.execute("""
+            INSERT INTO messages (sender_id, receiver_id, message_type, content, subject, from_address, to_address,
+                                  status, broadcast_id)
+            SELECT %(sender_id)s, u.id, %(channel)s, %(content)s, %(subject)s,
+                   CASE WHEN %(channel)s = 'email' THEN (SELECT email FROM users WHERE id = %(sender_id)s) END,
+                   r.address, 'queued', %(broadcast_id)s
+            FROM broadcast_recipients r
+            LEFT JOIN users u ON u.""" + user_column + """ = r.address
+            ORDER BY r.position
+            """, {"sender_id": sender_id, "channel": channel, "content": content,
+                  "subject": subject if channel == "email" else None, "broadcast_id": broadcast_id})
+
+            if channel == "sms":
+                cur.execute("""
+                INSERT INTO outbox (kind, payload, message_id)
+                SELECT 'sms', jsonb_build_object('from', %s::text, 'to', to_address, 'body', content), id
+                FROM messages
+                WHERE broadcast_id = %s
+                ORDER BY id
+                """, (os.getenv("TWILIO_PHONE_NUMBER"), broadcast_id))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    return {"id": broadcast_id, "queued": len(addresses), "rejected": rejected, "duplicates": duplicates}
+
+
+def broadcast_progress(broadcast_id):
+    """
+    Delivery progress of a broadcast: {"total", "rejected", "duplicates",
+    "statuses": {status: count}, "pending", "done"}, or None if unknown.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT total, rejected, duplicates FROM broadcasts WHERE id = %s", (broadcast_id,))
+    row = cur.fetchone()
+    if row is None:
+        cur.close()
+        conn.close()
+        return None
+    cur.execute("""
+    SELECT status, COUNT(*) FROM messages
+    WHERE broadcast_id = %s
+    GROUP BY status
+    """, (broadcast_id,))
+    statuses = dict(cur.fetchall())
+    cur.close()
+    conn.close()
+
+    pending = sum(statuses.get(status, 0) for status in PENDING_STATUSES)
+    return {
+        "total": row[0],
+        "rejected": row[1],
+        "duplicates": row[2],
+        "statuses": statuses,
+        "pending": pending,
+        "done": pending == 0,
+    }
+
+
+def get_broadcasts(sender_id, limit=10):
+    """The sender's most recent broadcasts as (id, channel, subject, content, total, created_at)."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT id, channel, subject, content, total, created_at
+    FROM broadcasts
+    WHERE sender_id = %s
+    ORDER BY id DESC
+    LIMIT %s
+    """, (sender_id, limit))
+    broadcasts = cur.fetchall()
+    cur.close()
+    conn.close()
+    return broadcasts
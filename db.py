@@ -0,0 +1,295 @@
+# db.py - Shared PostgreSQL connection pool for the Streamlit UI and the Flask webhooks
+
+import os
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+from dotenv import load_dotenv
+from metrics import Counter, Gauge, Histogram, WAIT_BUCKETS
+
+load_dotenv()
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+POOL_WAIT = Histogram("omni_db_pool_wait_seconds", "Time to check a connection out of the pool", buckets=WAIT_BUCKETS)
+POOL_TIMEOUTS = Counter("omni_db_pool_timeouts_total", "Checkouts that gave up with PoolTimeout")
+
+
+def get_db_settings():
+    """
+    Read the connection settings from the environment.
+
+    Returns a dict of keyword arguments for psycopg2.connect.
+    """
+    return {
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": int(os.getenv("DB_PORT", "5432")),
+        "dbname": os.getenv("DB_NAME", "omni_channel_db"),
+        "user": os.getenv("DB_USER", "postgres"),
+        "password": os.getenv("DB_PASSWORD"),
+        "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
+        "application_name": os.getenv("DB_APPLICATION_NAME", "omni-channel-app"),
+    }
+
+
+class PooledConnection:
+    """
+    Thin wrapper around a psycopg2 connection borrowed from a ConnectionPool.
+
+    Behaves like the underlying connection, except that close() hands the
+    connection back to the pool instead of closing the socket. Used as a
+    context manager it commits on success, rolls back on error and then
+    returns the connection.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(conn, name)
+
+    @property
+    def raw(self):
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.putconn(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._conn is not None:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        self.close()
+        return False
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    Args:
+        minconn: Number of connections opened up front and kept idle
+        maxconn: Upper bound on open connections
+        timeout: Seconds getconn() waits for a free connection before PoolTimeout
+        ping_after: Idle seconds after which a borrowed connection is checked
+            with SELECT 1 before being handed out (0 checks every borrow)
+        **dsn: Keyword arguments passed to psycopg2.connect
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=10.0, ping_after=5.0, **dsn):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._dsn = dsn
+        self._cond = threading.Condition()
+        self._idle = []  # stack of (conn, last_used); newest on top
+        self._open = 0
+        self._closed = False
+        self._stats = {
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "checkouts": 0,
+            "checkout_waits": 0,
+            "checkout_timeouts": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "health_check_failures": 0,
+        }
+
+        with self._cond:
+            for _ in range(minconn):
+                self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._dsn)
+        self._open += 1
+        self._stats["connections_created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        self._open -= 1
+        self._stats["connections_discarded"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.ping_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        """Borrow a connection, waiting up to `timeout` seconds for one to free up."""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+
+                if self._open < self.maxconn:
+                    # Reserve the slot, then connect outside the lock so slow
+                    # handshakes don't block other borrowers.
+                    self._open += 1
+                    conn = None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["checkout_timeouts"] += 1
+                    POOL_TIMEOUTS.inc()
+                    raise PoolTimeout(
+                        "no database connection available after %.1fs (max=%d)" % (timeout, self.maxconn)
+                    )
+                waited = True
+                self._cond.wait(remaining)
+
+        if conn is None:
+            try:
+                conn = psycopg2.connect(**self._dsn)
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._stats["connections_created"] += 1
+        elif not self._is_healthy(conn, last_used):
+            with self._cond:
+                self._stats["health_check_failures"] += 1
+                self._discard(conn)
+                self._cond.notify()
+            # Retry with whatever time is left; a replacement slot is now free.
+            return self.getconn(max(deadline - time.monotonic(), 0))
+
+        wait_time = time.monotonic() - started
+        POOL_WAIT.observe(wait_time)
+        with self._cond:
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["checkout_waits"] += 1
+            self._stats["wait_time_total"] += wait_time
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+
+        return PooledConnection(self, conn)
+
+    def putconn(self, conn):
+        """Return a connection to the pool, rolling back any open transaction."""
+        if isinstance(conn, PooledConnection):
+            conn.close()
+            return
+
+        healthy = not conn.closed
+        if healthy and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                healthy = False
+
+        with self._cond:
+            if not healthy or self._closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        """Snapshot of pool usage counters."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._open
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._open - len(self._idle)
+            stats["min"] = self.minconn
+            stats["max"] = self.maxconn
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, creating it on first use (and again after a fork)."""
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                minconn=int(os.getenv("DB_POOL_MIN", "1")),
+                maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+                timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+                ping_after=float(os.getenv("DB_POOL_PING_AFTER", "5")),
+                **get_db_settings()
+            )
+            _pool_pid = os.getpid()
+    return _pool
+
+
+# Database connection
+def get_db_connection(timeout=None):
+    """Borrow a connection from the shared pool. Call close() to give it back."""
+    return get_pool().getconn(timeout)
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+def _pool_connections():
+    if _pool is None or _pool_pid != os.getpid():
+        return []
+    stats = _pool.stats()
+    return [({"state": "idle"}, stats["idle"]), ({"state": "in_use"}, stats["in_use"])]
+
+
+Gauge("omni_db_pool_connections", "Open pool connections by state", ["state"], collect=_pool_connections)
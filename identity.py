@@ -0,0 +1,152 @@
+# identity.py - In-process cache of user identities (id, username, email, phone number)
+
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from db import get_db_connection
+from notifications import get_event_hub
+
+User = namedtuple("User", ["id", "username", "email", "phone_number"])
+
+# Columns a user can be looked up by
+LOOKUP_FIELDS = ("id", "username", "email", "phone_number")
+
+
+class IdentityCache:
+    """
+    Bounded LRU cache resolving a user from any one of its identifiers.
+
+    Every loaded user is stored under all four of its keys, so resolving a
+    phone number also answers later lookups by id, username or email.
+    Unknown emails and phone numbers (external senders) are cached as misses
+    too. The users table NOTIFYs every change (migration 17) and the
+    process's EventHub calls invalidate() for the users concerned; entries
+    also expire after `ttl` seconds, which bounds staleness while the hub is
+    not listening.
+
+    Args:
+        max_entries: Keys held before the least recently used are evicted
+        ttl: Seconds an entry (found or not) is trusted
+    """
+
+    def __init__(self, max_entries=10000, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (field, value) -> (expires_at, User or None)
+        self._users = None  # (expires_at, [(id, username), ...]) for get_users()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def lookup(self, field, value):
+        """Return the User whose `field` equals `value`, or None if there is none."""
+        if field not in LOOKUP_FIELDS:
+            raise ValueError(f"cannot look users up by {field!r}")
+        key = (field, value)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+
+        user = self._load(field, value)
+        with self._lock:
+            expires_at = time.monotonic() + self.ttl
+            if user is None:
+                self._put(key, expires_at, None)
+            else:
+                for key in zip(LOOKUP_FIELDS, user):
+                    self._put(key, expires_at, user)
+        return user
+
+    def by_id(self, user_id):
+        return self.lookup("id", user_id)
+
+    def by_username(self, username):
+        return self.lookup("username", username)
+
+    def by_email(self, email):
+        return self.lookup("email", email)
+
+    def by_phone(self, phone_number):
+        return self.lookup("phone_number", phone_number)
+
+    def all_users(self):
+        """(id, username) of every user, as the recipient pickers need them."""
+        now = time.monotonic()
+        with self._lock:
+            if self._users is not None and self._users[0] > now:
+                self.stats["hits"] += 1
+                return self._users[1]
+            self.stats["misses"] += 1
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT id, username FROM users")
+        users = cur.fetchall()
+        cur.close()
+        conn.close()
+
+        with self._lock:
+            self._users = (time.monotonic() + self.ttl, users)
+        return users
+
+    def invalidate(self, user_id=None):
+        """Forget one user (all of its keys), or everything when no id is given."""
+        with self._lock:
+            self.stats["invalidations"] += 1
+            self._users = None
+            if user_id is None:
+                self._entries.clear()
+                return
+            entry = self._entries.get(("id", user_id))
+            if entry is not None and entry[1] is not None:
+                for key in zip(LOOKUP_FIELDS, entry[1]):
+                    self._entries.pop(key, None)
+            self._entries.pop(("id", user_id), None)
+            # A new or changed user may match an identifier cached as unknown
+            for key in [key for key, (_, user) in self._entries.items() if user is None]:
+                del self._entries[key]
+
+    def _put(self, key, expires_at, user):
+        self._entries[key] = (expires_at, user)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _load(self, field, value):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            # field is one of LOOKUP_FIELDS, never user input
+            cur.execute(f"SELECT id, username, email, phone_number FROM users WHERE {field} = %s", (value,))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+            conn.close()
+        return User(*row) if row else None
+
+
+_identity_cache = None
+_identity_cache_pid = None
+_identity_cache_lock = threading.Lock()
+
+
+def get_identity_cache():
+    """Process-wide IdentityCache shared by the Streamlit UI and the webhooks, kept current by the EventHub."""
+    global _identity_cache, _identity_cache_pid
+    with _identity_cache_lock:
+        if _identity_cache is None or _identity_cache_pid != os.getpid():
+            _identity_cache = IdentityCache(
+                max_entries=int(os.getenv("IDENTITY_CACHE_SIZE", "10000")),
+                ttl=float(os.getenv("IDENTITY_CACHE_TTL", "300")),
+            )
+            _identity_cache_pid = os.getpid()
+        cache = _identity_cache
+    # Outside the lock: the hub's thread calls back into get_identity_cache()
+    get_event_hub()
+    return cache
@@ -0,0 +1,209 @@
+# mail_parse.py - One-time parsing of raw emails into stored text, preview and attachments
+
+import email
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from email.header import decode_header, make_header
+from html.parser import HTMLParser
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = 160
+
+# What a message that cannot be parsed at all is stored as
+EMPTY_RESULT = {"body": "", "preview": "", "attachments": []}
+
+_CONTROL_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+_SPACES_RE = re.compile(r"[ \t\u00a0]+")
+
+
+def decode_mime_header(value):
+    if not value:
+        return ""
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def extract_body(msg):
+    """
+    Pick the message body and attachment parts.
+
+    Returns (body, is_html, attachments) where attachments is a list of
+    (filename, payload bytes). Plain text wins over HTML.
+    """
+    plain = html = None
+    attachments = []
+    for part in msg.walk() if msg.is_multipart() else [msg]:
+        if part.is_multipart():
+            continue
+        content_type = part.get_content_type()
+        content_disposition = str(part.get("Content-Disposition"))
+
+        if "attachment" in content_disposition:
+            filename = part.get_filename()
+            if filename:
+                attachments.append((decode_mime_header(filename), part.get_payload(decode=True) or b""))
+            continue
+
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            continue
+        text = _decode(payload, part.get_content_charset())
+        if content_type == "text/plain" and plain is None:
+            plain = text
+        elif content_type == "text/html" and html is None:
+            html = text
+
+    if plain is not None:
+        return plain, False, attachments
+    return html or "", html is not None, attachments
+
+
+def _decode(payload, charset):
+    # Mailers send made-up charsets (x-unknown-8bit, ...); read those as UTF-8
+    try:
+        return payload.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document, one line per block element."""
+
+    SKIP = {"script", "style", "head", "title", "noscript", "template"}
+    BLOCKS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6",
+              "table", "ul", "ol", "blockquote", "pre", "hr", "section", "article"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skipping = max(self._skipping - 1, 0)
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return "".join(extractor.parts)
+
+
+def clean_text(text):
+    """Plain text safe to render: no control characters, tidy whitespace."""
+    text = _CONTROL_RE.sub("", text.replace("\r\n", "\n").replace("\r", "\n"))
+    lines = [_SPACES_RE.sub(" ", line).strip() for line in text.split("\n")]
+    return _BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+def make_preview(text, length=PREVIEW_LENGTH):
+    preview = " ".join(text.split())
+    return preview if len(preview) <= length else preview[:length - 3].rstrip() + "..."
+
+
+def parse_email(raw):
+    """
+    Turn a raw RFC 822 message into what gets stored with it.
+
+    Returns {"body": sanitized plain text, "preview": first PREVIEW_LENGTH
+    characters on one line, "attachments": [(filename, bytes), ...]}. A
+    module-level function so it can run in a worker process.
+    """
+    body, is_html, attachments = extract_body(email.message_from_bytes(raw))
+    text = clean_text(html_to_text(body) if is_html else body)
+    return {"body": text, "preview": make_preview(text), "attachments": attachments}
+
+
+class EmailParser:
+    """
+    Runs parse_email inline for small messages and in a process pool for
+    large ones (big MIME trees and base64 attachments are CPU-bound and
+    would otherwise hold the GIL the UI and webhooks also need).
+
+    Args:
+        workers: Pool processes (defaults to the CPU count)
+        inline_bytes: Messages up to this size are parsed in the calling thread
+    """
+
+    def __init__(self, workers=None, inline_bytes=256 * 1024):
+        self.workers = workers
+        self.inline_bytes = inline_bytes
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: forking a process that runs Streamlit/Flask threads is unsafe
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def parse_many(self, raws):
+        """
+        Parse several messages, large ones in parallel; results in input
+        order. A message that cannot be parsed comes back as EMPTY_RESULT,
+        so it is stored without a body instead of failing the whole sync.
+        """
+        futures = {i: self._executor().submit(parse_email, raw)
+                   for i, raw in enumerate(raws) if len(raw) > self.inline_bytes}
+        results = [None if i in futures else _parse_or_empty(parse_email, raw) for i, raw in enumerate(raws)]
+        for i, future in futures.items():
+            results[i] = _parse_or_empty(lambda _: future.result(), raws[i])
+        return results
+
+    def parse(self, raw):
+        return self.parse_many([raw])[0]
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def _parse_or_empty(parse, raw):
+    try:
+        return parse(raw)
+    except Exception:
+        logger.exception("Could not parse a %d-byte email; storing it without a body", len(raw))
+        return EMPTY_RESULT
+
+
+_parser = None
+_parser_pid = None
+_parser_lock = threading.Lock()
+
+
+def get_email_parser():
+    """Process-wide EmailParser configured from the environment."""
+    global _parser, _parser_pid
+    with _parser_lock:
+        if _parser is None or _parser_pid != os.getpid():
+            workers = os.getenv("MAIL_PARSE_WORKERS")
+            _parser = EmailParser(
+                workers=int(workers) if workers else None,
+                inline_bytes=int(os.getenv("MAIL_PARSE_INLINE_BYTES", str(256 * 1024))),
+            )
+            _parser_pid = os.getpid()
+        return _parser
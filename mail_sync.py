@@ -0,0 +1,364 @@
+# mail_sync.py - Incremental IMAP sync of the shared inbox into the messages table
+
+import email
+import email.utils
+import imaplib
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from db import get_db_connection
+from attachment_store import get_attachment_store
+from mail_parse import EMPTY_RESULT, decode_mime_header, get_email_parser
+from metrics import Counter, Histogram, timed
+
+logger = logging.getLogger(__name__)
+
+HEADER_FIELDS = "FROM TO SUBJECT DATE MESSAGE-ID"
+FETCH_BATCH = 100
+
+_UID_RE = re.compile(rb"UID (\d+)")
+_SIZE_RE = re.compile(rb"RFC822\.SIZE (\d+)")
+_ATTACHMENT_NAME_RE = re.compile(rb'"(?:FILENAME|NAME)" "([^"]*)"', re.IGNORECASE)
+
+# One row of the inbox list; the body itself is loaded when the email is opened
+InboxEmail = namedtuple("InboxEmail", ["id", "from_address", "subject", "attachment_names", "body_loaded",
+                                       "to_address", "created_at", "preview"])
+
+
+def header_datetime(value):
+    """Parse a Date header into a naive local timestamp, or None."""
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+IMAP_SECONDS = Histogram("omni_imap_seconds", "Time of IMAP syncs, body loads and the FETCH commands within them",
+                         ["operation"])
+IMAP_ERRORS = Counter("omni_imap_errors_total", "IMAP syncs and body loads that raised", ["operation", "error"])
+
+
+class MailSync:
+    """
+    Keeps one IMAP session open and copies new mail into `messages`.
+
+    Sync state (UIDVALIDITY and the highest UID seen) lives in
+    mailbox_sync_state, so each sync only asks the server for UIDs above the
+    last one stored. Headers and BODYSTRUCTURE are fetched for every new
+    message; bodies up to `prefetch_bytes` are downloaded and parsed in the
+    same sync, larger ones by load_body() when a message is opened. Either
+    way a body is parsed once, and the stored text, preview and attachments
+    are all the UI ever reads.
+
+    Args:
+        prefetch_bytes: Largest message (RFC822.SIZE) whose body is fetched during sync; 0 disables
+    """
+
+    def __init__(self, host, port, username, password, mailbox="INBOX", use_ssl=True, prefetch_bytes=0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.mailbox = mailbox
+        self.use_ssl = use_ssl
+        self.prefetch_bytes = prefetch_bytes
+        self._imap = None
+        self._lock = threading.Lock()
+        self.last_sync = 0.0
+
+    def _connection(self):
+        if self._imap is not None:
+            try:
+                self._imap.noop()
+                return self._imap
+            except (imaplib.IMAP4.error, OSError):
+                self._drop()
+
+        imap_class = imaplib.IMAP4_SSL if self.use_ssl else imaplib.IMAP4
+        self._imap = imap_class(self.host, self.port)
+        self._imap.login(self.username, self.password)
+        return self._imap
+
+    def _drop(self):
+        try:
+            self._imap.logout()
+        except Exception:
+            pass
+        self._imap = None
+
+    def close(self):
+        with self._lock:
+            if self._imap is not None:
+                self._drop()
+
+    def _select(self, imap):
+        status, _ = imap.select(self.mailbox, readonly=True)
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"cannot select mailbox {self.mailbox}")
+        _, data = imap.response("UIDVALIDITY")
+        return int(data[0])
+
+    @timed(IMAP_SECONDS, IMAP_ERRORS, operation="sync")
+    def sync(self, initial_limit=50):
+        """
+        Fetch headers of every message newer than the last synced UID.
+
+        On the very first sync (or after UIDVALIDITY changed) only the newest
+        `initial_limit` messages are pulled. Returns the number of new rows.
+        """
+        with self._lock:
+            try:
+                return self._sync(initial_limit)
+            except (imaplib.IMAP4.abort, OSError):
+                # Server dropped the idle session; reconnect once and retry.
+                self._drop()
+                return self._sync(initial_limit)
+
+    def _sync(self, initial_limit):
+        imap = self._connection()
+        uidvalidity = self._select(imap)
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT uidvalidity, last_uid FROM mailbox_sync_state WHERE mailbox = %s FOR UPDATE",
+                (self.mailbox,)
+            )
+            state = cur.fetchone()
+            if state is None or state[0] != uidvalidity:
+                if state is not None:
+                    # Old UIDs mean nothing under the new UIDVALIDITY; keep the
+                    # rows but detach them so they can't collide with new ones.
+                    logger.warning("UIDVALIDITY of %s changed, resyncing", self.mailbox)
+                    cur.execute(
+                        "UPDATE messages SET imap_uid = NULL WHERE imap_mailbox = %s AND imap_uid IS NOT NULL",
+                        (self.mailbox,)
+                    )
+                last_uid = 0
+            else:
+                last_uid = state[1]
+
+            _, data = imap.uid("SEARCH", None, f"UID {last_uid + 1}:*")
+            # "n:*" always matches the highest UID, even when it is below n
+            uids = [int(uid) for uid in data[0].split() if int(uid) > last_uid]
+            if last_uid == 0:
+                uids = uids[-initial_limit:]
+
+            inserted = 0
+            for start in range(0, len(uids), FETCH_BATCH):
+                batch = uids[start:start + FETCH_BATCH]
+                prefetch = []
+                for row in self._fetch_headers(imap, batch):
+                    if self._store_header(cur, row):
+                        inserted += 1
+                        if row["size"] is not None and row["size"] <= self.prefetch_bytes:
+                            prefetch.append(row["uid"])
+                if prefetch:
+                    self._prefetch_bodies(imap, cur, prefetch)
+
+            cur.execute("""
+            INSERT INTO mailbox_sync_state (mailbox, uidvalidity, last_uid, synced_at)
+            VALUES (%s, %s, %s, NOW())
+            ON CONFLICT (mailbox) DO UPDATE
+            SET uidvalidity = EXCLUDED.uidvalidity, last_uid = EXCLUDED.last_uid, synced_at = EXCLUDED.synced_at
+            """, (self.mailbox, uidvalidity, max(uids + [last_uid])))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+        self.last_sync = time.time()
+        return inserted
+
+    def _fetch_headers(self, imap, uids):
+        uid_set = ",".join(str(uid) for uid in uids)
+        with IMAP_SECONDS.time(operation="fetch_headers"):
+            _, data = imap.uid(
+                "FETCH", uid_set,
+                f"(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])"
+            )
+
+        # Each message arrives as (metadata, header literal) followed by the
+        # closing bytes, which may carry items the server sent after the literal.
+        rows = []
+        for i, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            meta, headers = item
+            trailer = data[i + 1] if i + 1 < len(data) and isinstance(data[i + 1], bytes) else b""
+            meta += trailer
+            uid = _UID_RE.search(meta)
+            if uid is None:
+                continue
+            size = _SIZE_RE.search(meta)
+            rows.append({
+                "uid": int(uid.group(1)),
+                "size": int(size.group(1)) if size else None,
+                "headers": email.message_from_bytes(headers),
+                "attachments": [name.decode(errors="replace") for name in _ATTACHMENT_NAME_RE.findall(meta)],
+            })
+        return rows
+
+    def _store_header(self, cur, row):
+        headers = row["headers"]
+        from_address = email.utils.parseaddr(headers.get("From", ""))[1].lower()
+        to_address = email.utils.parseaddr(headers.get("To", ""))[1].lower()
+
+        cur.execute("""
+        INSERT INTO messages (sender_id, receiver_id, message_type, subject, from_address, to_address,
+                              attachment_names, status, body_loaded, imap_mailbox, imap_uid, created_at)
+        VALUES ((SELECT id FROM users WHERE email = %s), (SELECT id FROM users WHERE email = %s), 'email',
+                %s, %s, %s, %s, 'received', FALSE, %s, %s, COALESCE(%s, NOW()))
+        ON CONFLICT (imap_mailbox, imap_uid) WHERE imap_uid IS NOT NULL DO NOTHING
+        """, (
+            from_address, to_address,
+            decode_mime_header(headers.get("Subject"))[:255],
+            decode_mime_header(headers.get("From")), decode_mime_header(headers.get("To")),
+            sorted(set(row["attachments"])) or None,
+            self.mailbox, row["uid"], header_datetime(headers.get("Date"))
+        ))
+        return cur.rowcount
+
+    def _fetch_bodies(self, imap, uids):
+        """{uid: raw message bytes} for the given UIDs, without setting \\Seen."""
+        with IMAP_SECONDS.time(operation="fetch_bodies"):
+            _, data = imap.uid("FETCH", ",".join(str(uid) for uid in uids), "(UID BODY.PEEK[])")
+        bodies = {}
+        for i, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            meta, raw = item
+            trailer = data[i + 1] if i + 1 < len(data) and isinstance(data[i + 1], bytes) else b""
+            uid = _UID_RE.search(meta + trailer)
+            if uid is not None:
+                bodies[int(uid.group(1))] = raw
+        return bodies
+
+    def _prefetch_bodies(self, imap, cur, uids):
+        bodies = self._fetch_bodies(imap, uids)
+        if not bodies:
+            return
+        cur.execute(
+            "SELECT imap_uid, id FROM messages WHERE imap_mailbox = %s AND imap_uid = ANY(%s) AND NOT body_loaded",
+            (self.mailbox, list(bodies))
+        )
+        message_ids = dict(cur.fetchall())
+        uids = [uid for uid in bodies if uid in message_ids]
+        parsed = get_email_parser().parse_many([bodies[uid] for uid in uids])
+        for uid, result in zip(uids, parsed):
+            # This runs inside the sync's transaction: a message whose body
+            # cannot be stored is kept without one rather than rolling back
+            # the sync and leaving last_uid where it was
+            cur.execute("SAVEPOINT store_body")
+            try:
+                self._store_body(cur, message_ids[uid], result)
+            except Exception:
+                logger.exception("Could not store the body of UID %s; keeping it without one", uid)
+                cur.execute("ROLLBACK TO SAVEPOINT store_body")
+                self._store_body(cur, message_ids[uid], EMPTY_RESULT)
+            cur.execute("RELEASE SAVEPOINT store_body")
+
+    def _store_body(self, cur, message_id, parsed):
+        """Save a parse_email() result for a message, using the caller's cursor."""
+        # Stored by content, so the same file in many emails takes up space once
+        store = get_attachment_store()
+        names = []
+        for filename, payload in parsed["attachments"]:
+            filename = os.path.basename(filename)
+            store.attach(cur, message_id, store.write(payload), filename)
+            names.append(filename)
+
+        cur.execute("""
+        UPDATE messages SET content = %s, preview = %s, attachment_names = %s, body_loaded = TRUE
+        WHERE id = %s
+        """, (parsed["body"], parsed["preview"], names or None, message_id))
+
+    @timed(IMAP_SECONDS, IMAP_ERRORS, operation="load_body")
+    def load_body(self, message_id):
+        """Download, store and return the body of a synced email, or None if gone."""
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT imap_mailbox, imap_uid, content, body_loaded FROM messages WHERE id = %s",
+                (message_id,)
+            )
+            row = cur.fetchone()
+            if row is None or row[3]:
+                return row[2] if row else None
+            if row[1] is None:
+                return None
+
+            with self._lock:
+                imap = self._connection()
+                self._select(imap)
+                raw = self._fetch_bodies(imap, [row[1]]).get(row[1])
+            if raw is None:
+                return None
+
+            parsed = get_email_parser().parse(raw)
+            self._store_body(cur, message_id, parsed)
+            conn.commit()
+            return parsed["body"]
+        finally:
+            cur.close()
+            conn.close()
+
+
+_mail_sync = None
+_mail_sync_lock = threading.Lock()
+
+
+def get_mail_sync():
+    """Process-wide MailSync for the account configured in the environment."""
+    global _mail_sync
+    with _mail_sync_lock:
+        if _mail_sync is None:
+            _mail_sync = MailSync(
+                host=os.getenv("IMAP_HOST", "imap.gmail.com"),
+                port=int(os.getenv("IMAP_PORT", "993")),
+                username=os.getenv("GMAIL_USERNAME"),
+                password=os.getenv("GMAIL_APP_PASSWORD"),
+                mailbox=os.getenv("IMAP_MAILBOX", "INBOX"),
+                use_ssl=os.getenv("IMAP_SSL", "true").lower() != "false",
+                prefetch_bytes=int(os.getenv("MAIL_PREFETCH_BYTES", str(64 * 1024))),
+            )
+        return _mail_sync
+
+
+def get_inbox_emails(mailbox=None, before=None, limit=50):
+    """
+    One page of synced emails, newest first, straight from the database, as
+    InboxEmail records without their bodies. The last record's
+    (created_at, id) is the cursor for the next page.
+    """
+    mailbox = mailbox or os.getenv("IMAP_MAILBOX", "INBOX")
+    params = {"mailbox": mailbox, "limit": limit}
+    filters = ""
+    if before:
+        filters = " AND (created_at, id) < (%(before_time)s, %(before_id)s)"
+        params["before_time"], params["before_id"] = before
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT id, from_address, subject, attachment_names, body_loaded, to_address, created_at, preview
+    FROM messages
+    WHERE message_type = 'email' AND imap_mailbox = %(mailbox)s""" + filters + """
+    ORDER BY created_at DESC, id DESC
+    LIMIT %(limit)s
+    """, params)
+    emails = [InboxEmail(*row) for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return emails
@@ -0,0 +1,300 @@
+# metrics.py - In-process counters, gauges and latency histograms in Prometheus text format
+
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers a cached lookup up to a slow provider round trip
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Pool checkouts are normally immediate, so the interesting part is sub-millisecond
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+_metrics_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _metrics_lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. errors."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_label_text(self.labelnames, key)} {_number(value)}" for key, value in values]
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. Either set() explicitly or computed at
+    scrape time by `collect`, a callable returning [(labels dict, value)].
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        if self.collect is not None:
+            try:
+                values = sorted((self._key(labels), value) for labels, value in self.collect())
+            except Exception as e:
+                logger.warning("Collecting %s failed: %s", self.name, e)
+                COLLECT_ERRORS.inc(metric=self.name)
+                return []
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [f"{self.name}{_label_text(self.labelnames, key)} {_number(value)}" for key, value in values]
+
+
+class Histogram(_Metric):
+    """Latency distribution in cumulative buckets, plus sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per-bucket (not yet cumulative) counts, +Inf last, then the sum
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, list(entry)) for key, entry in self._values.items())
+        lines = []
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, [('le', _number(bound))])} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {_number(entry[-1])}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+COLLECT_ERRORS = Counter("omni_metrics_collect_errors_total", "Scrape-time gauges that could not be computed",
+                         ["metric"])
+
+
+def timed(histogram, errors, **labels):
+    """
+    Decorator observing a function's duration in `histogram` and counting
+    the exceptions it raises in `errors` (labelled with the exception type).
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                errors.inc(error=type(e).__name__, **labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorate
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    with _metrics_lock:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Outbound channels: the request path in the UI (validation, insert, enqueue)
+CHANNEL_SECONDS = Histogram("omni_channel_request_seconds", "Time to accept an outbound message or call in the UI",
+                            ["channel"])
+CHANNEL_ERRORS = Counter("omni_channel_errors_total", "Outbound requests that raised", ["channel", "error"])
+
+# Provider round trips made by the background workers
+PROVIDER_SECONDS = Histogram("omni_provider_request_seconds", "Time of one provider call (Twilio REST, SMTP send)",
+                             ["provider", "operation"])
+PROVIDER_ERRORS = Counter("omni_provider_errors_total", "Failed provider calls, by whether they will be retried",
+                          ["provider", "operation", "outcome", "error"])
+
+# Flask request metrics, shared by every app instrumented below
+HTTP_SECONDS = Histogram("omni_http_request_seconds", "Time spent handling HTTP requests (webhooks, attachments)",
+                         ["app", "endpoint", "method"])
+HTTP_RESPONSES = Counter("omni_http_responses_total", "HTTP responses by status code",
+                         ["app", "endpoint", "method", "status"])
+HTTP_ERRORS = Counter("omni_http_errors_total", "Unhandled exceptions in HTTP handlers",
+                      ["app", "endpoint", "error"])
+
+
+def instrument(app):
+    """
+    Time every request of a Flask app and serve render() at /metrics.
+
+    Handlers are timed from before_request to teardown_request, so the
+    figure includes error handling; the /metrics scrape itself is excluded.
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _count_response(response):
+        if request.endpoint != "metrics":
+            HTTP_RESPONSES.inc(app=app.name, endpoint=request.endpoint or "unknown", method=request.method,
+                               status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def _observe(error):
+        started = g.pop("metrics_started", None)
+        if started is None or request.endpoint == "metrics":
+            return
+        endpoint = request.endpoint or "unknown"
+        HTTP_SECONDS.observe(time.perf_counter() - started, app=app.name, endpoint=endpoint, method=request.method)
+        if error is not None:
+            HTTP_ERRORS.inc(app=app.name, endpoint=endpoint, error=type(error).__name__)
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    return app
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_pid = None
+_server_lock = threading.Lock()
+_attempted_pid = None
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """
+    Serve render() at http://host:port/metrics from a daemon thread, for
+    processes without a Flask app of their own (Streamlit) or whose Flask app
+    is shared by several workers. Started once per process; later calls
+    return the running server. Raises OSError when the port is taken.
+    """
+    global _server, _server_pid
+    with _server_lock:
+        if _server is None or _server_pid != os.getpid():
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            _server.daemon_threads = True
+            _server_pid = os.getpid()
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+            logger.info("Serving metrics at http://%s:%d/metrics", host, port)
+        return _server
+
+
+def serve_metrics_once(port, host="0.0.0.0"):
+    """
+    start_metrics_server() for callers that run on every Streamlit rerun:
+    only the first call in a process tries to bind, and a taken port is
+    logged once instead of raised.
+    """
+    global _attempted_pid
+    with _server_lock:
+        if _attempted_pid == os.getpid():
+            return
+        _attempted_pid = os.getpid()
+    try:
+        start_metrics_server(port, host)
+    except OSError as e:
+        logger.warning("Metrics server not started on port %d: %s", port, e)
@@ -0,0 +1,580 @@
+# migrations.py - Versioned schema migrations, applied once per process
+
+import logging
+import threading
+import time
+from db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for pg_advisory_xact_lock so concurrently starting processes
+# (Streamlit, webhook workers) don't apply the same step twice.
+MIGRATION_LOCK_KEY = 727001
+
+# Upsert of conversation summaries from a set of messages or calls (a table
+# or a trigger's transition table). Every row counts for up to two users,
+# the sender's and the receiver's view of the conversation; rows are folded
+# per conversation first, so a bulk insert touches each summary once.
+_PEER_KEY = """
+CASE WHEN peer_id IS NOT NULL THEN 'user:' || peer_id
+     ELSE 'address:' || lower(COALESCE(substring(peer_address from '<([^<>]+)>'), peer_address, '')) END
+"""
+
+_CONVERSATION_UPSERT = """
+INSERT INTO conversations AS c (user_id, channel, peer_id, peer_address, peer_key, last_id, last_subject,
+                                last_preview, last_status, last_outbound, last_at, total, unread)
+SELECT DISTINCT ON (user_id, channel, peer_key)
+       user_id, channel, peer_id, peer_address, peer_key, id, subject, preview, status, outbound, item_at,
+       COUNT(*) OVER w, COUNT(*) FILTER (WHERE NOT outbound) OVER w
+FROM (SELECT v.*, """ + _PEER_KEY + """ AS peer_key FROM ({views}) v) keyed
+WINDOW w AS (PARTITION BY user_id, channel, peer_key)
+ORDER BY user_id, channel, peer_key, item_at DESC, id DESC
+ON CONFLICT (user_id, channel, peer_key) DO UPDATE SET
+    total = c.total + EXCLUDED.total,
+    unread = c.unread + EXCLUDED.unread,
+    last_id = CASE WHEN (EXCLUDED.last_at, EXCLUDED.last_id) >= (c.last_at, c.last_id)
+                   THEN EXCLUDED.last_id ELSE c.last_id END,
+    last_subject = CASE WHEN (EXCLUDED.last_at, EXCLUDED.last_id) >= (c.last_at, c.last_id)
+                        THEN EXCLUDED.last_subject ELSE c.last_subject END,
+    last_preview = CASE WHEN (EXCLUDED.last_at, EXCLUDED.last_id) >= (c.last_at, c.last_id)
+                        THEN EXCLUDED.last_preview ELSE c.last_preview END,
+    last_status = CASE WHEN (EXCLUDED.last_at, EXCLUDED.last_id) >= (c.last_at, c.last_id)
+                       THEN EXCLUDED.last_status ELSE c.last_status END,
+    last_outbound = CASE WHEN (EXCLUDED.last_at, EXCLUDED.last_id) >= (c.last_at, c.last_id)
+                         THEN EXCLUDED.last_outbound ELSE c.last_outbound END,
+    last_at = GREATEST(EXCLUDED.last_at, c.last_at)
+"""
+
+_MESSAGE_VIEWS = """
+SELECT sender_id AS user_id, message_type AS channel, receiver_id AS peer_id, to_address AS peer_address, id,
+       subject, COALESCE(preview, left(content, 160)) AS preview, status, TRUE AS outbound,
+       COALESCE(created_at, NOW()) AS item_at
+FROM {source} WHERE sender_id IS NOT NULL
+UNION ALL
+SELECT receiver_id, message_type, sender_id, from_address, id,
+       subject, COALESCE(preview, left(content, 160)), status, FALSE, COALESCE(created_at, NOW())
+FROM {source} WHERE receiver_id IS NOT NULL AND receiver_id IS DISTINCT FROM sender_id
+"""
+
+_CALL_VIEWS = """
+SELECT caller_id AS user_id, 'call'::varchar AS channel, receiver_id AS peer_id, receiver_phone AS peer_address, id,
+       NULL::varchar AS subject, NULL::text AS preview, status, TRUE AS outbound, COALESCE(created_at, NOW()) AS item_at
+FROM {source} WHERE caller_id IS NOT NULL
+UNION ALL
+SELECT receiver_id, 'call', caller_id, NULL, id, NULL, NULL, status, FALSE, COALESCE(created_at, NOW())
+FROM {source} WHERE receiver_id IS NOT NULL AND receiver_id IS DISTINCT FROM caller_id
+"""
+
+
+def _conversation_upsert(views, source):
+    return _CONVERSATION_UPSERT.replace("{views}", views.replace("{source}", source))
+
+
+# Ordered (version, description, statements). Never edit a released step;
+# append a new one instead.
+MIGRATIONS = [
+    (1, "baseline users, messages and calls tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            email VARCHAR(100) UNIQUE NOT NULL,
+            phone_number VARCHAR(20) UNIQUE NOT NULL,
+            password VARCHAR(100) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            sender_id INTEGER REFERENCES users(id),
+            receiver_id INTEGER REFERENCES users(id),
+            message_type VARCHAR(20) NOT NULL,  -- 'email', 'sms', 'chat', 'call'
+            content TEXT,
+            attachment_path TEXT,
+            status VARCHAR(20) NOT NULL,  -- 'sent', 'delivered', 'read'
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS calls (
+            id SERIAL PRIMARY KEY,
+            caller_id INTEGER REFERENCES users(id),
+            receiver_phone VARCHAR(20),
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            status VARCHAR(20),  -- 'ongoing', 'completed', 'missed'
+            direction VARCHAR(10),  -- 'inbound', 'outbound'
+            call_sid VARCHAR(34),  -- Twilio Call SID
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, "messages.subject and calls.receiver_id used by the app", [
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS subject VARCHAR(255)",
+        "ALTER TABLE calls ADD COLUMN IF NOT EXISTS receiver_id INTEGER REFERENCES users(id)",
+        '''
+        UPDATE calls c SET receiver_id = u.id
+        FROM users u
+        WHERE c.receiver_id IS NULL AND u.phone_number = c.receiver_phone
+        ''',
+    ]),
+    (3, "demo users", [
+        '''
+        INSERT INTO users (username, email, phone_number, password)
+        SELECT * FROM (VALUES
+            ('user1', 'user1@example.com', '+1234567890', 'password1'),
+            ('user2', 'user2@example.com', '+1987654321', 'password2')
+        ) AS demo (username, email, phone_number, password)
+        WHERE NOT EXISTS (SELECT 1 FROM users)
+        ''',
+    ]),
+    # users.phone_number, users.email and users.username already have unique
+    # indexes, which cover the webhook, send_email and login lookups.
+    (4, "indexes for inbox, call history and incoming call lookups", [
+        # get_messages: one side of "sender_id = %s OR receiver_id = %s" each,
+        # newest first, with and without the message_type filter
+        "CREATE INDEX IF NOT EXISTS messages_sender_created_idx ON messages (sender_id, created_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS messages_receiver_created_idx ON messages (receiver_id, created_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS messages_sender_type_created_idx "
+        "ON messages (sender_id, message_type, created_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS messages_receiver_type_created_idx "
+        "ON messages (receiver_id, message_type, created_at DESC, id DESC)",
+        # get_calls (direction is a cheap filter on top of this)
+        "CREATE INDEX IF NOT EXISTS calls_caller_created_idx ON calls (caller_id, created_at DESC, id DESC)",
+        # get_incoming_calls / check_incoming_calls only ever look at the
+        # handful of calls still ringing
+        '''
+        CREATE INDEX IF NOT EXISTS calls_inbound_ongoing_idx ON calls (receiver_id, start_time DESC)
+        WHERE direction = 'inbound' AND status = 'ongoing'
+        ''',
+    ]),
+    (5, "conversation index for chat threads", [
+        # Both directions of a conversation share one (low, high) key
+        '''
+        CREATE INDEX IF NOT EXISTS messages_chat_pair_idx
+        ON messages (LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id), id)
+        WHERE message_type = 'chat'
+        ''',
+    ]),
+    (6, "incremental IMAP sync state and synced email columns", [
+        '''
+        CREATE TABLE IF NOT EXISTS mailbox_sync_state (
+            mailbox TEXT PRIMARY KEY,
+            uidvalidity BIGINT NOT NULL,
+            last_uid BIGINT NOT NULL DEFAULT 0,
+            synced_at TIMESTAMP
+        )
+        ''',
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS from_address TEXT",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS to_address TEXT",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS attachment_names TEXT[]",
+        # FALSE until the body of a synced email has been downloaded
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS body_loaded BOOLEAN NOT NULL DEFAULT TRUE",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS imap_mailbox TEXT",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS imap_uid BIGINT",
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS messages_imap_uid_key ON messages (imap_mailbox, imap_uid)
+        WHERE imap_uid IS NOT NULL
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS messages_inbox_created_idx ON messages (imap_mailbox, created_at DESC, id DESC)
+        WHERE message_type = 'email'
+        ''',
+    ]),
+    (7, "outbound email queue columns", [
+        # messages doubles as the email outbox: 'queued' -> 'sending' -> 'sent' / 'failed'
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS last_error TEXT",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP",
+        '''
+        CREATE INDEX IF NOT EXISTS messages_email_outbox_idx ON messages (id)
+        WHERE message_type = 'email' AND status IN ('queued', 'sending')
+        ''',
+    ]),
+    (8, "Twilio outbox", [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            kind VARCHAR(20) NOT NULL,  -- 'sms', 'call', 'end_call'
+            payload JSONB NOT NULL,
+            message_id INTEGER REFERENCES messages(id),
+            call_id INTEGER REFERENCES calls(id),
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',  -- 'queued', 'sending', 'done', 'failed', 'canceled'
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox (next_attempt_at, id)
+        WHERE status = 'queued'
+        ''',
+        "CREATE INDEX IF NOT EXISTS outbox_sending_idx ON outbox (updated_at) WHERE status = 'sending'",
+        "CREATE INDEX IF NOT EXISTS outbox_call_idx ON outbox (call_id) WHERE call_id IS NOT NULL",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS twilio_sid VARCHAR(34)",
+    ]),
+    (9, "unique Twilio SIDs so webhook retries are idempotent", [
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS messages_twilio_sid_key ON messages (twilio_sid)
+        WHERE twilio_sid IS NOT NULL
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS calls_call_sid_key ON calls (call_sid)
+        WHERE call_sid IS NOT NULL
+        ''',
+    ]),
+    (10, "content-addressed attachment store", [
+        '''
+        CREATE TABLE IF NOT EXISTS attachments (
+            sha256 CHAR(64) PRIMARY KEY,
+            size BIGINT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            unreferenced_since TIMESTAMP,  -- set when refcount drops to 0; GC deletes after a grace period
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS message_attachments (
+            id SERIAL PRIMARY KEY,
+            message_id INTEGER NOT NULL REFERENCES messages(id),
+            sha256 CHAR(64) NOT NULL REFERENCES attachments(sha256),
+            filename TEXT NOT NULL,
+            content_type VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS message_attachments_message_idx ON message_attachments (message_id)",
+        '''
+        CREATE INDEX IF NOT EXISTS attachments_unreferenced_idx ON attachments (unreferenced_since)
+        WHERE refcount <= 0
+        ''',
+    ]),
+    (11, "stored one-line preview of parsed email bodies", [
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS preview TEXT",
+        '''
+        UPDATE messages SET preview = left(btrim(regexp_replace(content, '\\s+', ' ', 'g')), 160)
+        WHERE message_type = 'email' AND body_loaded AND preview IS NULL AND content IS NOT NULL
+        ''',
+    ]),
+    # Statement-level triggers send one NOTIFY per distinct (kind, users) per
+    # statement, so batched webhook inserts don't flood the channel; past
+    # 1000 rows a single "bulk" event tells listeners to refresh everything.
+    (12, "NOTIFY app_events on new messages, status changes and calls", [
+        '''
+        CREATE OR REPLACE FUNCTION notify_message_events() RETURNS trigger AS $$
+        BEGIN
+            IF (SELECT COUNT(*) FROM new_rows) > 1000 THEN
+                PERFORM pg_notify('app_events', '{"kind": "bulk"}');
+            ELSIF TG_OP = 'INSERT' THEN
+                PERFORM pg_notify('app_events', json_build_object(
+                    'kind', message_type, 'users', json_build_array(sender_id, receiver_id))::text)
+                FROM (SELECT DISTINCT message_type, sender_id, receiver_id FROM new_rows) changed;
+            ELSE
+                PERFORM pg_notify('app_events', json_build_object(
+                    'kind', message_type, 'users', json_build_array(sender_id, receiver_id))::text)
+                FROM (
+                    SELECT DISTINCT n.message_type, n.sender_id, n.receiver_id
+                    FROM new_rows n JOIN old_rows o ON o.id = n.id
+                    WHERE n.status IS DISTINCT FROM o.status
+                ) changed;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION notify_call_events() RETURNS trigger AS $$
+        BEGIN
+            IF (SELECT COUNT(*) FROM new_rows) > 1000 THEN
+                PERFORM pg_notify('app_events', '{"kind": "bulk"}');
+            ELSE
+                PERFORM pg_notify('app_events', json_build_object(
+                    'kind', 'call', 'users', json_build_array(caller_id, receiver_id))::text)
+                FROM (SELECT DISTINCT caller_id, receiver_id FROM new_rows) changed;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS messages_notify_insert ON messages",
+        '''
+        CREATE TRIGGER messages_notify_insert AFTER INSERT ON messages
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_message_events()
+        ''',
+        "DROP TRIGGER IF EXISTS messages_notify_update ON messages",
+        '''
+        CREATE TRIGGER messages_notify_update AFTER UPDATE ON messages
+        REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_message_events()
+        ''',
+        "DROP TRIGGER IF EXISTS calls_notify_insert ON calls",
+        '''
+        CREATE TRIGGER calls_notify_insert AFTER INSERT ON calls
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_call_events()
+        ''',
+        "DROP TRIGGER IF EXISTS calls_notify_update ON calls",
+        '''
+        CREATE TRIGGER calls_notify_update AFTER UPDATE ON calls
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_call_events()
+        ''',
+    ]),
+    (13, "full-text search over message subjects and bodies", [
+        # Kept up to date by Postgres on every insert and update. Bodies are
+        # capped so one huge email can't exceed the 1 MB tsvector limit.
+        '''
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', COALESCE(subject, '')), 'A') ||
+            setweight(to_tsvector('english', left(COALESCE(content, ''), 262144)), 'B')
+        ) STORED
+        ''',
+        "CREATE INDEX IF NOT EXISTS messages_search_idx ON messages USING GIN (search_vector)",
+    ]),
+    (14, "broadcasts", [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            sender_id INTEGER REFERENCES users(id),
+            channel VARCHAR(20) NOT NULL,  -- 'sms', 'email'
+            subject VARCHAR(255),
+            content TEXT,
+            total INTEGER NOT NULL,  -- recipients queued
+            rejected INTEGER NOT NULL DEFAULT 0,  -- invalid addresses dropped
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS broadcasts_sender_idx ON broadcasts (sender_id, id DESC)",
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS broadcast_id INTEGER REFERENCES broadcasts(id)",
+        # broadcast_progress counts one broadcast's messages by status
+        '''
+        CREATE INDEX IF NOT EXISTS messages_broadcast_status_idx ON messages (broadcast_id, status)
+        WHERE broadcast_id IS NOT NULL
+        ''',
+    ]),
+    # One row per user and conversation (channel plus the other party, a
+    # user or an external address), kept current by statement-level
+    # triggers on messages and calls, so the inbox reads N summaries.
+    (15, "conversation summaries", [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            channel VARCHAR(20) NOT NULL,  -- 'email', 'sms', 'chat', 'call'
+            peer_id INTEGER REFERENCES users(id),
+            peer_address TEXT,  -- phone number or email when the peer is not a user
+            peer_key TEXT NOT NULL,
+            last_id INTEGER NOT NULL,  -- messages.id, or calls.id for channel 'call'
+            last_subject VARCHAR(255),
+            last_preview TEXT,
+            last_status VARCHAR(20),
+            last_outbound BOOLEAN NOT NULL,
+            last_at TIMESTAMP NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            unread INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (user_id, channel, peer_key)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS conversations_user_last_idx ON conversations (user_id, last_at DESC, id DESC)",
+        '''
+        CREATE INDEX IF NOT EXISTS conversations_user_channel_last_idx
+        ON conversations (user_id, channel, last_at DESC, id DESC)
+        ''',
+        "CREATE INDEX IF NOT EXISTS conversations_last_item_idx ON conversations (channel, last_id)",
+        '''
+        CREATE OR REPLACE FUNCTION update_message_conversations() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                ''' + _conversation_upsert(_MESSAGE_VIEWS, "new_rows") + ''';
+            ELSE
+                UPDATE conversations c
+                SET last_status = n.status, last_preview = COALESCE(n.preview, left(n.content, 160))
+                FROM new_rows n JOIN old_rows o ON o.id = n.id
+                WHERE c.channel = n.message_type AND c.last_id = n.id
+                AND (n.status IS DISTINCT FROM o.status OR n.preview IS DISTINCT FROM o.preview);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION update_call_conversations() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                ''' + _conversation_upsert(_CALL_VIEWS, "new_rows") + ''';
+            ELSE
+                UPDATE conversations c SET last_status = n.status
+                FROM new_rows n JOIN old_rows o ON o.id = n.id
+                WHERE c.channel = 'call' AND c.last_id = n.id AND n.status IS DISTINCT FROM o.status;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS messages_conversations_insert ON messages",
+        '''
+        CREATE TRIGGER messages_conversations_insert AFTER INSERT ON messages
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION update_message_conversations()
+        ''',
+        "DROP TRIGGER IF EXISTS messages_conversations_update ON messages",
+        '''
+        CREATE TRIGGER messages_conversations_update AFTER UPDATE ON messages
+        REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION update_message_conversations()
+        ''',
+        "DROP TRIGGER IF EXISTS calls_conversations_insert ON calls",
+        '''
+        CREATE TRIGGER calls_conversations_insert AFTER INSERT ON calls
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION update_call_conversations()
+        ''',
+        "DROP TRIGGER IF EXISTS calls_conversations_update ON calls",
+        '''
+        CREATE TRIGGER calls_conversations_update AFTER UPDATE ON calls
+        REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION update_call_conversations()
+        ''',
+        # Existing history; received messages from before count as read
+        "TRUNCATE conversations",
+        _conversation_upsert(_MESSAGE_VIEWS, "messages"),
+        _conversation_upsert(_CALL_VIEWS, "calls"),
+        "UPDATE conversations SET unread = 0",
+    ]),
+    (16, "call progress from Twilio status callbacks", [
+        "ALTER TABLE calls ADD COLUMN IF NOT EXISTS answered_at TIMESTAMP",
+        # Seconds, as reported by Twilio when the call completes
+        "ALTER TABLE calls ADD COLUMN IF NOT EXISTS duration INTEGER",
+    ]),
+    # Tells every process's identity cache which users to forget; without a
+    # list of ids (more than 1000 rows in one statement) it forgets everyone.
+    (17, "NOTIFY app_events when users are added, changed or removed", [
+        '''
+        CREATE OR REPLACE FUNCTION notify_user_events() RETURNS trigger AS $$
+        BEGIN
+            IF (SELECT COUNT(*) FROM changed_rows) > 1000 THEN
+                PERFORM pg_notify('app_events', '{"kind": "user"}');
+            ELSE
+                PERFORM pg_notify('app_events', json_build_object(
+                    'kind', 'user', 'users', json_agg(id))::text)
+                FROM changed_rows
+                HAVING COUNT(*) > 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS users_notify_insert ON users",
+        '''
+        CREATE TRIGGER users_notify_insert AFTER INSERT ON users
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_user_events()
+        ''',
+        "DROP TRIGGER IF EXISTS users_notify_update ON users",
+        # Old ids, so a changed id still evicts the entry cached under it
+        '''
+        CREATE TRIGGER users_notify_update AFTER UPDATE ON users
+        REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_user_events()
+        ''',
+        "DROP TRIGGER IF EXISTS users_notify_delete ON users",
+        '''
+        CREATE TRIGGER users_notify_delete AFTER DELETE ON users
+        REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_user_events()
+        ''',
+    ]),
+]
+
+_applied = False
+_applied_lock = threading.Lock()
+schema_timings = {"startup_seconds": None, "steps_applied": 0, "rerun_checks": 0}
+
+
+def current_version(cur):
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+def migrate():
+    """
+    Apply every pending migration, each in its own transaction.
+
+    Returns the list of versions applied by this call.
+    """
+    applied = []
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        conn.commit()
+
+        for version, description, statements in MIGRATIONS:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+            if current_version(cur) >= version:
+                conn.rollback()
+                continue
+
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute(
+                "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            conn.commit()
+            applied.append(version)
+            logger.info("Applied schema migration %d: %s", version, description)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    return applied
+
+
+def ensure_schema():
+    """
+    Bring the schema up to date once per process.
+
+    The first call runs migrate(); every later call (e.g. each Streamlit
+    rerun) is a flag check and touches no database connection.
+    """
+    global _applied
+    if _applied:
+        schema_timings["rerun_checks"] += 1
+        return
+
+    with _applied_lock:
+        if _applied:
+            schema_timings["rerun_checks"] += 1
+            return
+        started = time.perf_counter()
+        applied = migrate()
+        schema_timings["startup_seconds"] = time.perf_counter() - started
+        schema_timings["steps_applied"] = len(applied)
+        _applied = True
+        logger.info("Schema ready in %.3fs (%d steps applied)", schema_timings["startup_seconds"], len(applied))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    ensure_schema()
+    started = time.perf_counter()
+    ensure_schema()
+    print(f"startup: {schema_timings['startup_seconds'] * 1000:.2f} ms, "
+          f"rerun: {(time.perf_counter() - started) * 1000:.4f} ms, "
+          f"steps applied: {schema_timings['steps_applied']}")
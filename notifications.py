@@ -0,0 +1,193 @@
+# notifications.py - Push delivery of new messages and calls via PostgreSQL LISTEN/NOTIFY
+
+import json
+import logging
+import os
+import select
+import threading
+import time
+import psycopg2
+from db import get_db_settings
+
+logger = logging.getLogger(__name__)
+
+# Channel the triggers from migration 12 notify on
+EVENTS_CHANNEL = "app_events"
+
+# Topic every event also counts towards, for views that show all channels
+ALL_TOPIC = "all"
+
+
+def topics_for(event):
+    """
+    [(user_id, topic), ...] an event from the triggers concerns.
+
+    Chat events are per conversation ("chat:<peer id>"), the other kinds per
+    channel ("sms", "email", "calls"); every user involved also gets ALL_TOPIC.
+    """
+    kind = event.get("kind")
+    users = [user_id for user_id in event.get("users") or [] if user_id is not None]
+    found = set()
+    for user_id in users:
+        found.add((user_id, ALL_TOPIC))
+        if kind == "chat":
+            found.update((user_id, f"chat:{peer_id}") for peer_id in users if peer_id != user_id)
+        elif kind == "call":
+            found.add((user_id, "calls"))
+        elif kind:
+            found.add((user_id, kind))
+    return found
+
+
+class EventHub:
+    """
+    One LISTEN connection per process, fanned out to every session in it.
+
+    A background thread waits on the connection socket (no polling queries)
+    and, for each notification, bumps a counter per (user, topic); events
+    about changed users evict them from the identity cache instead. Sessions
+    remember the version they last rendered and compare it with version(),
+    which is a dictionary lookup, so checking for news costs the database
+    nothing. After the connection drops, the epoch changes on reconnect so
+    every session refreshes once in case something was missed. While not
+    listening, version() returns None and callers fall back to querying.
+
+    Args:
+        channel: NOTIFY channel to listen on
+        reconnect_interval: Seconds between reconnection attempts
+        **dsn: Keyword arguments passed to psycopg2.connect
+    """
+
+    def __init__(self, channel=EVENTS_CHANNEL, reconnect_interval=2.0, **dsn):
+        self.channel = channel
+        self.reconnect_interval = reconnect_interval
+        self._dsn = dsn
+        self._counts = {}  # (user_id, topic) -> events seen
+        self._epoch = 0
+        self._listening = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"notifications": 0, "events": 0, "bulk": 0, "user_changes": 0, "reconnects": 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="event-hub", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def listening(self):
+        return self._listening
+
+    def version(self, user_id, topic):
+        """Opaque value that changes whenever an event for (user_id, topic) arrives; None while not listening."""
+        with self._lock:
+            if not self._listening:
+                return None
+            return self._epoch, self._counts.get((user_id, topic), 0)
+
+    def wait_listening(self, timeout=5.0):
+        """Block until LISTEN is active (for benchmarks and scripts); returns whether it is."""
+        deadline = time.monotonic() + timeout
+        while not self._listening and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self._listening
+
+    def dispatch(self, payload):
+        """Apply one NOTIFY payload to the counters."""
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning("Ignoring malformed event %r", payload)
+            return
+        if event.get("kind") == "user":
+            with self._lock:
+                self.stats["notifications"] += 1
+                self.stats["user_changes"] += 1
+            self._forget_users(event.get("users"))
+            return
+        with self._lock:
+            self.stats["notifications"] += 1
+            if event.get("kind") == "bulk":
+                # Too many rows changed to list them; every session refreshes
+                self._epoch += 1
+                self.stats["bulk"] += 1
+                return
+            for key in topics_for(event):
+                self._counts[key] = self._counts.get(key, 0) + 1
+                self.stats["events"] += 1
+
+    def _forget_users(self, user_ids):
+        """Drop changed users (all of them when user_ids is None) from this process's identity cache."""
+        # Imported here: identity starts the hub through get_event_hub()
+        from identity import get_identity_cache
+        identities = get_identity_cache()
+        if user_ids is None:
+            identities.invalidate()
+        else:
+            for user_id in user_ids:
+                identities.invalidate(user_id)
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self._dsn)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f'LISTEN "{self.channel}"')
+                cur.close()
+                with self._lock:
+                    self._epoch += 1
+                    self._listening = True
+                # User changes may have been missed while not listening
+                self._forget_users(None)
+                logger.info("Listening for %s notifications", self.channel)
+                self._listen(conn)
+            except psycopg2.Error as e:
+                logger.warning("Event listener lost its connection: %s", e)
+            finally:
+                with self._lock:
+                    self._listening = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            if self._stop.wait(self.reconnect_interval):
+                break
+            self.stats["reconnects"] += 1
+
+    def _listen(self, conn):
+        while not self._stop.is_set():
+            # Wake up now and then to notice stop(); idle connections send nothing
+            if select.select([conn], [], [], 1.0)[0]:
+                conn.poll()
+                while conn.notifies:
+                    self.dispatch(conn.notifies.pop(0).payload)
+
+
+_hub = None
+_hub_pid = None
+_hub_lock = threading.Lock()
+
+
+def get_event_hub():
+    """Process-wide EventHub with its listener thread started."""
+    global _hub, _hub_pid
+    with _hub_lock:
+        if _hub is None or _hub_pid != os.getpid():
+            settings = get_db_settings()
+            settings["application_name"] += "-events"
+            # Notice a silently dropped connection instead of waiting forever
+            _hub = EventHub(keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+                            **settings).start()
+            _hub_pid = os.getpid()
+        return _hub
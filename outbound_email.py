@@ -0,0 +1,310 @@
+# outbound_email.py - Background delivery of queued emails over reused SMTP sessions
+
+import logging
+import os
+import smtplib
+import threading
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from psycopg2.extras import execute_values
+from db import get_db_connection
+from metrics import Gauge, PROVIDER_ERRORS, PROVIDER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Rows stuck in 'sending' this long (worker died mid-send) are queued again
+STALE_CLAIM_SECONDS = 600
+
+
+class SmtpSession:
+    """
+    One authenticated SMTP connection that is kept open between messages.
+
+    The connection is opened lazily, checked with NOOP after it has been idle
+    for `idle_check` seconds, and transparently re-established when the
+    server has dropped it.
+    """
+
+    def __init__(self, host, port, username=None, password=None, starttls=True, timeout=30, idle_check=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._smtp = None
+        self._last_used = 0.0
+        self.connections_opened = 0
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        self.connections_opened += 1
+        return smtp
+
+    def _connection(self):
+        if self._smtp is not None and time.monotonic() - self._last_used > self.idle_check:
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+        if self._smtp is None:
+            self._smtp = self._connect()
+        return self._smtp
+
+    def send(self, msg):
+        try:
+            self._connection().send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed an idle session; one fresh connection, one retry.
+            self.close()
+            self._connection().send_message(msg)
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+
+def smtp_session_from_env():
+    return SmtpSession(
+        host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
+        port=int(os.getenv("SMTP_PORT", "587")),
+        username=os.getenv("GMAIL_USERNAME"),
+        password=os.getenv("GMAIL_APP_PASSWORD"),
+        starttls=os.getenv("SMTP_STARTTLS", "true").lower() != "false",
+    )
+
+
+def build_message(from_address, to_address, subject, content, attachment_path, attachment_name=None):
+    msg = MIMEMultipart()
+    msg["From"] = from_address
+    msg["To"] = to_address
+    msg["Subject"] = subject or ""
+    msg.attach(MIMEText(content or "", "plain"))
+
+    if attachment_path:
+        # Stored blobs are named by hash; the original name comes from message_attachments
+        attachment_name = attachment_name or os.path.basename(attachment_path)
+        with open(attachment_path, "rb") as file:
+            part = MIMEApplication(file.read(), Name=attachment_name)
+        part["Content-Disposition"] = f'attachment; filename="{attachment_name}"'
+        msg.attach(part)
+    return msg
+
+
+def is_transient(error):
+    """4xx replies and dropped connections are worth retrying; 5xx are not."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+
+class EmailOutbox:
+    """
+    Worker pool that drains 'queued' email rows from `messages`.
+
+    The messages table is the durable outbox: send_email inserts a row with
+    status 'queued', a worker claims it ('sending'), and it ends up 'sent' or
+    'failed' (with last_error). Each worker owns one SmtpSession, so messages
+    reuse the same authenticated connection.
+
+    Args:
+        workers: Number of sender threads
+        batch_size: Rows a worker claims at once
+        max_attempts: Deliveries tried before a transient error becomes 'failed'
+        poll_interval: Seconds an idle worker sleeps before looking again
+        session_factory: Callable returning a new SmtpSession
+    """
+
+    def __init__(self, workers=2, batch_size=20, max_attempts=3, poll_interval=5.0,
+                 session_factory=smtp_session_from_env):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.session_factory = session_factory
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self.stats = {"sent": 0, "failed": 0, "retried": 0}
+        self._stats_lock = threading.Lock()
+
+    def start(self):
+        if self._threads:
+            return self
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"email-outbox-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wake(self):
+        """Tell idle workers there is new mail instead of waiting for the next poll."""
+        self._wake.set()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _run(self):
+        session = self.session_factory()
+        try:
+            while not self._stop.is_set():
+                try:
+                    batch = self.claim()
+                except Exception:
+                    logger.exception("Could not claim queued emails")
+                    batch = []
+
+                if not batch:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+                    continue
+
+                # One UPDATE records the outcome of the whole batch
+                self._record([self._deliver(session, row) for row in batch])
+        finally:
+            session.close()
+
+    def _record(self, outcomes):
+        """
+        _finish() until it succeeds: the emails have already gone out, so a
+        failed UPDATE is retried every poll_interval rather than ending the
+        worker and leaving them to be sent again once their claim is stale.
+        """
+        while True:
+            try:
+                self._finish(outcomes)
+                return
+            except Exception:
+                logger.exception("Could not record the outcome of %d emails", len(outcomes))
+            if self._stop.wait(self.poll_interval):
+                return
+
+    def claim(self):
+        """Atomically move up to batch_size queued emails to 'sending' and return them."""
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+            UPDATE messages SET status = 'queued', claimed_at = NULL
+            WHERE message_type = 'email' AND status = 'sending'
+            AND claimed_at < NOW() - make_interval(secs => %s)
+            """, (STALE_CLAIM_SECONDS,))
+            cur.execute("""
+            UPDATE messages m SET status = 'sending', claimed_at = NOW(), attempts = m.attempts + 1
+            FROM (
+                SELECT id FROM messages
+                WHERE message_type = 'email' AND status = 'queued'
+                AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) q
+            WHERE m.id = q.id
+            RETURNING m.id, m.from_address, m.to_address, m.subject, m.content, m.attachment_path, m.attempts,
+                (SELECT filename FROM message_attachments a WHERE a.message_id = m.id ORDER BY a.id LIMIT 1)
+            """, (self.batch_size,))
+            rows = cur.fetchall()
+            conn.commit()
+            return rows
+        finally:
+            cur.close()
+            conn.close()
+
+    def _deliver(self, session, row):
+        """Send one claimed email; returns its (message_id, status, error, retry_in) outcome."""
+        message_id, from_address, to_address, subject, content, attachment_path, attempts, attachment_name = row
+        try:
+            msg = build_message(from_address, to_address, subject, content, attachment_path, attachment_name)
+            with PROVIDER_SECONDS.time(provider="smtp", operation="send_email"):
+                session.send(msg)
+        except Exception as e:
+            retry = is_transient(e) and attempts < self.max_attempts
+            PROVIDER_ERRORS.inc(provider="smtp", operation="send_email", outcome="retry" if retry else "failed",
+                                error=type(e).__name__)
+            logger.warning("Email %s to %s failed (attempt %s): %s", message_id, to_address, attempts, e)
+            self._count("retried" if retry else "failed")
+            if retry:
+                session.close()
+            # Back off 10s, 20s, 40s, ... before the next attempt
+            return message_id, "queued" if retry else "failed", str(e), 5 * 2 ** attempts if retry else None
+
+        self._count("sent")
+        return message_id, "sent", None, None
+
+    def _finish(self, outcomes):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            execute_values(cur, """
+            UPDATE messages m SET status = o.status, last_error = o.error, claimed_at = NULL,
+                next_attempt_at = NOW() + make_interval(secs => o.retry_in)
+            FROM (VALUES %s) AS o (id, status, error, retry_in)
+            WHERE m.id = o.id
+            """, outcomes, template="(%s::integer, %s::varchar, %s::text, %s::double precision)",
+                page_size=len(outcomes))
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+
+_outbox = None
+_outbox_pid = None
+_outbox_lock = threading.Lock()
+
+
+def get_email_outbox():
+    """Process-wide EmailOutbox, started on first use."""
+    global _outbox, _outbox_pid
+    with _outbox_lock:
+        if _outbox is None or _outbox_pid != os.getpid():
+            _outbox = EmailOutbox(
+                workers=int(os.getenv("EMAIL_WORKERS", "2")),
+                max_attempts=int(os.getenv("EMAIL_MAX_ATTEMPTS", "3")),
+            ).start()
+            _outbox_pid = os.getpid()
+        return _outbox
+
+
+def _outbox_depth():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+        SELECT status, COUNT(*) FROM messages
+        WHERE message_type = 'email' AND status IN ('queued', 'sending')
+        GROUP BY status
+        """)
+        depth = {"queued": 0, "sending": 0}
+        depth.update(cur.fetchall())
+        return [({"status": status}, count) for status, count in depth.items()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+Gauge("omni_email_outbox_depth", "Emails waiting for or in delivery", ["status"], collect=_outbox_depth)
@@ -0,0 +1,218 @@
+# previews.py - Thumbnails of image and PDF attachments, built in the background
+
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_TYPES = ("image/", "application/pdf")
+
+
+def can_preview(content_type):
+    return bool(content_type) and content_type.startswith(PREVIEW_TYPES)
+
+
+class PreviewCache:
+    """
+    Size-bounded on-disk cache of JPEG previews, keyed by blob SHA-256.
+
+    submit() queues a blob for a background worker, which renders a
+    thumbnail no larger than `max_size` pixels on either side (the first
+    page for PDFs, when PyMuPDF is installed) and stores it as
+    <root>/<sha256>.jpg. Identical attachments share one preview. Once the
+    files add up to more than `max_bytes`, the least recently used previews
+    are deleted; they are rebuilt if someone asks for them again.
+
+    The directory itself is the index: Streamlit and every webhook worker
+    have their own PreviewCache over the same files, so a hit is a stat of
+    the file (whichever process rendered it), recency is its access time,
+    and the byte bound is enforced by scanning the directory after each
+    render.
+
+    Args:
+        root: Directory for preview files (created on demand)
+        max_bytes: Total size of previews kept on disk
+        max_size: Longest side of a preview in pixels
+        workers: Render threads
+    """
+
+    def __init__(self, root, max_bytes=256 * 2**20, max_size=480, workers=1):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+        self.workers = workers
+        self._pending = set()
+        self._failed = set()
+        self._missing = set()  # modules a render could not import (Pillow, PyMuPDF)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = []
+        self.stats = {"hits": 0, "misses": 0, "rendered": 0, "failed": 0, "evicted": 0}
+
+    def start(self):
+        if self._threads:
+            return self
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"preview-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def path(self, sha256):
+        return os.path.join(self.root, f"{sha256}.jpg")
+
+    def get(self, sha256):
+        """Path of the preview if it is on disk (and mark it recently used), else None."""
+        path = self.path(sha256)
+        try:
+            # Set the access time explicitly, so eviction order does not
+            # depend on how the filesystem is mounted
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except FileNotFoundError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        with self._lock:
+            self.stats["hits"] += 1
+        return path
+
+    def submit(self, sha256, content_type, source_path):
+        """Queue a preview unless it exists, is already queued, or could not be built before."""
+        if not self._renderable(content_type):
+            return
+        with self._lock:
+            if sha256 in self._pending or sha256 in self._failed or os.path.exists(self.path(sha256)):
+                return
+            self._pending.add(sha256)
+        self._queue.put((sha256, content_type, source_path))
+
+    def status(self, sha256, content_type, source_path):
+        """
+        'ready', 'pending' or 'unavailable' for one attachment, queueing it
+        when there is no preview yet.
+        """
+        if not self._renderable(content_type):
+            return "unavailable"
+        if self.get(sha256):
+            return "ready"
+        self.submit(sha256, content_type, source_path)
+        with self._lock:
+            return "unavailable" if sha256 in self._failed else "pending"
+
+    def _renderable(self, content_type):
+        if not can_preview(content_type):
+            return False
+        needs = {"PIL", "fitz"} if content_type == "application/pdf" else {"PIL"}
+        with self._lock:
+            return not needs & self._missing
+
+    def _run(self):
+        while True:
+            sha256, content_type, source_path = self._queue.get()
+            try:
+                self.render(source_path, content_type, self.path(sha256))
+            except ImportError as e:
+                # Not this file's fault: remember the module and say so once
+                with self._lock:
+                    self._pending.discard(sha256)
+                    first = e.name not in self._missing
+                    self._missing.add(e.name)
+                if first:
+                    logger.warning("Previews of %s need the %s module, which is not installed: %s",
+                                   content_type, e.name, e)
+                continue
+            except Exception as e:
+                logger.warning("No preview for %s (%s): %s", sha256, content_type, e)
+                with self._lock:
+                    self._pending.discard(sha256)
+                    self._failed.add(sha256)
+                    self.stats["failed"] += 1
+                continue
+            with self._lock:
+                self._pending.discard(sha256)
+                self.stats["rendered"] += 1
+            self._evict()
+
+    def _evict(self):
+        """Delete the least recently used previews until the directory is within max_bytes."""
+        found = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_atime, entry.path, stat.st_size))
+        total = sum(size for _, _, size in found)
+        found.sort()
+        evicted = 0
+        # Another process may be evicting at the same time; a file it
+        # already removed still counts as freed
+        for _, path, size in found[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        if evicted:
+            with self._lock:
+                self.stats["evicted"] += evicted
+
+    def render(self, source_path, content_type, target_path):
+        """Write a JPEG thumbnail of source_path to target_path; returns its size in bytes."""
+        from PIL import Image, ImageOps
+
+        if content_type == "application/pdf":
+            image = self._render_pdf_page(source_path)
+        else:
+            image = Image.open(source_path)
+            # Let the JPEG decoder scale down while decoding instead of after
+            image.draft("RGB", (self.max_size, self.max_size))
+            image = ImageOps.exif_transpose(image)
+
+        image.thumbnail((self.max_size, self.max_size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = f"{target_path}.{threading.get_ident()}.tmp"
+        image.save(temp_path, "JPEG", quality=80, optimize=True)
+        os.replace(temp_path, target_path)
+        return os.path.getsize(target_path)
+
+    def _render_pdf_page(self, source_path):
+        # PyMuPDF is optional; without it PDFs simply get no preview
+        import fitz
+        from PIL import Image
+
+        with fitz.open(source_path) as document:
+            page = document[0]
+            zoom = self.max_size / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+
+_previews = None
+_previews_pid = None
+_previews_lock = threading.Lock()
+
+
+def get_preview_cache():
+    """Process-wide PreviewCache with its worker started."""
+    global _previews, _previews_pid
+    with _previews_lock:
+        if _previews is None or _previews_pid != os.getpid():
+            _previews = PreviewCache(
+                os.getenv("PREVIEW_DIR", os.path.join(os.getenv("ATTACHMENT_DIR", "attachments"), "previews")),
+                max_bytes=int(os.getenv("PREVIEW_CACHE_BYTES", str(256 * 2**20))),
+                max_size=int(os.getenv("PREVIEW_MAX_SIZE", "480")),
+                workers=int(os.getenv("PREVIEW_WORKERS", "1")),
+            ).start()
+            _previews_pid = os.getpid()
+        return _previews
@@ -0,0 +1,107 @@
+# query_cache.py - Per-process cache of UI read queries, invalidated by per-user versions
+
+import os
+import threading
+from collections import OrderedDict
+from metrics import Counter
+from notifications import get_event_hub
+
+LOOKUPS = Counter("omni_query_cache_lookups_total", "Query cache lookups by result (hit, miss, bypass)", ["result"])
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of read query results, shared by every session in the process.
+
+    An entry is keyed by the query function, its arguments and the user it
+    belongs to, and remembers the version it was loaded at: the user's local
+    write counter plus the EventHub version of the topic the query depends
+    on ("sms", "calls", "chat:<peer>", ...). Writes made in this process call
+    invalidate() right after committing, so they show up on the very next
+    rerun; writes from other processes (webhooks, workers) arrive through the
+    triggers' NOTIFY events. A lookup whose version no longer matches runs
+    the query again. While the EventHub is not listening, changes from other
+    processes cannot be seen, so every lookup goes to the database.
+
+    Cached rows are shared between sessions and must not be modified.
+
+    Args:
+        max_entries: Results held before the least recently used are evicted
+    """
+
+    def __init__(self, max_entries=2000, hub=None):
+        self.max_entries = max_entries
+        self._hub = hub
+        self._entries = OrderedDict()  # key -> (version, rows)
+        self._user_versions = {}  # user_id -> local write counter
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "bypasses": 0, "evictions": 0, "invalidations": 0}
+
+    def fetch(self, user_id, topic, func, *args, **kwargs):
+        """
+        func(*args, **kwargs), answered from the cache while neither
+        `user_id` nor `topic` has seen a write since it was stored.
+        """
+        hub_version = (self._hub or get_event_hub()).version(user_id, topic)
+        if hub_version is None:
+            self._count("bypasses", "bypass")
+            return func(*args, **kwargs)
+
+        key = (func.__module__, func.__qualname__, user_id, topic, args, tuple(sorted(kwargs.items())))
+        with self._lock:
+            version = (self._user_versions.get(user_id, 0), hub_version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                LOOKUPS.inc(result="hit")
+                return entry[1]
+            self.stats["misses"] += 1
+        LOOKUPS.inc(result="miss")
+
+        # Stored under the version read before querying: a write that lands
+        # meanwhile changes the version, so the next lookup reloads
+        rows = func(*args, **kwargs)
+        with self._lock:
+            self._entries[key] = (version, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return rows
+
+    def invalidate(self, *user_ids):
+        """Mark every cached result of these users stale; call after committing a write that concerns them."""
+        with self._lock:
+            self.stats["invalidations"] += 1
+            for user_id in user_ids:
+                if user_id is not None:
+                    self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+
+    def hit_rate(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"] + self.stats["bypasses"]
+            return self.stats["hits"] / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _count(self, key, result):
+        with self._lock:
+            self.stats[key] += 1
+        LOOKUPS.inc(result=result)
+
+
+_query_cache = None
+_query_cache_pid = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    """Process-wide QueryCache shared by every Streamlit session."""
+    global _query_cache, _query_cache_pid
+    with _query_cache_lock:
+        if _query_cache is None or _query_cache_pid != os.getpid():
+            _query_cache = QueryCache(max_entries=int(os.getenv("QUERY_CACHE_ENTRIES", "2000")))
+            _query_cache_pid = os.getpid()
+        return _query_cache
@@ -1,20 +1,22 @@
-import threading
-import os
-from app import flask_app
+# run.py - Start the webhook server and the Streamlit UI together for local use
 
-def run_flask():
-    flask_app.run(host='0.0.0.0', port=5000)
+import subprocess
+import sys
 
-def run_streamlit():
-    # Use the full path to the Streamlit executable
-    streamlit_path = r'C:\Users\angel\AppData\Roaming\Python\Python313\Scripts\streamlit.exe'
-    os.system(f'"{streamlit_path}" run app.py')
 
-if __name__ == '__main__':
-    # Start Flask in a separate thread
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
-    
-    # Run Streamlit in the main thread
-    run_streamlit()
\ No newline at end of file
+def main():
+    # Separate processes: the webhook server forks its own workers, and
+    # Streamlit reruns never compete with Twilio's requests
+    webhooks = subprocess.Popen([sys.executable, "webhook_server.py"] + sys.argv[1:])
+    try:
+        subprocess.call([sys.executable, "-m", "streamlit", "run", "app.py"])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # SIGTERM is gunicorn's graceful shutdown: finish requests, write queued events
+        webhooks.terminate()
+        webhooks.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# tests/conftest.py - Shared fixtures: import paths and the optional query-plan database
+#
+# The pure-function tests need nothing but the source tree. The query-plan
+# tests run only when TEST_DB_NAME names a scratch database on the server
+# configured by the usual DB_* variables; it is created and seeded on first
+# use (TEST_DB_MESSAGES / TEST_DB_CALLS rows), never the application database.
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+# After the app's modules, as several benchmarks share their names
+sys.path.append(os.path.join(ROOT, "benchmarks"))
+
+
+@pytest.fixture(scope="session")
+def plan_database():
+    """(app module, heavy user id, light user id) on the seeded TEST_DB_NAME database."""
+    name = os.getenv("TEST_DB_NAME")
+    if not name:
+        pytest.skip("TEST_DB_NAME is not set")
+
+    import psycopg2
+    from common import seed, use_bench_database
+
+    try:
+        use_bench_database(name)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"no database server: {e}")
+    heavy_id = seed(users=2000, messages=int(os.getenv("TEST_DB_MESSAGES", "200000")),
+                    calls=int(os.getenv("TEST_DB_CALLS", "40000")), random_seed=0.5)
+
+    import app
+    from db import get_db_connection
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE username = 'bench42'")
+    light_id = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return app, heavy_id, light_id
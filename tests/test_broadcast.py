@@ -0,0 +1,30 @@
+# tests/test_broadcast.py - Recipient list clean-up for broadcasts
+
+import pytest
+
+from broadcast import normalize_recipients
+
+
+def test_sms_strips_punctuation_and_drops_duplicates():
+    addresses, rejected, duplicates = normalize_recipients(
+        "sms", ["+1 (555) 010-0001", "+1.555.010.0001", "+15550100002", " +15550100001 "])
+    assert addresses == ["+15550100001", "+15550100002"]
+    assert (rejected, duplicates) == (0, 2)
+
+
+def test_sms_rejects_invalid_numbers():
+    addresses, rejected, duplicates = normalize_recipients("sms", ["12", "call me", "", None, "+0123456789"])
+    assert addresses == []
+    assert (rejected, duplicates) == (5, 0)
+
+
+def test_email_lowercases_and_keeps_first_seen_order():
+    addresses, rejected, duplicates = normalize_recipients(
+        "email", ["Bob@Example.com", "alice@example.com", "bob@example.COM", "not-an-address", "a@b"])
+    assert addresses == ["bob@example.com", "alice@example.com"]
+    assert (rejected, duplicates) == (2, 1)
+
+
+def test_unknown_channel():
+    with pytest.raises(ValueError):
+        normalize_recipients("chat", ["user2"])
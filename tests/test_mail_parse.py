@@ -0,0 +1,62 @@
+# tests/test_mail_parse.py - Inbound email bodies turned into safe plain text and previews
+
+from email.message import EmailMessage
+
+import mail_parse
+from mail_parse import EMPTY_RESULT, PREVIEW_LENGTH, EmailParser, clean_text, html_to_text, make_preview, parse_email
+
+
+def test_clean_text_drops_control_characters_and_tidies_whitespace():
+    text = "Hello\x00\x07 \t world\r\n\r\n\r\n\r\nBye\x1b  now  "
+    assert clean_text(text) == "Hello world\n\nBye now"
+
+
+def test_html_to_text_skips_scripts_and_styles():
+    html = ("<html><head><title>T</title><style>p {color: red}</style></head>"
+            "<body><p>First &amp; foremost</p><script>alert(1)</script><div>Second</div></body></html>")
+    assert clean_text(html_to_text(html)) == "First & foremost\n\nSecond"
+
+
+def test_make_preview_is_one_line_and_bounded():
+    assert make_preview("a\nb\n\nc") == "a b c"
+    preview = make_preview("word " * 100)
+    assert len(preview) <= PREVIEW_LENGTH
+    assert preview.endswith("...")
+
+
+def test_parse_email_prefers_plain_text_and_keeps_attachments():
+    msg = EmailMessage()
+    msg["Subject"] = "Invoice"
+    msg.set_content("Plain\x00 body")
+    msg.add_alternative("<p>HTML body</p>", subtype="html")
+    msg.add_attachment(b"%PDF-1.4", maintype="application", subtype="pdf", filename="invoice.pdf")
+
+    parsed = parse_email(msg.as_bytes())
+    assert parsed["body"] == "Plain body"
+    assert parsed["preview"] == "Plain body"
+    assert parsed["attachments"] == [("invoice.pdf", b"%PDF-1.4")]
+
+
+def test_parse_email_sanitises_html_only_message():
+    msg = EmailMessage()
+    msg.set_content("<p>Hi<script>steal()</script></p><p>there</p>", subtype="html")
+    assert parse_email(msg.as_bytes())["body"] == "Hi\n\nthere"
+
+
+def test_parse_email_reads_unknown_charset_as_utf8():
+    msg = EmailMessage()
+    msg.set_content("h\u00e9llo")
+    msg.replace_header("Content-Type", 'text/plain; charset="x-unknown-8bit"')
+    assert parse_email(msg.as_bytes())["body"] == "h\u00e9llo"
+
+
+def test_parse_many_returns_empty_result_for_a_failing_message(monkeypatch):
+    def parse(raw):
+        if raw == b"broken":
+            raise RuntimeError("cannot parse")
+        return {"body": raw.decode(), "preview": "", "attachments": []}
+
+    monkeypatch.setattr(mail_parse, "parse_email", parse)
+    results = EmailParser(inline_bytes=1024).parse_many([b"first", b"broken", b"last"])
+    assert [result["body"] for result in results] == ["first", "", "last"]
+    assert results[1] is EMPTY_RESULT
@@ -0,0 +1,40 @@
+# tests/test_notifications.py - Which sessions an event from the triggers wakes up
+
+import identity
+from notifications import ALL_TOPIC, EventHub, topics_for
+
+
+def test_chat_event_per_conversation():
+    assert topics_for({"kind": "chat", "users": [1, 2]}) == {
+        (1, ALL_TOPIC), (1, "chat:2"), (2, ALL_TOPIC), (2, "chat:1"),
+    }
+
+
+def test_call_event_uses_calls_topic():
+    assert topics_for({"kind": "call", "users": [3, None]}) == {(3, ALL_TOPIC), (3, "calls")}
+
+
+def test_channel_event_uses_its_kind():
+    assert topics_for({"kind": "sms", "users": [4, 5]}) == {
+        (4, ALL_TOPIC), (4, "sms"), (5, ALL_TOPIC), (5, "sms"),
+    }
+
+
+def test_event_without_users_or_kind():
+    assert topics_for({"kind": "email"}) == set()
+    assert topics_for({"users": [6]}) == {(6, ALL_TOPIC)}
+
+
+def test_user_event_invalidates_identities(monkeypatch):
+    invalidated = []
+
+    class Identities:
+        def invalidate(self, user_id=None):
+            invalidated.append(user_id)
+
+    monkeypatch.setattr(identity, "get_identity_cache", Identities)
+    hub = EventHub()
+    hub.dispatch('{"kind": "user", "users": [7, 8]}')
+    hub.dispatch('{"kind": "user"}')
+    assert invalidated == [7, 8, None]
+    assert hub.stats["user_changes"] == 2 and hub.stats["events"] == 0
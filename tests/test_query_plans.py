@@ -0,0 +1,31 @@
+# tests/test_query_plans.py - Every hot query reads its tables through an index
+#
+# The checks of benchmarks/query_plans.py as one test each. Only the plan
+# shape is asserted here; latency budgets belong to the benchmark, on its
+# full-size dataset.
+
+import psycopg2
+import pytest
+
+import query_plans
+from db import get_db_settings
+
+
+@pytest.fixture(scope="module")
+def checks(plan_database):
+    app, heavy_id, light_id = plan_database
+    pool = query_plans.record_app_queries(app)
+    explain_conn = psycopg2.connect(**get_db_settings())
+    yield explain_conn, {name: (run, tables) for name, run, tables in query_plans.build_checks(app, heavy_id, light_id)}
+    explain_conn.close()
+    pool.closeall()
+
+
+@pytest.mark.parametrize("name", query_plans.CHECK_NAMES)
+def test_uses_index(checks, name):
+    explain_conn, by_name = checks
+    run, guarded_tables = by_name[name]
+    results = query_plans.check_plans(explain_conn, run, guarded_tables, budget_ms=float("inf"))
+    assert results, f"{name} issued no reads"
+    for statement, _, _, problems in results:
+        assert not problems, f"{', '.join(problems)}:\n{statement}"
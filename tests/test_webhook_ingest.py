@@ -0,0 +1,96 @@
+# tests/test_webhook_ingest.py - Coalescing of Twilio status callbacks within one batch
+
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from webhook_ingest import WebhookIngestor, _coalesce_call_statuses, _coalesce_message_statuses
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def at(seconds):
+    return T0 + timedelta(seconds=seconds)
+
+
+def test_message_keeps_most_advanced_status():
+    rows = _coalesce_message_statuses([
+        ("SM1", "delivered", None, at(1)),
+        ("SM1", "sent", None, at(2)),
+        ("SM1", "read", None, at(3)),
+    ])
+    assert rows == [("SM1", "read", 4, None)]
+
+
+def test_message_keeps_error_of_earlier_callback():
+    rows = _coalesce_message_statuses([
+        ("SM1", "undelivered", "Twilio error 30003", at(1)),
+        ("SM1", "failed", None, at(2)),
+    ])
+    assert rows == [("SM1", "failed", 3, "Twilio error 30003")]
+
+
+def test_message_one_row_per_sid():
+    rows = _coalesce_message_statuses([
+        ("SM1", "sent", None, at(1)),
+        ("SM2", "queued", None, at(1)),
+        ("SM1", "delivered", None, at(2)),
+    ])
+    assert sorted(rows) == [("SM1", "delivered", 3, None), ("SM2", "queued", 0, None)]
+
+
+def test_call_answered_then_completed():
+    rows = _coalesce_call_statuses([
+        ("CA1", "ongoing", False, None, at(0)),
+        ("CA1", "ongoing", True, None, at(5)),
+        ("CA1", "completed", False, 42, at(47)),
+    ])
+    assert rows == [("CA1", "completed", 2, at(5), at(47), 42)]
+
+
+def test_call_late_ringing_does_not_undo_completed():
+    rows = _coalesce_call_statuses([
+        ("CA1", "completed", False, 10, at(20)),
+        ("CA1", "ongoing", True, None, at(3)),
+    ])
+    assert rows == [("CA1", "completed", 2, at(3), at(20), 10)]
+
+
+def test_call_earliest_answer_wins():
+    rows = _coalesce_call_statuses([
+        ("CA1", "ongoing", True, None, at(9)),
+        ("CA1", "ongoing", True, None, at(4)),
+    ])
+    assert rows == [("CA1", "ongoing", 1, at(4), None, None)]
+
+
+def failing_flush(ingestor, errors):
+    """Replace flush() with one that raises errors[event values] and records what it wrote."""
+    written = []
+
+    def flush(events):
+        for _, values in events:
+            if values in errors:
+                raise errors[values]
+        written.extend(values for _, values in events)
+
+    ingestor.flush = flush
+    return written
+
+
+def test_flush_each_drops_only_bad_events():
+    ingestor = WebhookIngestor()
+    written = failing_flush(ingestor, {"bad": ValueError("NUL character")})
+    left = ingestor._flush_each([("sms", "good1"), ("sms", "bad"), ("sms", "good2")])
+    assert left == []
+    assert written == ["good1", "good2"]
+    assert ingestor.stats["dead_letters"] == 1
+
+
+def test_flush_each_keeps_events_when_database_is_unreachable():
+    ingestor = WebhookIngestor()
+    written = failing_flush(ingestor, {"second": psycopg2.OperationalError("server closed the connection")})
+    events = [("sms", "first"), ("sms", "second"), ("sms", "third")]
+    assert ingestor._flush_each(events) == events[1:]
+    assert written == ["first"]
+    assert ingestor.stats["dead_letters"] == 0
@@ -0,0 +1,425 @@
+# twilio_dispatch.py - Durable outbox and concurrent dispatcher for Twilio SMS and calls
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from db import get_db_connection
+from metrics import Gauge, PROVIDER_ERRORS, PROVIDER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Rows stuck in 'sending' this long (dispatcher died mid-request) are queued again
+STALE_CLAIM_SECONDS = 600
+
+
+class TwilioApiError(Exception):
+    def __init__(self, status, body):
+        super().__init__(f"Twilio API returned {status}: {body}")
+        self.status = status
+        self.body = body
+
+    @property
+    def retryable(self):
+        return self.status == 429 or self.status >= 500
+
+
+class CallNotPlaced(Exception):
+    """end_call ran while the call it should hang up is still being placed."""
+
+    retryable = True
+
+
+class TwilioApi:
+    """
+    Minimal Twilio REST client over a single pooled requests.Session.
+
+    Every request reuses the session's keep-alive connections instead of
+    constructing a new twilio Client (and TLS connection) per call.
+    `base_url` can point at a local stand-in.
+    """
+
+    def __init__(self, account_sid, auth_token, base_url="https://api.twilio.com", timeout=15, pool_size=10):
+        self.account_sid = account_sid
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (account_sid, auth_token)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _post(self, path, data):
+        url = f"{self.base_url}/2010-04-01/Accounts/{self.account_sid}/{path}"
+        response = self.session.post(url, data=data, timeout=self.timeout)
+        if response.status_code >= 400:
+            raise TwilioApiError(response.status_code, response.text[:500])
+        return response.json()
+
+    def create_message(self, from_, to, body, media_url=None, status_callback=None):
+        data = {"From": from_, "To": to, "Body": body}
+        if media_url:
+            data["MediaUrl"] = media_url
+        if status_callback:
+            data["StatusCallback"] = status_callback
+        return self._post("Messages.json", data)
+
+    def create_call(self, from_, to, url, status_callback=None):
+        data = {"From": from_, "To": to, "Url": url}
+        if status_callback:
+            data["StatusCallback"] = status_callback
+            # Only 'completed' is reported unless the other events are asked for
+            data["StatusCallbackEvent"] = ["initiated", "ringing", "answered", "completed"]
+        return self._post("Calls.json", data)
+
+    def update_call(self, call_sid, status):
+        return self._post(f"Calls/{call_sid}.json", {"Status": status})
+
+    def close(self):
+        self.session.close()
+
+
+class RateLimiter:
+    """Token bucket: `rate` operations per second with bursts up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def enqueue(cur, kind, payload, message_id=None, call_id=None):
+    """
+    Add a job to the outbox using the caller's cursor, so it commits (or
+    rolls back) together with the messages/calls row it belongs to.
+    """
+    cur.execute("""
+    INSERT INTO outbox (kind, payload, message_id, call_id)
+    VALUES (%s, %s, %s, %s)
+    RETURNING id
+    """, (kind, json.dumps(payload), message_id, call_id))
+    return cur.fetchone()[0]
+
+
+class TwilioDispatcher:
+    """
+    Drains the outbox table with a bounded pool of worker threads.
+
+    One thread claims queued jobs (FOR UPDATE SKIP LOCKED, never more than
+    there are idle workers) and hands them to the pool. Messages and calls
+    each pass through their own per-account token bucket. Failures with a
+    429/5xx or connection error are retried with exponential backoff; the
+    outcome is written back to the messages/calls row.
+
+    Args:
+        api: TwilioApi used for every request
+        workers: Concurrent requests in flight
+        messages_per_second: Message send rate (Twilio long codes allow 1/s)
+        calls_per_second: Outbound call rate
+        max_attempts: Tries before a job is marked failed
+        poll_interval: Seconds to sleep when the outbox is empty
+        status_callback_base: Public base URL of the Flask app; when set,
+            Twilio reports delivery and call progress to its /twilio/*-status
+            routes, which keep messages and calls up to date
+    """
+
+    def __init__(self, api, workers=4, messages_per_second=1.0, calls_per_second=1.0,
+                 max_attempts=5, poll_interval=5.0, backoff_base=2.0, status_callback_base=None):
+        self.api = api
+        self.status_callback_base = status_callback_base.rstrip("/") if status_callback_base else None
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self.limiters = {
+            "sms": RateLimiter(messages_per_second, burst=max(1, int(messages_per_second))),
+            "call": RateLimiter(calls_per_second, burst=max(1, int(calls_per_second))),
+        }
+        self._slots = threading.Semaphore(workers)
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.stats = {"sent": 0, "retried": 0, "failed": 0}
+        self._stats_lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="twilio-dispatch")
+        self._thread = threading.Thread(target=self._run, name="twilio-dispatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def wake(self):
+        self._wake.set()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Wait for at least one idle worker before claiming anything
+            self._slots.acquire()
+            free = 1
+            while free < self.workers and self._slots.acquire(blocking=False):
+                free += 1
+
+            try:
+                jobs = self.claim(free)
+            except Exception:
+                logger.exception("Could not claim outbox jobs")
+                jobs = []
+
+            for _ in range(free - len(jobs)):
+                self._slots.release()
+            for job in jobs:
+                self._executor.submit(self._process, job)
+
+            if not jobs:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def claim(self, limit):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+            UPDATE outbox SET status = 'queued'
+            WHERE status = 'sending' AND updated_at < NOW() - make_interval(secs => %s)
+            """, (STALE_CLAIM_SECONDS,))
+            cur.execute("""
+            UPDATE outbox o SET status = 'sending', attempts = o.attempts + 1, updated_at = NOW()
+            FROM (
+                SELECT id FROM outbox
+                WHERE status = 'queued' AND next_attempt_at <= NOW()
+                ORDER BY next_attempt_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) q
+            WHERE o.id = q.id
+            RETURNING o.id, o.kind, o.payload, o.message_id, o.call_id, o.attempts
+            """, (limit,))
+            jobs = cur.fetchall()
+            conn.commit()
+            return jobs
+        finally:
+            cur.close()
+            conn.close()
+
+    def _process(self, job):
+        job_id, kind, payload, message_id, call_id, attempts = job
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        try:
+            try:
+                statements = getattr(self, f"_send_{kind}")(payload, message_id, call_id)
+            except Exception as e:
+                self._handle_error(job_id, kind, message_id, call_id, attempts, e)
+                return
+            # Twilio accepted the request: from here on the job is never
+            # retried or failed, only its outcome written
+            self._record(job_id, statements)
+            self._count("sent")
+        finally:
+            self._slots.release()
+            self._wake.set()
+
+    def _handle_error(self, job_id, kind, message_id, call_id, attempts, e):
+        """Retry a send Twilio did not accept with backoff, or fail it after max_attempts."""
+        retryable = isinstance(e, requests.RequestException) or getattr(e, "retryable", False)
+        PROVIDER_ERRORS.inc(provider="twilio", operation=kind, error=type(e).__name__,
+                            outcome="retry" if retryable and attempts < self.max_attempts else "failed")
+        if retryable and attempts < self.max_attempts:
+            delay = self.backoff_base * 2 ** (attempts - 1) * (1 + random.random() / 2)
+            self._retry(job_id, delay, str(e))
+            self._count("retried")
+        else:
+            logger.warning("Outbox job %s (%s) failed: %s", job_id, kind, e)
+            self._fail(job_id, kind, message_id, call_id, str(e))
+            self._count("failed")
+
+    def _record(self, job_id, statements):
+        """
+        _complete() until it succeeds, backing off up to a minute between
+        tries, so a sent SMS or placed call keeps its SID instead of being
+        marked failed by a database error.
+        """
+        delay = self.backoff_base
+        while True:
+            try:
+                self._complete(job_id, statements)
+                return
+            except Exception:
+                logger.exception("Could not record the outcome of outbox job %s; retrying", job_id)
+            if self._stop.wait(delay):
+                return
+            delay = min(delay * 2, 60)
+
+    def _send_sms(self, payload, message_id, call_id):
+        self.limiters["sms"].acquire()
+        with PROVIDER_SECONDS.time(provider="twilio", operation="sms"):
+            result = self.api.create_message(payload["from"], payload["to"], payload["body"],
+                                             media_url=payload.get("media_url"),
+                                             status_callback=self._status_callback("message-status"))
+        return [("UPDATE messages SET status = 'sent', twilio_sid = %s, last_error = NULL WHERE id = %s",
+                 (result.get("sid"), message_id))]
+
+    def _send_call(self, payload, message_id, call_id):
+        self.limiters["call"].acquire()
+        with PROVIDER_SECONDS.time(provider="twilio", operation="call"):
+            result = self.api.create_call(payload["from"], payload["to"], payload["url"],
+                                          status_callback=self._status_callback("call-status"))
+        return [("UPDATE calls SET status = 'ongoing', call_sid = %s, start_time = NOW() "
+                 "WHERE id = %s AND status = 'queued'", (result.get("sid"), call_id))]
+
+    def _status_callback(self, route):
+        return f"{self.status_callback_base}/twilio/{route}" if self.status_callback_base else None
+
+    def _send_end_call(self, payload, message_id, call_id):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT call_sid, status FROM calls WHERE id = %s FOR UPDATE", (call_id,))
+            call_sid, status = cur.fetchone()
+            if call_sid is None:
+                if status != "queued":
+                    # Failed, canceled or missed without ever being placed:
+                    # nothing to hang up
+                    conn.rollback()
+                    return []
+                # Hung up before it was dialled: cancel the pending call job instead
+                cur.execute("""
+                UPDATE outbox SET status = 'canceled', updated_at = NOW()
+                WHERE call_id = %s AND kind = 'call' AND status = 'queued'
+                """, (call_id,))
+                if cur.rowcount == 0:
+                    # A worker already claimed the call job and is dialling;
+                    # retry once its call_sid is stored, so the call can be hung up
+                    conn.rollback()
+                    raise CallNotPlaced(f"call {call_id} is being placed")
+                cur.execute("UPDATE calls SET status = 'canceled', end_time = NOW() WHERE id = %s", (call_id,))
+                conn.commit()
+                return []
+            conn.rollback()
+        finally:
+            cur.close()
+            conn.close()
+
+        with PROVIDER_SECONDS.time(provider="twilio", operation="end_call"):
+            self.api.update_call(call_sid, "completed")
+        return [("UPDATE calls SET status = 'completed', end_time = NOW() WHERE id = %s", (call_id,))]
+
+    def _complete(self, job_id, statements):
+        """Apply a handler's row updates and close the job in one transaction."""
+        self._execute(*statements, (
+            "UPDATE outbox SET status = 'done', last_error = NULL, updated_at = NOW() WHERE id = %s", (job_id,)
+        ))
+
+    def _retry(self, job_id, delay, error):
+        self._execute(("""
+        UPDATE outbox SET status = 'queued', last_error = %s, updated_at = NOW(),
+            next_attempt_at = NOW() + make_interval(secs => %s)
+        WHERE id = %s
+        """, (error, delay, job_id)))
+
+    def _fail(self, job_id, kind, message_id, call_id, error):
+        statements = [("UPDATE outbox SET status = 'failed', last_error = %s, updated_at = NOW() WHERE id = %s",
+                       (error, job_id))]
+        if message_id is not None:
+            statements.append(("UPDATE messages SET status = 'failed', last_error = %s WHERE id = %s",
+                               (error, message_id)))
+        if kind == "call":
+            statements.append(("UPDATE calls SET status = 'failed', end_time = NOW() WHERE id = %s", (call_id,)))
+        self._execute(*statements)
+
+    def _execute(self, *statements):
+        """Run (sql, params) pairs in a single transaction."""
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            for sql, params in statements:
+                cur.execute(sql, params)
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Process-wide TwilioDispatcher configured from the environment, started on first use."""
+    global _dispatcher, _dispatcher_pid
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher_pid != os.getpid():
+            api = TwilioApi(
+                os.getenv("TWILIO_ACCOUNT_SID"),
+                os.getenv("TWILIO_AUTH_TOKEN"),
+                base_url=os.getenv("TWILIO_API_BASE", "https://api.twilio.com"),
+            )
+            _dispatcher = TwilioDispatcher(
+                api,
+                workers=int(os.getenv("TWILIO_WORKERS", "4")),
+                messages_per_second=float(os.getenv("TWILIO_MPS", "1")),
+                calls_per_second=float(os.getenv("TWILIO_CPS", "1")),
+                max_attempts=int(os.getenv("TWILIO_MAX_ATTEMPTS", "5")),
+                status_callback_base=(os.getenv("PUBLIC_BASE_URL", "http://localhost:5000")
+                                      if os.getenv("TWILIO_STATUS_CALLBACKS", "false").lower() == "true" else None),
+            ).start()
+            _dispatcher_pid = os.getpid()
+        return _dispatcher
+
+
+def _outbox_depth():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+        SELECT kind, status, COUNT(*) FROM outbox
+        WHERE status IN ('queued', 'sending')
+        GROUP BY kind, status
+        """)
+        # Empty queues report 0 rather than disappearing from the scrape
+        depth = {(kind, status): 0 for kind in ("sms", "call", "end_call") for status in ("queued", "sending")}
+        depth.update(((kind, status), count) for kind, status, count in cur.fetchall())
+        return [({"kind": kind, "status": status}, count) for (kind, status), count in depth.items()]
+    finally:
+        cur.close()
+        conn.close()
+
+
+Gauge("omni_twilio_outbox_depth", "Twilio jobs waiting for or in delivery", ["kind", "status"], collect=_outbox_depth)
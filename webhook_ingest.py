@@ -0,0 +1,387 @@
+# webhook_ingest.py - Write-behind ingestion of Twilio webhooks
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+import psycopg2
+from psycopg2.extras import execute_values
+from db import PoolTimeout, get_db_connection
+from metrics import Counter, Gauge, Histogram
+from query_cache import get_query_cache
+
+logger = logging.getLogger(__name__)
+
+# One multi-row INSERT per kind per flush. Sender/receiver ids are resolved
+# by joining users in the same statement, and the unique SID indexes turn a
+# Twilio retry of an already stored event into a no-op.
+INSERT_SMS = """
+INSERT INTO messages (sender_id, receiver_id, message_type, content, status, twilio_sid, from_address, to_address,
+                      created_at)
+SELECT s.id, r.id, 'sms', v.body, 'received', v.sid, v.from_phone, v.to_phone, v.received_at
+FROM (VALUES %s) AS v (sid, from_phone, to_phone, body, received_at)
+LEFT JOIN users s ON s.phone_number = v.from_phone
+LEFT JOIN users r ON r.phone_number = v.to_phone
+ON CONFLICT (twilio_sid) WHERE twilio_sid IS NOT NULL DO NOTHING
+RETURNING sender_id, receiver_id
+"""
+
+# Inbound calls are forwarded to user2 and only recorded for known callers
+INSERT_CALL = """
+INSERT INTO calls (caller_id, receiver_id, receiver_phone, start_time, status, direction, call_sid, created_at)
+SELECT c.id, r.id, r.phone_number, v.received_at, 'ongoing', 'inbound', v.sid, v.received_at
+FROM (VALUES %s) AS v (sid, from_phone, received_at)
+JOIN users c ON c.phone_number = v.from_phone
+CROSS JOIN (SELECT id, phone_number FROM users WHERE username = 'user2') r
+ON CONFLICT (call_sid) WHERE call_sid IS NOT NULL DO NOTHING
+RETURNING caller_id, receiver_id
+"""
+
+# Twilio delivery statuses as stored in messages.status, and how far along
+# each is: a late or repeated callback never moves a message backwards
+MESSAGE_STATUSES = {
+    "accepted": "queued", "scheduled": "queued", "queued": "queued", "sending": "sending", "sent": "sent",
+    "delivered": "delivered", "undelivered": "undelivered", "failed": "failed", "read": "read",
+}
+MESSAGE_STATUS_RANK = {"queued": 0, "sending": 1, "sent": 2, "delivered": 3, "undelivered": 3, "failed": 3, "read": 4}
+
+# Twilio call progress as stored in calls.status
+CALL_STATUSES = {
+    "queued": "queued", "initiated": "ongoing", "ringing": "ongoing", "in-progress": "ongoing",
+    "completed": "completed", "busy": "missed", "no-answer": "missed", "failed": "failed", "canceled": "canceled",
+}
+CALL_STATUS_RANK = {"queued": 0, "ongoing": 1, "completed": 2, "missed": 2, "failed": 2, "canceled": 2}
+
+
+def _rank_sql(column, ranks):
+    return "CASE " + column + "".join(f" WHEN '{status}' THEN {rank}" for status, rank in ranks.items()) + " ELSE 0 END"
+
+
+# One UPDATE per kind per flush, with at most one row per SID (see
+# _coalesce_*). Rows whose SID is not stored yet are not returned, so the
+# flusher can try them again.
+UPDATE_MESSAGE_STATUS = """
+UPDATE messages m SET
+    status = CASE WHEN v.rank >= """ + _rank_sql("m.status", MESSAGE_STATUS_RANK) + """ THEN v.status ELSE m.status END,
+    last_error = COALESCE(v.error, m.last_error)
+FROM (VALUES %s) AS v (sid, status, rank, error)
+WHERE m.twilio_sid = v.sid
+RETURNING v.sid, m.sender_id, m.receiver_id
+"""
+
+UPDATE_CALL_STATUS = """
+UPDATE calls c SET
+    status = CASE WHEN v.rank >= """ + _rank_sql("c.status", CALL_STATUS_RANK) + """ THEN v.status ELSE c.status END,
+    answered_at = COALESCE(c.answered_at, v.answered_at),
+    end_time = COALESCE(c.end_time, v.ended_at),
+    duration = COALESCE(v.duration, c.duration)
+FROM (VALUES %s) AS v (sid, status, rank, answered_at, ended_at, duration)
+WHERE c.call_sid = v.sid
+RETURNING v.sid, c.caller_id, c.receiver_id
+"""
+
+
+def _coalesce_message_statuses(events):
+    """Fold a burst of (sid, status, error, received_at) callbacks into the most advanced status per SID."""
+    latest = {}
+    for sid, status, error, received_at in events:
+        rank = MESSAGE_STATUS_RANK[status]
+        current = latest.get(sid)
+        if current is None or rank >= current[2]:
+            latest[sid] = (sid, status, rank, error or (current[3] if current else None))
+    return list(latest.values())
+
+
+def _coalesce_call_statuses(events):
+    """
+    Fold (sid, status, answered, duration, received_at) callbacks into one
+    row per SID: the most advanced status, when it was answered and ended.
+    """
+    calls = {}
+    for sid, status, answered, duration, received_at in events:
+        call = calls.setdefault(sid, {"status": status, "rank": -1, "answered_at": None, "ended_at": None,
+                                      "duration": None})
+        rank = CALL_STATUS_RANK[status]
+        if rank >= call["rank"]:
+            call["status"], call["rank"] = status, rank
+        if answered and (call["answered_at"] is None or received_at < call["answered_at"]):
+            call["answered_at"] = received_at
+        if rank == 2:
+            call["ended_at"] = received_at
+        if duration is not None:
+            call["duration"] = duration
+    return [(sid, c["status"], c["rank"], c["answered_at"], c["ended_at"], c["duration"]) for sid, c in calls.items()]
+
+
+def _is_transient(error):
+    """True for errors of reaching the database rather than of the events themselves."""
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout))
+
+
+FLUSH_SECONDS = Histogram("omni_webhook_flush_seconds", "Time to write one batch of webhook events")
+WEBHOOK_ERRORS = Counter("omni_webhook_errors_total", "Webhook events refused (queue full) and failed flushes",
+                         ["error"])
+
+
+class WebhookIngestor:
+    """
+    Buffers webhook events in memory and batch-inserts them from one thread.
+
+    Handlers call submit() and answer Twilio straight away; the flusher
+    writes whatever has queued up every `flush_interval` seconds (or as soon
+    as `batch_size` events are waiting). A flush that fails because the
+    database is unreachable keeps its batch and tries again; one that fails
+    on the data is retried an event at a time, and events that still fail
+    are logged and dropped so they cannot hold up the rest. stop() drains
+    the queue before returning.
+
+    Delivery-status callbacks are coalesced per SID within a batch, so a
+    message's sent/delivered/read arrive as one row of one bulk UPDATE. A
+    status for a SID that is not stored yet (the callback beat the
+    dispatcher's own update) is retried with later batches for up to
+    `status_wait` seconds.
+
+    Args:
+        batch_size: Most events written per INSERT
+        flush_interval: Longest an event waits before it is written
+        max_queue: Events held in memory before submit() refuses more
+        retry_interval: Seconds to wait after a failed flush
+        status_wait: Seconds a status callback for an unknown SID is kept
+    """
+
+    def __init__(self, batch_size=500, flush_interval=0.2, max_queue=50000, retry_interval=1.0, status_wait=30.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.status_wait = status_wait
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._deferred = []  # status events whose SID was not found yet
+        self._deferred_at = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"received": 0, "rejected": 0, "inserted": 0, "skipped": 0, "status_updates": 0,
+                      "status_deferred": 0, "status_dropped": 0, "dead_letters": 0,
+                      "batches": 0, "flush_errors": 0, "flush_seconds": 0.0}
+        self._stats_lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="webhook-flusher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """Flush everything still queued, then stop the flusher."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, kind, values):
+        """
+        Queue one event without touching the database.
+
+        Args:
+            kind: 'sms', 'call', 'sms_status' or 'call_status'
+            values: Row tuple matching the VALUES list of that kind's INSERT,
+                or the arguments of the _coalesce_* function for statuses
+
+        Returns False when the queue is full; the handler should then answer
+        with an error so Twilio retries later.
+        """
+        try:
+            self._queue.put_nowait((kind, values))
+        except queue.Full:
+            self._count("rejected")
+            WEBHOOK_ERRORS.inc(error="queue_full")
+            return False
+        self._count("received")
+        return True
+
+    def submit_sms(self, message_sid, from_phone, to_phone, body):
+        return self.submit("sms", (message_sid, from_phone, to_phone, body, datetime.now()))
+
+    def submit_call(self, call_sid, from_phone):
+        return self.submit("call", (call_sid, from_phone, datetime.now()))
+
+    def submit_message_status(self, message_sid, twilio_status, error_code=None):
+        """Queue a message status callback; statuses of inbound messages are acknowledged and ignored."""
+        status = MESSAGE_STATUSES.get(twilio_status)
+        if status is None:
+            return True
+        error = f"Twilio error {error_code}" if error_code else None
+        return self.submit("sms_status", (message_sid, status, error, datetime.now()))
+
+    def submit_call_status(self, call_sid, twilio_status, duration=None):
+        """Queue a call status callback; `duration` is Twilio's CallDuration in seconds."""
+        status = CALL_STATUSES.get(twilio_status)
+        if status is None:
+            return True
+        duration = int(duration) if duration and str(duration).isdigit() else None
+        return self.submit("call_status", (call_sid, status, twilio_status == "in-progress", duration, datetime.now()))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _take(self, batch):
+        """Add queued events to `batch`, waiting at most flush_interval for the first one."""
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0 and not self._stop.is_set():
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _run(self):
+        batch = []
+        while True:
+            stopping = self._stop.is_set()
+            if self._deferred and time.monotonic() - self._deferred_at >= self.retry_interval:
+                batch.extend(self._deferred)
+                self._deferred = []
+            self._take(batch)
+            if batch:
+                try:
+                    self.flush(batch)
+                    batch = []
+                except Exception as e:
+                    logger.exception("Could not write %d webhook events; retrying", len(batch))
+                    self._count("flush_errors")
+                    WEBHOOK_ERRORS.inc(error="flush_failed")
+                    if not _is_transient(e):
+                        batch = self._flush_each(batch)
+                    if batch:
+                        if stopping:
+                            return
+                        time.sleep(self.retry_interval)
+            elif stopping:
+                return
+
+    def _flush_each(self, events):
+        """
+        Write a batch that failed on its data one event at a time, dropping
+        the events that fail on their own. Returns the events left to retry
+        once the database is reachable again.
+        """
+        for i, event in enumerate(events):
+            try:
+                self.flush([event])
+            except Exception as e:
+                if _is_transient(e):
+                    return events[i:]
+                logger.error("Dropping webhook event %s %r: %s", event[0], event[1], e)
+                self._count("dead_letters")
+                WEBHOOK_ERRORS.inc(error="dead_letter")
+        return []
+
+    def flush(self, events):
+        """Insert a batch of events, then apply its status callbacks, in one transaction."""
+        by_kind = {"sms": [], "call": [], "sms_status": [], "call_status": []}
+        for kind, values in events:
+            by_kind[kind].append(values)
+
+        started = time.perf_counter()
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            users = set()
+            inserted = 0
+            for kind, sql in (("sms", INSERT_SMS), ("call", INSERT_CALL)):
+                if by_kind[kind]:
+                    rows = execute_values(cur, sql, by_kind[kind], page_size=len(by_kind[kind]), fetch=True)
+                    inserted += len(rows)
+                    users.update(user_id for row in rows for user_id in row)
+
+            # After the inserts, so a call's status in the same batch finds its row
+            updated = set()
+            for kind, sql, coalesce, template in (
+                ("sms_status", UPDATE_MESSAGE_STATUS, _coalesce_message_statuses, "(%s, %s, %s::integer, %s::text)"),
+                ("call_status", UPDATE_CALL_STATUS, _coalesce_call_statuses,
+                 "(%s, %s, %s::integer, %s::timestamp, %s::timestamp, %s::integer)"),
+            ):
+                if by_kind[kind]:
+                    rows = coalesce(by_kind[kind])
+                    found = execute_values(cur, sql, rows, template=template, page_size=len(rows), fetch=True)
+                    updated.update((kind, row[0]) for row in found)
+                    users.update(user_id for row in found for user_id in row[1:])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+        # Sessions in this process see the new rows on their next rerun
+        if users:
+            get_query_cache().invalidate(*users)
+
+        # Statuses whose SID isn't stored yet wait for a later batch, for a while
+        waited_out = datetime.now().timestamp() - self.status_wait
+        deferred = dropped = 0
+        for kind in ("sms_status", "call_status"):
+            for values in by_kind[kind]:
+                if (kind, values[0]) in updated:
+                    continue
+                if values[-1].timestamp() > waited_out:
+                    self._deferred.append((kind, values))
+                    deferred += 1
+                else:
+                    dropped += 1
+        if deferred:
+            self._deferred_at = time.monotonic()
+
+        elapsed = time.perf_counter() - started
+        FLUSH_SECONDS.observe(elapsed)
+        with self._stats_lock:
+            self.stats["batches"] += 1
+            self.stats["inserted"] += inserted
+            # Retries of already stored events, and calls from unknown numbers
+            self.stats["skipped"] += len(by_kind["sms"]) + len(by_kind["call"]) - inserted
+            self.stats["status_updates"] += len(updated)
+            self.stats["status_deferred"] += deferred
+            self.stats["status_dropped"] += dropped
+            self.stats["flush_seconds"] += elapsed
+
+
+_ingestor = None
+_ingestor_pid = None
+_ingestor_lock = threading.Lock()
+
+
+def get_webhook_ingestor():
+    """Process-wide WebhookIngestor, started on first use and drained at exit."""
+    global _ingestor, _ingestor_pid
+    with _ingestor_lock:
+        if _ingestor is None or _ingestor_pid != os.getpid():
+            _ingestor = WebhookIngestor(
+                batch_size=int(os.getenv("WEBHOOK_BATCH_SIZE", "500")),
+                flush_interval=float(os.getenv("WEBHOOK_FLUSH_INTERVAL", "0.2")),
+                max_queue=int(os.getenv("WEBHOOK_MAX_QUEUE", "50000")),
+                status_wait=float(os.getenv("WEBHOOK_STATUS_WAIT", "30")),
+            ).start()
+            _ingestor_pid = os.getpid()
+            atexit.register(_ingestor.stop)
+        return _ingestor
+
+
+def _queue_depth():
+    if _ingestor is None or _ingestor_pid != os.getpid():
+        return []
+    return [({}, _ingestor.pending())]
+
+
+Gauge("omni_webhook_queue_depth", "Webhook events waiting to be written", collect=_queue_depth)
@@ -0,0 +1,128 @@
+# webhook_server.py - Multi-process WSGI server for the webhook app, run apart from Streamlit
+
+import argparse
+import logging
+import os
+from dotenv import load_dotenv
+from migrations import ensure_schema
+from attachment_store import check_link_secret
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def server_options():
+    """
+    Serving options from the environment.
+
+    Every worker process has its own connection pool (DB_POOL_MAX
+    connections), webhook ingestor and metrics, so workers x DB_POOL_MAX
+    must stay below the server's max_connections.
+    """
+    return {
+        "bind": os.getenv("WEBHOOK_BIND", "0.0.0.0:5000"),
+        "workers": int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1))),
+        "threads": int(os.getenv("WEBHOOK_THREADS", "8")),
+        # Seconds in-flight requests get to finish after SIGTERM, before the
+        # worker drains its ingestor queue and exits
+        "graceful_timeout": int(os.getenv("WEBHOOK_GRACEFUL_TIMEOUT", "30")),
+        "timeout": int(os.getenv("WEBHOOK_TIMEOUT", "60")),
+        "keepalive": int(os.getenv("WEBHOOK_KEEPALIVE", "5")),
+        "backlog": int(os.getenv("WEBHOOK_BACKLOG", "2048")),
+    }
+
+
+def _start_worker_metrics(server, worker):
+    # /metrics on the shared port answers from whichever worker accepted the
+    # connection; with WEBHOOK_METRICS_PORT each worker also listens on the
+    # first free port from there, so every worker can be scraped
+    base = os.getenv("WEBHOOK_METRICS_PORT")
+    if not base:
+        return
+    from metrics import start_metrics_server
+
+    for port in range(int(base), int(base) + 2 * server.num_workers):
+        try:
+            start_metrics_server(port)
+            return
+        except OSError:
+            continue
+    server.log.warning("Worker %s found no free metrics port from %s", worker.pid, base)
+
+
+def _stop_ingestor(server, worker):
+    # The ingestor also drains at interpreter exit; doing it here keeps the
+    # write inside the worker's graceful shutdown and logs how much was left
+    from webhook_ingest import get_webhook_ingestor
+
+    ingestor = get_webhook_ingestor()
+    pending = ingestor.pending()
+    ingestor.stop()
+    server.log.info("Worker %s wrote its last %d webhook events", worker.pid, pending)
+
+
+def serve_gunicorn(options):
+    """
+    Serve webhooks.flask_app from `workers` pre-forked processes with
+    `threads` threads each. SIGTERM/SIGINT stop accepting connections, let
+    in-flight requests finish, then write each worker's queued webhook
+    events before exiting; SIGHUP reloads the workers, TTIN/TTOU add and
+    remove one.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class WebhookApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+            self.cfg.set("worker_class", "gthread")
+            # Import the app (and its dependencies) once, before forking
+            self.cfg.set("preload_app", True)
+            self.cfg.set("post_fork", _start_worker_metrics)
+            self.cfg.set("worker_exit", _stop_ingestor)
+
+        def load(self):
+            from webhooks import flask_app
+            return flask_app
+
+    WebhookApplication().run()
+
+
+def serve_threaded(options):
+    """Single-process fallback where gunicorn is unavailable (Windows): one thread per request."""
+    from werkzeug.serving import run_simple
+    from webhooks import flask_app
+
+    host, _, port = options["bind"].rpartition(":")
+    logger.warning("gunicorn is not installed; serving webhooks from one process on %s", options["bind"])
+    run_simple(host or "0.0.0.0", int(port), flask_app, threaded=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Twilio webhooks, status callbacks and attachments")
+    parser.add_argument("--bind", help="host:port to listen on (WEBHOOK_BIND)")
+    parser.add_argument("--workers", type=int, help="worker processes (WEBHOOK_WORKERS, default: CPU count)")
+    parser.add_argument("--threads", type=int, help="threads per worker (WEBHOOK_THREADS)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    options = server_options()
+    options.update({key: value for key, value in vars(args).items() if value is not None})
+
+    try:
+        check_link_secret()
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    # Once here, so the workers start without migrating
+    ensure_schema()
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        serve_threaded(options)
+    else:
+        serve_gunicorn(options)
+
+
+if __name__ == "__main__":
+    main()
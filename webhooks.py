@@ -0,0 +1,194 @@
+# webhooks.py - Flask app for Twilio webhooks, status callbacks and attachment downloads
+#
+# Kept apart from the Streamlit UI so it can be served on its own by a
+# multi-process WSGI server (see webhook_server.py).
+
+import logging
+import os
+from twilio.twiml.voice_response import VoiceResponse
+from flask import Flask, request, abort, jsonify, send_file
+from dotenv import load_dotenv
+from webhook_ingest import get_webhook_ingestor
+from identity import get_identity_cache
+from attachment_store import verify_link, load_attachment
+from previews import get_preview_cache
+from metrics import instrument
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+flask_app = Flask(__name__)
+
+# Twilio SIDs are 34 characters, as are the columns they are stored in
+SID_LENGTH = 34
+
+
+def form_text(name):
+    """A form field without NUL characters, which Postgres text cannot store."""
+    value = request.form.get(name)
+    return value.replace('\x00', '') if value is not None else None
+
+
+def valid_sid(sid):
+    return sid is None or len(sid) <= SID_LENGTH
+
+# Add a route for the root URL
+@flask_app.route('/')
+def index():
+    return "Welcome to the Omni-Channel Communication App!"
+
+# Add a route for the favicon
+@flask_app.route('/favicon.ico')
+def favicon():
+    return '', 204
+
+# Inbound SMS from Twilio
+@flask_app.route('/webhook/sms', methods=['POST'])
+def receive_sms():
+    message_sid = form_text('MessageSid')
+    sender_phone = form_text('From')
+    receiver_phone = form_text('To')
+    content = form_text('Body')
+    if not sender_phone or not receiver_phone or content is None:
+        return jsonify({"status": "error", "message": "From, To and Body are required"}), 400
+    if not valid_sid(message_sid):
+        return jsonify({"status": "error", "message": "invalid MessageSid"}), 400
+    
+    # Queue the message and acknowledge right away; the ingestor writes it in
+    # the next batch and drops Twilio retries of the same MessageSid
+    if not get_webhook_ingestor().submit_sms(message_sid, sender_phone, receiver_phone, content):
+        return jsonify({"status": "error", "message": "busy, retry later"}), 503
+    
+    return jsonify({"status": "success"}), 200
+
+# Function to handle incoming calls
+@flask_app.route("/incoming-call", methods=["POST"])
+def incoming_call():
+    # Get call details from Twilio
+    from_number = form_text('From') or ''
+    call_sid = form_text('CallSid')
+    if not valid_sid(call_sid):
+        return "invalid CallSid", 400
+    logger.debug("Incoming call %s from %s", call_sid, from_number)
+    
+    # Queue the call record and answer at once; the webhook ingestor writes
+    # it in the next batch and drops Twilio retries of the same CallSid. A
+    # full queue answers 503 so Twilio redelivers instead of the call going
+    # unrecorded
+    if not get_webhook_ingestor().submit_call(call_sid, from_number):
+        return "busy, retry later", 503
+    
+    # Find user2 to receive the call
+    receiver = get_identity_cache().by_username('user2')
+    receiver_phone = receiver.phone_number if receiver else None
+    
+    # Create TwiML response to forward the call to user2's phone number
+    response = VoiceResponse()
+    response.say("Hello, this is a call from the Omni-Channel Communication App.")
+    response.dial(receiver_phone)
+    
+    return str(response)
+
+# Delivery reports for messages sent through the dispatcher (StatusCallback)
+@flask_app.route("/twilio/message-status", methods=["POST"])
+def message_status():
+    message_sid = form_text('MessageSid')
+    message_status = form_text('MessageStatus')
+    if not message_sid or not message_status:
+        return "MessageSid and MessageStatus are required", 400
+    if not valid_sid(message_sid):
+        return "invalid MessageSid", 400
+
+    # Coalesced with the other callbacks of the same batch into one UPDATE
+    if not get_webhook_ingestor().submit_message_status(message_sid, message_status, form_text('ErrorCode')):
+        return "busy, retry later", 503
+    return '', 204
+
+# Call progress (ringing, answered, completed with its duration) for placed and forwarded calls
+@flask_app.route("/twilio/call-status", methods=["POST"])
+def call_status():
+    call_sid = form_text('CallSid')
+    call_status = form_text('CallStatus')
+    if not call_sid or not call_status:
+        return "CallSid and CallStatus are required", 400
+    if not valid_sid(call_sid):
+        return "invalid CallSid", 400
+
+    if not get_webhook_ingestor().submit_call_status(call_sid, call_status, request.form.get('CallDuration')):
+        return "busy, retry later", 503
+    return '', 204
+
+# Serve stored attachments straight from disk to the browser
+@flask_app.route("/attachments/<int:attachment_id>")
+def serve_attachment(attachment_id):
+    """
+    Stream one attachment to a user holding a signed link (see attachment_url).
+    
+    send_file hands the open file
+    to the WSGI server's file wrapper (sendfile where supported, X-Sendfile
+    with ATTACHMENT_X_SENDFILE) and answers Range and If-None-Match itself;
+    blobs are named by their SHA-256, so it is a strong ETag and the response
+    never changes.
+    """
+    attachment = authorized_attachment(attachment_id)
+    response = send_file(
+        os.path.abspath(attachment.path),
+        mimetype=attachment.content_type,
+        as_attachment=not attachment.content_type.startswith('image/'),
+        download_name=attachment.filename,
+        conditional=True,
+        etag=attachment.sha256,
+        max_age=365 * 24 * 3600,
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+@flask_app.route("/attachments/<int:attachment_id>/preview")
+def serve_attachment_preview(attachment_id):
+    """The cached thumbnail of an image or PDF attachment; 404 until it has been built."""
+    attachment = authorized_attachment(attachment_id)
+    previews = get_preview_cache()
+    if previews.status(attachment.sha256, attachment.content_type, attachment.path) != "ready":
+        abort(404)
+    
+    try:
+        response = send_file(
+            os.path.abspath(previews.path(attachment.sha256)),
+            mimetype="image/jpeg",
+            conditional=True,
+            etag=f"{attachment.sha256}-{previews.max_size}",
+            max_age=365 * 24 * 3600,
+        )
+    except FileNotFoundError:
+        # Evicted by another process since the check; render it again
+        previews.submit(attachment.sha256, attachment.content_type, attachment.path)
+        abort(404)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def authorized_attachment(attachment_id):
+    """
+    The attachment a signed link points at, aborting with 403 unless the
+    link is valid and the message belongs to its user (or is a synced inbox
+    email, since the inbox is shared), and with 404 if there is none.
+    """
+    user_id = request.args.get('u')
+    if not verify_link(attachment_id, user_id, request.args.get('e'), request.args.get('s')):
+        abort(403)
+    
+    found = load_attachment(attachment_id)
+    if found is None:
+        abort(404)
+    attachment, sender_id, receiver_id, is_inbox_email = found
+    if int(user_id) not in (sender_id, receiver_id) and not is_inbox_email:
+        abort(403)
+    return attachment
+
+flask_app.use_x_sendfile = os.getenv('ATTACHMENT_X_SENDFILE', 'false').lower() == 'true'
+# Request timings and ingest queue depth, scraped from /metrics
+instrument(flask_app)